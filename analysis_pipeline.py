@@ -0,0 +1,511 @@
+# analysis_pipeline.py
+# 圖片分析流程：Vision API 物件偵測 -> LLM 名稱精煉 -> (典型份量 ∥ 每 100 克營養) -> 依克數換算營養
+# 這裡的函式會在背景執行緒中執行，因此「不可以」呼叫任何 st.* UI 函式；
+# 所有要顯示給使用者的訊息都收集在回傳結果中，由 app_streamlit.py 負責呈現。
+
+import contextvars
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+from vision_module import vision_api
+import llm_module
+import portion_table
+import label_resolution
+import label_filter
+import metrics
+import nutrition_providers
+import llm_usage
+from stage_scheduler import StageGraph
+from deadline import Deadline, is_expired
+from food_item import FoodItem, NUTRIENT_KEYS, PendingRefinement, StageStatus, sum_nutrients
+
+VISION_SCORE_THRESHOLD = 0.45 # Vision 物件的信賴度門檻
+DEFAULT_PORTION_GRAMS = 100    # LLM 無法建議份量時使用的預設克數
+MAX_ANALYSIS_WORKERS = 4       # 同時分析的圖片數上限 (避免一次對 API 發出過多請求)
+USE_CROP_LABELS = True         # 是否對每個物件裁切後做批次標籤偵測，以取得更具體的名稱
+ANALYSIS_DEADLINE_SECONDS = 45.0 # 一次分析 (所有圖片) 的整體截止時間；超過時先回傳已完成的項目
+DEADLINE_GRACE_SECONDS = 3.0     # 截止後再等工作執行緒收尾的時間 (已送出的 API 呼叫無法中斷)
+ITEM_COMPLETION_DEADLINE_SECONDS = 30.0 # 補完單一 pending 項目的截止時間
+NUTRITION_REFERENCE_GRAMS = 100  # 營養先以每 100 克查詢 (與份量建議同時進行)，再依克數換算
+STAGE_WORKERS = 32               # 執行各物件分析階段的執行緒數 (每個分析執行緒同時最多 2 個階段)
+
+_stage_executor = ThreadPoolExecutor(max_workers=STAGE_WORKERS, thread_name_prefix="foodie-stage")
+
+STATUS_PENDING = StageStatus.PENDING # 截止時間到時尚未執行的階段，之後由 complete_pending_item 補完
+
+# 分析模式
+ANALYSIS_MODE_VISION_LLM = "vision_llm"   # Vision 物件偵測 + 每個物件的文字 LLM 三段流程
+ANALYSIS_MODE_MULTIMODAL = "multimodal"   # 直接把圖片交給多模態 Gemini，一次取得全部結果
+ANALYSIS_MODES = {
+    ANALYSIS_MODE_VISION_LLM: "Vision API + LLM 分段分析 (較細緻，呼叫次數多)",
+    ANALYSIS_MODE_MULTIMODAL: "Gemini 多模態直接分析 (單次呼叫，速度快)",
+}
+MULTIMODAL_OBJECT_NAME = "Gemini 多模態" # 多模態模式沒有 Vision 物件名稱，以此標示來源
+
+
+def _new_result():
+    return {
+        "status": "success",
+        "items": [],
+        "messages": [], # (level, text)，level 為 "info" / "caption" / "warning" / "error"
+        "debug": [],    # (標題, 內容)，供 UI 的除錯區塊顯示
+        "llm_usage": None, # 這張圖片的 LLM token 用量與估算費用 (llm_usage.TokenUsage.snapshot())
+    }
+
+
+def resolve_food_name(object_name, label_hints=None, deadline=None):
+    """
+    將 Vision 標籤精煉為具體食物名稱：先查離線建好的標籤查表，再以本地標籤過濾 (非食物 / 食物類別) 判斷，
+    都無法判斷時才呼叫 LLM (其結果供標籤過濾學習)。
+    查表結果為 "category" 但有裁切標籤線索時，仍交給 LLM 依線索判斷更具體的名稱。
+    回傳格式同 llm_module.refine_food_name_with_llm。
+    """
+    table_result = label_resolution.resolve_label(object_name)
+    if table_result and not (table_result["status"] == "category" and label_hints):
+        return table_result
+    filter_result = label_filter.classify(object_name, label_hints=label_hints)
+    if filter_result:
+        return filter_result
+    llm_result = llm_module.refine_food_name_with_llm(object_name, label_hints=label_hints, deadline=deadline)
+    label_filter.record_llm_outcome(object_name, llm_result, label_hints=label_hints)
+    return llm_result
+
+
+def suggest_portion_grams(food_name, deadline=None):
+    """
+    建議食物的典型克數：先查份量表，查不到才問 LLM；LLM 成功建議的克數會寫回份量表。
+    回傳格式同 llm_module.get_typical_portion_grams_with_llm，另外加上 "source" ("portion_table" 或 "llm")。
+    """
+    table = portion_table.get_portion_table()
+    table_grams = table.lookup(food_name)
+    if table_grams is not None:
+        return {"status": "success", "grams": table_grams, "source": "portion_table"}
+
+    typical_portion_result = llm_module.get_typical_portion_grams_with_llm(food_name, deadline=deadline)
+    if typical_portion_result:
+        typical_portion_result["source"] = "llm"
+        if typical_portion_result["status"] == "success" and typical_portion_result["grams"] is not None:
+            table.record(food_name, typical_portion_result["grams"], source="llm")
+    return typical_portion_result
+
+
+def fetch_nutrition(food_name, grams, deadline=None):
+    """
+    查詢指定克數食物的營養：依序詢問本地食物表 -> Edamam 快取 -> Edamam API -> LLM (見 nutrition_providers)。
+    回傳格式同 llm_module.get_nutrition_from_llm，另外加上 "source" ("local" / "edamam_cache" / "edamam" / "llm")。
+    """
+    return nutrition_providers.get_default_chain().lookup(food_name, grams, deadline=deadline)
+
+
+def is_item_pending(item):
+    """項目是否還有因截止時間而尚未執行的階段。"""
+    return item.is_pending()
+
+
+def _refine_item(item, result, deadline=None):
+    """名稱精煉階段；回傳 False 表示該物件不是具體食物 (或精煉失敗)，應捨棄。"""
+    refine_input = item.pending_refinement
+    object_name = refine_input.object_name
+    if is_expired(deadline):
+        return True
+
+    refined_name_result = resolve_food_name(object_name, label_hints=refine_input.label_hints, deadline=deadline)
+    result["debug"].append((f"'{object_name}' (Vision 信賴度: {refine_input.vision_score:.2f}) 的精煉結果 (標籤查表或 LLM)",
+                            refined_name_result if refined_name_result else "LLM refine_food_name_with_llm 未返回結果或結果為 None"))
+
+    if refined_name_result and refined_name_result["status"] == "category":
+        result["messages"].append(("info", f"AI 判斷 '{object_name}' 是一個食物類別 '{refined_name_result['refined_name']}'，而非具體品項，已略過。"))
+        return False
+    if refined_name_result and refined_name_result["status"] in ["not_food", "unknown_food"]:
+        result["messages"].append(("info", f"AI 判斷 '{object_name}' 為 '{refined_name_result['status']}' ({refined_name_result.get('refined_name', '')})，已略過。"))
+        return False
+    if not refined_name_result or refined_name_result["status"] != "success":
+        return is_expired(deadline) # 因截止時間而失敗時保留為 pending；其他 "error" 狀態會被自然略過
+
+    item.llm_refined_name = refined_name_result["refined_name"]
+    item.status_name_refinement = StageStatus.SUCCESS
+    item.pending_refinement = None
+    return True
+
+
+def _suggest_item_portion(item, result, deadline=None):
+    """典型份量階段 (截止時間已到則保持 pending)。"""
+    if is_expired(deadline):
+        return
+    food_name = item.llm_refined_name
+    typical_portion_result = suggest_portion_grams(food_name, deadline=deadline)
+    result["debug"].append((f"'{food_name}' 的典型份量建議結果 (份量表或 LLM)",
+                            typical_portion_result if typical_portion_result else "LLM get_typical_portion_grams_with_llm 未返回結果或結果為 None"))
+
+    suggested_grams = DEFAULT_PORTION_GRAMS
+    if typical_portion_result and typical_portion_result["status"] == "success" and typical_portion_result["grams"] is not None:
+        suggested_grams = typical_portion_result["grams"]
+    elif typical_portion_result and typical_portion_result["status"] == "unknown_weight":
+        result["messages"].append(("caption", f"提示：AI 未能為 '{food_name}' 建議典型克數，預設為 {suggested_grams}克。"))
+    elif is_expired(deadline):
+        return
+
+    item.llm_suggested_grams = suggested_grams
+    item.user_grams = suggested_grams
+    item.status_portion_suggestion = StageStatus.parse(typical_portion_result.get("status") if typical_portion_result else "error")
+
+
+def _fetch_item_nutrition_per_100g(item, result, deadline=None):
+    """每 100 克營養查詢階段 (只需要精煉後的名稱，與典型份量階段同時執行)；截止時間已到則返回 None。"""
+    if is_expired(deadline):
+        return None
+    food_name = item.llm_refined_name
+    nutrition_data_result = fetch_nutrition(food_name, NUTRITION_REFERENCE_GRAMS, deadline=deadline)
+    result["debug"].append((f"'{food_name}' 每 {NUTRITION_REFERENCE_GRAMS} 克的營養數據查詢結果 (營養來源鏈)",
+                            nutrition_data_result if nutrition_data_result else "營養來源鏈未返回結果或結果為 None"))
+    return nutrition_data_result
+
+
+def _apply_item_nutrition(item, result, nutrition_per_100g_result):
+    """依項目的克數換算營養 (份量與每 100 克營養都完成後執行)；份量或營養仍未完成時保持 pending。"""
+    if item.status_portion_suggestion is STATUS_PENDING:
+        return
+    if nutrition_per_100g_result is None or nutrition_per_100g_result["status"] == "timeout":
+        return
+    food_name, grams = item.llm_refined_name, item.user_grams
+    if nutrition_per_100g_result["status"] == "no_data":
+        result["messages"].append(("caption", f"提示：AI 未能查詢到 '{food_name}' ({grams}克) 的詳細營養數據。"))
+    if nutrition_per_100g_result["status"] == "success":
+        item.set_nutrition("success", nutrition_providers.scale_per_100g(nutrition_per_100g_result["data"], grams),
+                           nutrition_per_100g_result.get("source"))
+    else:
+        item.set_nutrition(nutrition_per_100g_result["status"])
+
+
+def _advance_item(item, result, deadline=None):
+    """
+    執行項目尚未完成的階段，截止時間到了就停在目前的階段。
+    階段的相依關係：名稱精煉 -> (典型份量 ∥ 每 100 克營養) -> 依克數換算營養；
+    份量與營養只需要精煉後的名稱，因此同時查詢 (關鍵路徑為 2 次往返)。
+    回傳 False 表示該項目應捨棄 (不是具體食物)。
+    """
+    keep_item = True
+    nutrition_per_100g_results = []
+
+    def _refine_stage():
+        nonlocal keep_item
+        keep_item = _refine_item(item, result, deadline)
+        return keep_item and item.status_name_refinement is not STATUS_PENDING # 未完成精煉時後續階段都不執行
+
+    def _nutrition_per_100g_stage():
+        nutrition_per_100g_results.append(_fetch_item_nutrition_per_100g(item, result, deadline))
+
+    graph = StageGraph(f"'{item.vision_object_name}'")
+    name_stages = ()
+    if item.status_name_refinement is STATUS_PENDING:
+        graph.add("refine", _refine_stage)
+        name_stages = ("refine",)
+    nutrition_inputs = name_stages
+    if item.status_portion_suggestion is STATUS_PENDING:
+        graph.add("portion", lambda: _suggest_item_portion(item, result, deadline), depends_on=name_stages)
+        nutrition_inputs += ("portion",)
+    if item.status_nutrition_fetch is STATUS_PENDING:
+        graph.add("nutrition_per_100g", _nutrition_per_100g_stage, depends_on=name_stages)
+        graph.add("nutrition", lambda: _apply_item_nutrition(item, result, nutrition_per_100g_results[0]),
+                  depends_on=nutrition_inputs + ("nutrition_per_100g",))
+    if len(graph):
+        graph.run(_stage_executor)
+    return keep_item
+
+
+def _analyze_vision_object(object_name, vision_score, result, crop_labels=None, deadline=None):
+    """
+    對單一 Vision 物件執行名稱精煉 -> 典型份量 -> 營養三段流程，回傳 FoodItem；不是具體食物時回傳 None。
+    crop_labels 為該物件裁切圖的標籤偵測結果 [(標籤, 分數), ...]，用來取得更具體的名稱。
+    整體截止時間到時，尚未執行的階段標記為 STATUS_PENDING (項目仍會回傳，之後可補完)。
+    """
+    vision_object_name = object_name
+    label_hints = [label for label, _ in crop_labels] if crop_labels else None
+    object_name = vision_api.pick_specific_label(object_name, crop_labels)
+    if object_name != vision_object_name:
+        result["debug"].append((f"裁切標籤將 '{vision_object_name}' 具體化為 '{object_name}'", crop_labels))
+
+    food_item = FoodItem(
+        vision_object_name=vision_object_name,
+        llm_refined_name=object_name, # 精煉完成前先顯示 Vision 名稱
+        llm_suggested_grams=DEFAULT_PORTION_GRAMS,
+        user_grams=DEFAULT_PORTION_GRAMS,
+        # 名稱精煉需要的輸入；精煉完成後移除
+        pending_refinement=PendingRefinement(object_name, vision_score, label_hints),
+    )
+    if not _advance_item(food_item, result, deadline):
+        return None
+    return food_item
+
+
+def complete_pending_item(item, deadline_seconds=ITEM_COMPLETION_DEADLINE_SECONDS):
+    """
+    補完因整體截止時間而未完成的項目 (直接修改 item)。
+    Returns:
+        tuple: (item 或 None (該物件經精煉後不是具體食物，應移除), 提示訊息列表)
+    """
+    result = _new_result()
+    keep_item = _advance_item(item, result, Deadline(deadline_seconds))
+    return (item if keep_item else None), result["messages"]
+
+
+def complete_pending_items(items, max_workers=MAX_ANALYSIS_WORKERS):
+    """同時補完多個 pending 項目，回傳與 items 順序相同的 complete_pending_item 結果列表。"""
+    if not items:
+        return []
+    # 每個項目在呼叫端 context 的副本中執行，LLM token 用量才會算進呼叫端的 llm_usage.track_usage() 範圍
+    contexts = [contextvars.copy_context() for _ in items]
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(items))), thread_name_prefix="foodie-complete") as executor:
+        return list(executor.map(lambda context, item: context.run(complete_pending_item, item), contexts, items))
+
+
+def _mark_timeout(result):
+    result["status"] = "timeout"
+    result["messages"].append(("warning", "分析超過時間上限，這張圖片尚未完成辨識，請稍後重新分析。"))
+    return result
+
+
+def _mark_partial(result):
+    # 截止時間到時仍有未完成的項目：先回傳已完成的部分，未完成的項目之後再補完
+    pending_count = sum(1 for item in result["items"] if is_item_pending(item))
+    if pending_count:
+        result["status"] = "partial"
+        result["messages"].append(("warning", f"分析超過時間上限，有 {pending_count} 個項目尚未完成，"
+                                              "可點擊項目中的「⏳ 完成分析」補完。"))
+    return result
+
+
+def analyze_food_image(image_bytes, image_key=None, image_name=None, deadline=None, result=None):
+    """
+    分析單張食物圖片。
+    Args:
+        image_bytes (bytes): 圖片原始位元組。
+        image_key (str): 圖片的識別 key (會記錄在每個食物項目中，方便依圖片分組)。
+        image_name (str): 圖片檔名 (用於顯示)。
+        deadline (deadline.Deadline, 可選): 整體截止時間；到期時未完成的項目標記為 pending。
+        result (dict, 可選): 要寫入的結果字典 (由 analyze_images_concurrently 傳入，逾時時可取得已完成的部分)。
+    Returns:
+        dict: {"status": "success" | "partial" | "no_objects" | "vision_error" | "timeout",
+               "items": FoodItem 列表, "messages": 提示訊息列表, "debug": 除錯資訊列表}
+    """
+    result = result if result is not None else _new_result()
+    if is_expired(deadline):
+        return _mark_timeout(result)
+
+    vision_results = vision_api.analyze_image_objects(
+        image_bytes, include_bounding_boxes=True, timeout=deadline.remaining() if deadline else None)
+    result["debug"].append(("Vision API 原始結果 (vision_results)",
+                            vision_results if vision_results is not None else "Vision API 未返回結果或結果為 None (例如憑證或API呼叫問題)"))
+    if vision_results is None and is_expired(deadline):
+        return _mark_timeout(result)
+    if vision_results is None:
+        result["status"] = "vision_error"
+        result["messages"].append(("info", "Vision API 未偵測到任何物件。請嘗試另一張圖片或檢查 API 設定。"))
+        return result
+    if not vision_results:
+        result["status"] = "no_objects"
+        result["messages"].append(("info", "Vision API 未偵測到任何物件。請嘗試另一張圖片或檢查 API 設定。"))
+        return result
+
+    # 同名的物件可能是不同的食物 (例如盤子上的兩顆蘋果)：只去掉名稱與框都相同的重複結果，
+    # 其餘的合併一律交給下方的重疊框去重 (沒有框的物件才退回以名稱去重)
+    processed_vision_objects = set()
+    unique_vision_objects = []
+    non_food_names = []
+    for vision_object in vision_results:
+        name = vision_object["name"]
+        bounding_box = vision_object.get("bounding_box")
+        object_key = (name.lower(), tuple(map(tuple, bounding_box)) if bounding_box else None)
+        if vision_object["score"] > VISION_SCORE_THRESHOLD and object_key not in processed_vision_objects:
+            processed_vision_objects.add(object_key)
+            # 確定不是食物的標籤在裁切與名稱精煉之前就略過 (不需要裁切標籤，也不需要問 LLM)；
+            # 標籤查表已有結果的標籤本來就不會問 LLM，不計入省下的 LLM 呼叫
+            if label_filter.classify(name, allow_category=False, count_saved=not label_resolution.has_label(name)):
+                non_food_names.append(name)
+            else:
+                unique_vision_objects.append(vision_object)
+    if non_food_names:
+        result["debug"].append(("本地標籤過濾略過的非食物物件 (label_filter)", non_food_names))
+    # 同一區域的多個標籤 (例如 "Food"、"Baked goods"、"Bread") 只保留最具體、信賴度最高的一個；
+    # 在略過非食物之後才做，避免盤子之類的大框把上面的食物擠掉
+    unique_vision_objects, overlapping_objects = vision_api.suppress_overlapping_objects(unique_vision_objects)
+    if overlapping_objects:
+        metrics.increment("vision.overlap_suppressed", len(overlapping_objects))
+        result["debug"].append(("重疊框去重捨棄的物件 (捨棄的名稱, 保留的名稱, IoU)", overlapping_objects))
+    result["debug"].append(("初步過濾和去重後的 Vision API 物件 (unique_vision_objects)",
+                            unique_vision_objects if unique_vision_objects else "沒有符合初步過濾條件的 Vision API 物件"))
+
+    if not unique_vision_objects:
+        result["status"] = "no_objects"
+        result["messages"].append(("info", "Vision API 未偵測到足夠可用於後續分析的物件。"))
+        return result
+
+    # 一次批次請求取得所有物件裁切圖的標籤 (失敗時退回只用物件名稱)
+    all_crop_labels = None
+    if USE_CROP_LABELS and not is_expired(deadline):
+        all_crop_labels = vision_api.label_object_crops(image_bytes, unique_vision_objects,
+                                                        timeout=deadline.remaining() if deadline else None)
+        result["debug"].append(("物件裁切圖的批次標籤偵測結果 (crop_labels)",
+                                all_crop_labels if all_crop_labels is not None else "批次標籤偵測未返回結果 (將只使用物件名稱)"))
+    if not all_crop_labels:
+        all_crop_labels = [None] * len(unique_vision_objects)
+
+    for vision_object, crop_labels in zip(unique_vision_objects, all_crop_labels):
+        food_item = _analyze_vision_object(vision_object["name"], vision_object["score"], result,
+                                           crop_labels=crop_labels, deadline=deadline)
+        if food_item:
+            food_item.image_key = image_key
+            food_item.image_name = image_name
+            result["items"].append(food_item)
+    return _mark_partial(result)
+
+
+def _guess_image_mime_type(image_bytes):
+    """依檔頭判斷圖片格式 (上傳只接受 JPG/PNG)。"""
+    if image_bytes[:8] == b"\x89PNG\r\n\x1a\n":
+        return "image/png"
+    return "image/jpeg"
+
+
+def analyze_food_image_multimodal(image_bytes, image_key=None, image_name=None, deadline=None, result=None):
+    """
+    以多模態 Gemini 一次分析單張食物圖片 (不經過 Vision API 與逐項文字 LLM 呼叫)。
+    參數與回傳格式同 analyze_food_image (單次呼叫沒有部分結果，逾時時整張圖片為 "timeout")。
+    """
+    result = result if result is not None else _new_result()
+    if is_expired(deadline):
+        return _mark_timeout(result)
+
+    multimodal_result = llm_module.analyze_image_with_llm(image_bytes, mime_type=_guess_image_mime_type(image_bytes),
+                                                          deadline=deadline)
+    result["debug"].append(("Gemini 多模態分析結果 (multimodal_result)",
+                            multimodal_result if multimodal_result else "LLM analyze_image_with_llm 未返回結果或結果為 None"))
+
+    if (not multimodal_result or multimodal_result["status"] == "error") and is_expired(deadline):
+        return _mark_timeout(result)
+    if not multimodal_result or multimodal_result["status"] == "error":
+        result["status"] = "error"
+        result["messages"].append(("error", "Gemini 多模態分析失敗，請稍後再試或改用「Vision API + LLM 分段分析」模式。"))
+        return result
+    if multimodal_result["status"] == "no_food":
+        result["status"] = "no_objects"
+        result["messages"].append(("info", "Gemini 未在圖片中辨識出任何食物。"))
+        return result
+
+    for llm_item in multimodal_result["items"]:
+        suggested_grams = llm_item["grams"]
+        status_portion_suggestion = "success"
+        if suggested_grams is None:
+            suggested_grams = DEFAULT_PORTION_GRAMS
+            status_portion_suggestion = "unknown_weight"
+            result["messages"].append(("caption", f"提示：AI 未能為 '{llm_item['name']}' 估計克數，預設為 {suggested_grams}克。"))
+        # 克數是 AI 預設的，營養數據也是依該克數估算；克數為預設值時營養數據不可信，交由使用者重新計算
+        nutrition_info = llm_item["nutrition"] if status_portion_suggestion == "success" and llm_item["nutrition"] else None
+        food_item = FoodItem(
+            vision_object_name=MULTIMODAL_OBJECT_NAME,
+            llm_refined_name=llm_item["name"],
+            llm_suggested_grams=suggested_grams,
+            user_grams=suggested_grams,
+            status_name_refinement=StageStatus.SUCCESS,
+            status_portion_suggestion=StageStatus.parse(status_portion_suggestion),
+            image_key=image_key,
+            image_name=image_name,
+        )
+        food_item.set_nutrition(StageStatus.SUCCESS if nutrition_info else StageStatus.ERROR, nutrition_info, "llm")
+        result["items"].append(food_item)
+    return result
+
+
+def analyze_images_concurrently(images, load_image_bytes, max_workers=MAX_ANALYSIS_WORKERS, mode=ANALYSIS_MODE_VISION_LLM,
+                                deadline_seconds=ANALYSIS_DEADLINE_SECONDS, on_progress=None):
+    """
+    以有上限的執行緒池同時分析多張圖片。
+    Args:
+        images (list): (image_key, image_name) 的列表。
+        load_image_bytes (callable): 傳入 image_key、回傳原圖位元組的函式 (或 None 表示已無法取得)。
+                                     在工作執行緒中才讀取原圖，避免所有原圖同時留在記憶體。
+        max_workers (int): 執行緒池大小上限。
+        mode (str): 分析模式，ANALYSIS_MODE_VISION_LLM 或 ANALYSIS_MODE_MULTIMODAL。
+        deadline_seconds (float): 整體截止時間 (秒)，None 表示不限時。到期後最多再等 DEADLINE_GRACE_SECONDS，
+                                  仍未完成的圖片只回傳已完成的項目 (status 為 "timeout")。
+        on_progress (callable, 可選): 每完成一張圖片就呼叫 on_progress(已完成張數, 總張數) (在工作執行緒中呼叫)。
+    Returns:
+        dict: image_key -> analyze_food_image 的結果 (順序與 images 相同)。
+    """
+    analysis_deadline = Deadline(deadline_seconds) if deadline_seconds else None
+    # 每張圖片的結果字典事先建立並傳給工作執行緒，逾時時仍可取得已完成的項目
+    in_progress_results = {image_key: _new_result() for image_key, _ in images}
+    usage_by_image = {image_key: llm_usage.TokenUsage() for image_key, _ in images} # 逾時的圖片也能取得已用的 token
+
+    def _analyze_one(image_key, image_name):
+        with llm_usage.track_usage(usage_by_image[image_key]):
+            return _analyze_image(image_key, image_name)
+
+    def _analyze_image(image_key, image_name):
+        result = in_progress_results[image_key]
+        image_bytes = load_image_bytes(image_key)
+        if image_bytes is None:
+            result["status"] = "image_missing"
+            result["messages"].append(("warning", f"圖片 '{image_name}' 的原始檔已從暫存中清除，請重新上傳後再分析。"))
+            return result
+        if mode == ANALYSIS_MODE_MULTIMODAL:
+            return analyze_food_image_multimodal(image_bytes, image_key=image_key, image_name=image_name,
+                                                 deadline=analysis_deadline, result=result)
+        return analyze_food_image(image_bytes, image_key=image_key, image_name=image_name,
+                                  deadline=analysis_deadline, result=result)
+
+    if not images:
+        return {}
+
+    completed_count = [0]
+    completed_lock = threading.Lock()
+
+    def _report_done(_future):
+        with completed_lock:
+            completed_count[0] += 1
+            done = completed_count[0]
+        if on_progress:
+            on_progress(done, len(images))
+
+    worker_count = max(1, min(max_workers, len(images)))
+    executor = ThreadPoolExecutor(max_workers=worker_count, thread_name_prefix="foodie-analysis")
+    results = {}
+    try:
+        futures = [(image_key, executor.submit(contextvars.copy_context().run, _analyze_one, image_key, image_name))
+                   for image_key, image_name in images]
+        for _, future in futures:
+            future.add_done_callback(_report_done)
+        for image_key, future in futures:
+            wait_seconds = None if analysis_deadline is None else analysis_deadline.remaining() + DEADLINE_GRACE_SECONDS
+            try:
+                results[image_key] = future.result(timeout=wait_seconds)
+            except FutureTimeoutError:
+                # 工作執行緒仍卡在無法中斷的呼叫中：取已完成項目的快照，不再等它
+                in_progress = in_progress_results[image_key]
+                result = _new_result()
+                result["items"] = list(in_progress["items"])
+                result["messages"] = list(in_progress["messages"])
+                result["debug"] = list(in_progress["debug"])
+                results[image_key] = _mark_timeout(result)
+            except Exception as e:
+                print(f"錯誤 (analysis_pipeline.py): 分析圖片 {image_key} 時發生未預期錯誤: {e}")
+                result = _new_result()
+                result["status"] = "error"
+                result["messages"].append(("error", f"分析圖片時發生未預期錯誤: {e}"))
+                results[image_key] = result
+            results[image_key]["llm_usage"] = usage_by_image[image_key].snapshot()
+            llm_usage.record_image_usage(results[image_key]["llm_usage"])
+    finally:
+        # 不等待仍在執行的工作 (其結果會被丟棄)；尚未開始的工作直接取消
+        executor.shutdown(wait=False, cancel_futures=True)
+    return results
+
+
+def sum_nutrition(food_items):
+    """
+    加總食物項目的營養 (只計入已有營養數據的項目)。
+    Returns:
+        tuple: (各營養素總和的字典, 納入加總的項目數)
+    """
+    return sum_nutrients(food_items)
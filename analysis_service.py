@@ -0,0 +1,257 @@
+# analysis_service.py
+# 無介面的 HTTP 分析服務 (給行動裝置等無法操作 Streamlit UI 的用戶端使用)，以 tornado 非同步處理請求。
+# - 阻塞的分析工作 (Vision、Vertex AI、營養來源鏈) 交給有上限的執行緒池；排隊過多時直接回 503，避免無限堆積。
+# - 指定份量 (非克數單位) 的查詢由 measure_conversion 在本機換算；無法換算的單位才以 edamam_module 的非同步 httpx 用戶端
+#   詢問 Nutrition Analysis API，直接在 event loop 上執行。
+# - 份量表、標籤查表、本地食物索引、Edamam 快取、斷路器、LLM 對沖統計等都是模組層級的共用物件，所有請求共用。
+#
+# 啟動：python analysis_service.py [--port 8600]
+# 端點：
+#   POST /analyze-image?mode=vision_llm|multimodal   內容為圖片位元組 (或 multipart 欄位 "image")
+#   GET|POST /nutrition?food_name=apple&grams=150    也可用 JSON body；另可指定 quantity + unit (例如 1 cup)，
+#                                                     raw=1 時附上 Edamam 原始回應
+#   GET /metrics                                      指標、LLM 延遲與每日 token 用量、營養來源狀態、服務負載
+#   GET /healthz
+
+import argparse
+import asyncio
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import tornado.web
+
+from vision_module import vision_api
+import llm_module
+import llm_usage
+import edamam_module
+import measure_conversion
+import analysis_pipeline
+import image_store
+import metrics
+import nutrition_providers
+
+DEFAULT_PORT = int(os.getenv("FOODIE_SERVICE_PORT", "8600"))
+SERVICE_WORKERS = int(os.getenv("FOODIE_SERVICE_WORKERS", "8"))  # 同時執行的阻塞分析工作數
+MAX_PENDING_REQUESTS = SERVICE_WORKERS * 4 # 進行中 + 排隊中的阻塞工作上限，超過時回 503
+MAX_IMAGE_BYTES = 20 * 1024 * 1024
+RETRY_AFTER_SECONDS = 5
+
+
+class ServiceOverloaded(Exception):
+    """執行緒池的排隊數已達上限。"""
+
+
+class BoundedExecutor:
+    """有排隊上限的執行緒池：超過上限時立即拒絕，而不是讓請求無限等待。"""
+
+    def __init__(self, max_workers, max_pending):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="foodie-service")
+        self._lock = threading.Lock()
+        self._pending = 0
+
+    async def run(self, fn, *args):
+        with self._lock:
+            if self._pending >= self.max_pending:
+                metrics.increment("service.rejected")
+                raise ServiceOverloaded()
+            self._pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+    def stats(self):
+        with self._lock:
+            return {"workers": self.max_workers, "pending": self._pending, "max_pending": self.max_pending}
+
+
+def _to_json(payload):
+    # 除錯資訊中可能有非 JSON 型別 (例如 tuple 以外的物件)，一律轉成字串
+    return json.dumps(payload, ensure_ascii=False, default=str)
+
+
+class JsonHandler(tornado.web.RequestHandler):
+    """所有端點的共同基底：回應一律是 JSON (包含錯誤)。"""
+
+    def initialize(self, executor):
+        self.executor = executor
+
+    def write_json(self, payload, status=200):
+        self.set_status(status)
+        self.set_header("Content-Type", "application/json; charset=UTF-8")
+        self.finish(_to_json(payload))
+
+    def write_error(self, status_code, **kwargs):
+        message = self._reason
+        if "exc_info" in kwargs and isinstance(kwargs["exc_info"][1], tornado.web.HTTPError):
+            message = kwargs["exc_info"][1].log_message or message
+        self.set_header("Content-Type", "application/json; charset=UTF-8")
+        if status_code == 503:
+            # send_error 會先 clear() 所有標頭，退避提示必須在這裡設定
+            self.set_header("Retry-After", str(RETRY_AFTER_SECONDS))
+        self.finish(_to_json({"status": "error", "error_message": message}))
+
+    def json_body(self):
+        if not self.request.body or "application/json" not in self.request.headers.get("Content-Type", ""):
+            return {}
+        try:
+            body = json.loads(self.request.body)
+        except json.JSONDecodeError:
+            raise tornado.web.HTTPError(400, "Request body is not valid JSON.")
+        if not isinstance(body, dict):
+            raise tornado.web.HTTPError(400, "Request body must be a JSON object.")
+        return body
+
+    async def run_blocking(self, fn, *args):
+        try:
+            return await self.executor.run(fn, *args)
+        except ServiceOverloaded:
+            raise tornado.web.HTTPError(503, "Service is busy, please retry later.") # Retry-After 由 write_error 加上
+
+
+class AnalyzeImageHandler(JsonHandler):
+    async def post(self):
+        image_files = self.request.files.get("image")
+        image_bytes = image_files[0]["body"] if image_files else self.request.body
+        if not image_bytes:
+            raise tornado.web.HTTPError(400, "Missing image: send the image bytes as the body or as multipart field 'image'.")
+        if len(image_bytes) > MAX_IMAGE_BYTES:
+            raise tornado.web.HTTPError(413, "Image is too large.")
+
+        mode = self.get_argument("mode", analysis_pipeline.ANALYSIS_MODE_VISION_LLM)
+        if mode not in analysis_pipeline.ANALYSIS_MODES:
+            raise tornado.web.HTTPError(400, f"Unknown mode '{mode}'.")
+        try:
+            deadline_seconds = float(self.get_argument("deadline_seconds", analysis_pipeline.ANALYSIS_DEADLINE_SECONDS))
+        except ValueError:
+            raise tornado.web.HTTPError(400, "deadline_seconds must be a number.")
+        include_debug = self.get_argument("debug", "0") == "1"
+
+        metrics.increment("service.requests.analyze_image")
+        image_name = image_files[0]["filename"] if image_files else None
+
+        def analyze():
+            # 圖片存入磁碟快取 (與 App 共用)，回傳的 image_key 可用於日後對照；寫檔也在執行緒池中進行，不阻塞 event loop
+            image_key = image_store.get_disk_store().put(image_bytes)
+            results = analysis_pipeline.analyze_images_concurrently(
+                [(image_key, image_name)], load_image_bytes=lambda _key: image_bytes,
+                max_workers=1, mode=mode, deadline_seconds=deadline_seconds)
+            return image_key, results[image_key]
+
+        image_key, result = await self.run_blocking(analyze)
+
+        totals, item_count = analysis_pipeline.sum_nutrition(result["items"])
+        payload = {
+            "status": result["status"],
+            "image_key": image_key,
+            "items": [item.to_dict() for item in result["items"]],
+            "totals": totals,
+            "totals_item_count": item_count,
+            "messages": [{"level": level, "text": text} for level, text in result["messages"]],
+            "llm_usage": result["llm_usage"],
+        }
+        if include_debug:
+            payload["debug"] = [{"title": title, "payload": debug_payload} for title, debug_payload in result["debug"]]
+        self.write_json(payload)
+
+
+class NutritionHandler(JsonHandler):
+    async def get(self):
+        await self._lookup({})
+
+    async def post(self):
+        await self._lookup(self.json_body())
+
+    async def _lookup(self, body):
+        food_name = body.get("food_name") or self.get_argument("food_name", None)
+        if not food_name:
+            raise tornado.web.HTTPError(400, "Missing food_name.")
+        unit = body.get("unit") or self.get_argument("unit", None)
+        metrics.increment("service.requests.nutrition")
+
+        if unit and unit.lower() not in ("g", "gram", "grams"):
+            # 非克數單位 (例如 "cup"、"slice")：先以快取的 Edamam 份量單位在本機換算，無法換算時才詢問 Nutrition Analysis
+            quantity = self._number(body.get("quantity") or self.get_argument("quantity", None), "quantity")
+            include_raw = str(body.get("raw") or self.get_argument("raw", "0")).lower() in ("1", "true")
+            edamam_result = await measure_conversion.get_nutrition_for_amount_async(food_name, quantity, unit,
+                                                                                    include_raw=include_raw)
+            if edamam_result is None:
+                self.write_json({"status": "error", "error_message": f"Edamam could not analyze {quantity} {unit} {food_name}."}, 502)
+                return
+            self.write_json({"status": "success", "source": edamam_result.pop("source"), "food_name": food_name,
+                             "quantity": quantity, "unit": unit, "nutrient_units": edamam_module.NUTRIENT_UNITS,
+                             "data": edamam_result})
+            return
+
+        grams = self._number(body.get("grams") or self.get_argument("grams", None) or
+                             body.get("quantity") or self.get_argument("quantity", None), "grams")
+        result = await self.run_blocking(analysis_pipeline.fetch_nutrition, food_name, grams)
+        status_code = 200 if result["status"] in ("success", "no_data") else 502
+        self.write_json({"food_name": food_name, "grams": grams, **result}, status_code)
+
+    @staticmethod
+    def _number(value, field_name):
+        try:
+            number = float(value)
+        except (TypeError, ValueError):
+            raise tornado.web.HTTPError(400, f"{field_name} must be a positive number.")
+        if number <= 0:
+            raise tornado.web.HTTPError(400, f"{field_name} must be a positive number.")
+        return number
+
+
+class MetricsHandler(JsonHandler):
+    def get(self):
+        self.write_json({
+            "metrics": metrics.snapshot(),
+            "llm_latency": llm_module.get_llm_latency_stats(),
+            "llm_usage_by_day": llm_usage.get_daily_usage(),
+            "nutrition_providers": nutrition_providers.get_default_chain().stats(),
+            "executor": self.executor.stats(),
+        })
+
+
+class HealthHandler(JsonHandler):
+    def get(self):
+        self.write_json({
+            "status": "ok",
+            "vision_credentials": bool(vision_api._google_credentials_set),
+            "vertex_ai": bool(llm_module._vertex_ai_initialized),
+        })
+
+
+def make_app(executor=None):
+    executor = executor or BoundedExecutor(SERVICE_WORKERS, MAX_PENDING_REQUESTS)
+    handler_kwargs = {"executor": executor}
+    return tornado.web.Application([
+        (r"/analyze-image", AnalyzeImageHandler, handler_kwargs),
+        (r"/nutrition", NutritionHandler, handler_kwargs),
+        (r"/metrics", MetricsHandler, handler_kwargs),
+        (r"/healthz", HealthHandler, handler_kwargs),
+    ])
+
+
+async def main(port):
+    # 憑證與模型只初始化一次，所有請求共用 (與 App 相同，讀取 .streamlit/secrets.toml)
+    vision_api.setup_google_credentials()
+    if not llm_module.initialize_vertex_ai():
+        print("警告 (analysis_service.py): Vertex AI 初始化失敗，LLM 相關功能將無法使用。")
+
+    app = make_app()
+    app.listen(port, max_body_size=MAX_IMAGE_BYTES + 1024 * 1024)
+    print(f"Foodie 分析服務已啟動：http://0.0.0.0:{port} (工作執行緒 {SERVICE_WORKERS} 個)")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await edamam_module.close_async_client()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Foodie 無介面 HTTP 分析服務")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    asyncio.run(main(parser.parse_args().port))
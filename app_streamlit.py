@@ -2,13 +2,20 @@
 
 import streamlit as st
 import io
-import uuid # 用於為每個食物項目產生唯一ID
 
 # 匯入我們自己建立的模組
 try:
     from vision_module import vision_api # 或者您實際的 vision 模組路徑，例如 from Ճ<y_bin_46>python_code import vision_api
     import llm_module      # LLM 模組
-    # Edamam 模組暫時不在此「全LLM」流程中使用，如果您想比較或備用，可以保留 import edamam_module
+    import llm_usage       # LLM token 用量與估算費用
+    import metrics         # 程式內指標 (每張圖片的平均 token 用量)
+    import image_store     # 圖片儲存 (記憶體只留縮圖，原圖存磁碟)
+    import analysis_pipeline # 圖片分析流程 (Vision -> LLM)，支援多張圖片同時分析
+    import portion_table   # 典型份量查表 (由 LLM 建議與使用者調整的克數累積而成)
+    import meal_log        # 持久化飲食日誌 (SQLite)
+    import nutrition_providers # 營養來源鏈 (本地 -> Edamam 快取 -> Edamam API -> LLM)
+    import job_queue       # 背景工作佇列 (分析在工作執行緒中執行，UI 只輪詢進度)
+    from food_item import StageStatus # 食物項目各階段的狀態
 except ImportError as e:
     st.error(f"錯誤：無法匯入必要的程式模組: {e}。"
              "請確認 'vision_module/vision_api.py' 和 'llm_module.py' 檔案都存在且路徑正確。")
@@ -32,26 +39,37 @@ else:
     st.error("嚴重錯誤：'initialize_vertex_ai' (LLM) 函式未定義。")
     st.stop() 
 
+JOB_POLL_SECONDS = 1.0 # 背景分析工作進度的輪詢間隔 (秒)
+PENDING_STAGE_LABELS = {"name_refinement": "名稱精煉", "portion_suggestion": "份量建議", "nutrition_fetch": "營養查詢"}
+
 # --- Session State 初始化 ---
 default_session_state = {
-    "uploaded_image_bytes": None,
-    "current_file_name": None,
+    "uploaded_image_keys": [], # 已上傳圖片的內容雜湊列表 (依上傳順序)，用來向 image_store 取回縮圖/原圖
     "vision_object_results": None,
-    "food_items_analysis": [], # 儲存最終分析出的食物項目列表
-    "image_processed_flag": False 
+    "image_analysis_results": {}, # image_key -> 該圖片的分析狀態、提示訊息與除錯資訊
+    "food_items_analysis": [], # 儲存最終分析出的 FoodItem 列表 (所有圖片，每個項目以 image_key 標示來源)
+    "image_processed_flag": False,
+    "analysis_job_id": None, # 進行中 (或最近一次) 的背景分析工作 id，同時寫在網址的 ?job= 參數，重新連線時用來取回結果
+    "applied_job_id": None,  # 已套用到畫面上的工作 id (避免重複套用)
 }
 for key, value in default_session_state.items():
     if key not in st.session_state:
         st.session_state[key] = value
+# 每個 session 一個圖片儲存物件 (不放進 default_session_state，避免重置時遺失對磁碟快取的引用)
+if "image_store" not in st.session_state:
+    st.session_state.image_store = image_store.SessionImageStore()
+# 上傳元件的 key 編號：圖片存入 image_store 後換一個 key，舊元件 (與其中保留的上傳檔案位元組) 隨之從 session 釋放
+if "file_uploader_generation" not in st.session_state:
+    st.session_state.file_uploader_generation = 0
 
 # --- 側邊欄說明與狀態 ---
 st.sidebar.header("使用說明")
 st.sidebar.info(
     """
-    1.  **上傳圖片**。
-    2.  **AI 分析**：點擊按鈕。
-    3.  **檢視與調整**：查看辨識出的食物列表，您可以調整克數並重新計算營養。
-    4.  **查看總計**：底部顯示總營養。
+    1.  **上傳圖片**：可一次上傳多張 (例如一整天的餐點)。
+    2.  **AI 分析**：點擊按鈕，所有圖片會同時分析。
+    3.  **檢視與調整**：查看每張圖片辨識出的食物列表，您可以調整克數並重新計算營養。
+    4.  **查看總計**：每張圖片有小計，底部顯示全部餐點的總營養。
     """
 )
 if hasattr(vision_api, '_google_credentials_set') and not vision_api._google_credentials_set:
@@ -59,220 +77,413 @@ if hasattr(vision_api, '_google_credentials_set') and not vision_api._google_cre
 if hasattr(llm_module, '_vertex_ai_initialized') and not llm_module._vertex_ai_initialized:
     st.sidebar.error("Vertex AI (LLM) 警告：LLM 功能可能無法使用。", icon="⚠️")
 
+meal_log_user_id = st.sidebar.text_input(
+    "飲食日誌使用者名稱", value=meal_log.DEFAULT_USER_ID, key="meal_log_user_id",
+    help="分析結果會以此名稱記錄到飲食日誌，下次使用相同名稱即可查看歷史紀錄。",
+).strip() or meal_log.DEFAULT_USER_ID
+
+with st.sidebar.expander("💾 圖片記憶體使用狀況", expanded=False):
+    memory_stats = image_store.get_memory_stats()
+    st.metric("連線中的 Session 數", memory_stats["session_count"])
+    st.metric("記憶體中的縮圖", f"{memory_stats['preview_count']} 張 / {memory_stats['preview_bytes'] / 1024:.0f} KB")
+    st.metric("已移至磁碟的原圖", f"{memory_stats['original_bytes_offloaded'] / 1024 / 1024:.1f} MB")
+    st.caption(f"磁碟快取：{memory_stats['disk']['file_count']} 個檔案，"
+               f"{memory_stats['disk']['total_bytes'] / 1024 / 1024:.1f} / {memory_stats['disk']['max_bytes'] / 1024 / 1024:.0f} MB，"
+               f"已淘汰 {memory_stats['disk']['evictions']} 張")
+
+with st.sidebar.expander("⏱️ LLM 延遲與對沖統計", expanded=False):
+    llm_latency_stats = llm_module.get_llm_latency_stats()
+    if llm_latency_stats:
+        st.dataframe(
+            [{"任務": task, "模型": llm_module.get_task_route(task)["model"], **task_stats}
+             for task, task_stats in llm_latency_stats.items()],
+            hide_index=True, use_container_width=True,
+        )
+    else:
+        st.caption("尚未有 LLM 呼叫紀錄。")
+
+with st.sidebar.expander("🪙 LLM Token 用量與費用", expanded=False):
+    daily_llm_usage = llm_usage.get_daily_usage()
+    if daily_llm_usage:
+        today, today_usage = next(iter(daily_llm_usage.items()))
+        st.caption(f"{today}：{today_usage['total']['calls']} 次呼叫，"
+                   f"輸入 {today_usage['total']['prompt_tokens']:,} / 輸出 {today_usage['total']['output_tokens']:,} tokens，"
+                   f"約 US${today_usage['total']['cost_usd']:.4f}")
+        st.dataframe(
+            [{"任務": task, **task_usage} for task, task_usage in today_usage["by_task"].items()],
+            hide_index=True, use_container_width=True,
+        )
+        image_count = metrics.get("llm_tokens.images")
+        if image_count:
+            st.caption(f"每張圖片平均：輸入 {metrics.get('llm_tokens.per_image.prompt') / image_count:,.0f} / "
+                       f"輸出 {metrics.get('llm_tokens.per_image.output') / image_count:,.0f} tokens，"
+                       f"約 US${metrics.get('llm_cost_usd.per_image') / image_count:.4f}")
+        if len(daily_llm_usage) > 1:
+            st.dataframe(
+                [{"日期": day, **day_usage["total"]} for day, day_usage in daily_llm_usage.items()],
+                hide_index=True, use_container_width=True,
+            )
+    else:
+        st.caption("尚未有 LLM 呼叫紀錄。")
+    st.caption(f"本地標籤過濾 (非食物 / 食物類別) 已省下 {metrics.get('label_filter.llm_calls_saved'):.0f} 次 LLM 名稱精煉。")
+    st.caption("費用依 llm_usage.MODEL_PRICES_PER_MILLION_TOKENS 估算，僅供參考。")
+
+with st.sidebar.expander("🥗 營養來源狀態", expanded=False):
+    st.dataframe(
+        [{"來源": name, **provider_stats} for name, provider_stats in nutrition_providers.get_default_chain().stats().items()],
+        hide_index=True, use_container_width=True,
+    )
+    st.caption("依序詢問本地食物表、Edamam 快取、Edamam API、LLM；連續失敗的來源會暫時跳過 (state 為 open)。")
+
+
+def show_messages(messages):
+    """顯示分析流程收集到的提示訊息 (level, text)。"""
+    for level, text in messages:
+        if level == "caption": st.caption(text)
+        elif level == "warning": st.warning(text)
+        elif level == "error": st.error(text)
+        else: st.info(text)
+
+
+def show_nutrition_totals(food_items, title, compact=False):
+    """顯示一組食物項目的營養加總；沒有任何已計算項目時不顯示。"""
+    total_nutrition_summary, valid_items_for_sum = analysis_pipeline.sum_nutrition(food_items)
+    if valid_items_for_sum == 0:
+        return
+    if compact:
+        st.caption(f"**{title}**：熱量 {total_nutrition_summary['calories_kcal']:.0f} kcal ・ "
+                   f"蛋白質 {total_nutrition_summary['protein_g']:.1f} g ・ "
+                   f"脂肪 {total_nutrition_summary['fat_g']:.1f} g ・ "
+                   f"碳水 {total_nutrition_summary['carbohydrates_g']:.1f} g ・ "
+                   f"纖維 {total_nutrition_summary['fiber_g']:.1f} g")
+        return
+    st.markdown("---")
+    st.subheader(title)
+    sum_col1, sum_col2, sum_col3 = st.columns(3)
+    sum_col1.metric("總熱量", f"{total_nutrition_summary['calories_kcal']:.0f} kcal")
+    sum_col2.metric("總蛋白質", f"{total_nutrition_summary['protein_g']:.1f} g")
+    sum_col3.metric("總脂肪", f"{total_nutrition_summary['fat_g']:.1f} g")
+    
+    sum_col4, sum_col5, _ = st.columns(3)
+    sum_col4.metric("總碳水化合物", f"{total_nutrition_summary['carbohydrates_g']:.1f} g")
+    sum_col5.metric("總膳食纖維", f"{total_nutrition_summary['fiber_g']:.1f} g")
+
+
+def show_pending_food_item(index, display_number, items_to_remove_indices):
+    """顯示因整體截止時間而尚未完成的項目，提供「完成分析」按鈕以補完剩下的階段。"""
+    item = st.session_state.food_items_analysis[index]
+    stage_labels = [PENDING_STAGE_LABELS[stage] for stage in item.pending_stages()]
+    with st.expander(f"食物項目 {display_number}: **{item.llm_refined_name}** ⏳ 尚未完成 (原始偵測: *{item.vision_object_name}*)", expanded=True):
+        st.caption(f"分析時間到時此項目尚未完成：{'、'.join(stage_labels)}。")
+        col_complete_button, col_remove_button = st.columns(2)
+        with col_complete_button:
+            if st.button("⏳ 完成分析", key=f"complete_button_{item.id}"):
+                with st.spinner(f"正在完成 '{item.llm_refined_name}' 的分析..."):
+                    completed_item, messages = analysis_pipeline.complete_pending_item(item)
+                show_messages(messages)
+                if completed_item is None:
+                    items_to_remove_indices.append(index)
+                else:
+                    st.rerun()
+        with col_remove_button:
+            if st.button(f"❌ 移除", key=f"remove_button_{item.id}", type="secondary"):
+                items_to_remove_indices.append(index)
+
+
+def show_food_item(index, display_number, items_to_remove_indices):
+    """顯示單一食物項目，並允許使用者修改份量、重新計算營養或移除。"""
+    item = st.session_state.food_items_analysis[index] # 獲取當前項目的可變引用
+
+    if analysis_pipeline.is_item_pending(item):
+        show_pending_food_item(index, display_number, items_to_remove_indices)
+        return
+
+    # 使用 expander 來包裹每個食物項目，使介面更整潔
+    with st.expander(f"食物項目 {display_number}: **{item.llm_refined_name}** (原始偵測: *{item.vision_object_name}*)", expanded=True):
+        
+        col_gram_input, col_recalc_button, col_remove_button = st.columns([2,1,1])
+
+        with col_gram_input:
+            # 份量調整
+            new_user_grams = st.number_input(
+                f"份量 (克)", 
+                min_value=1, 
+                value=item.user_grams, 
+                step=10, # 調整步伐
+                key=f"grams_input_{item.id}" 
+            )
+        
+        item_needs_recalculation = False
+        if new_user_grams != item.user_grams:
+            item.user_grams = new_user_grams # 直接更新 session state 中的值
+            item.clear_nutrition() # 克數變了，舊的營養數據失效
+            item_needs_recalculation = True # 標記需要重新計算按鈕出現
+        
+        # 如果沒有營養數據，也標記為需要計算 (通常是首次，或上一步LLM查詢營養失敗)
+        if item.nutrients is None and item.status_nutrition_fetch is not StageStatus.NO_DATA:
+             item_needs_recalculation = True
+
+        with col_recalc_button:
+            # 為了讓按鈕在同一行，可以使用 st.empty() 或 CSS，但簡單起見先這樣
+            st.write("") # 佔位，讓按鈕稍微下來一點
+            if st.button(f"🔄 計算營養", key=f"recalc_button_{item.id}", help=f"使用 {item.user_grams}克 重新計算 '{item.llm_refined_name}' 的營養"):
+                if item.user_grams != item.llm_suggested_grams:
+                    # 使用者確認了自己調整的克數，作為份量表的一筆樣本
+                    portion_table.get_portion_table().record(item.llm_refined_name, item.user_grams, source="user")
+                with st.spinner(f"正在為 '{item.llm_refined_name}' ({item.user_grams}克) 重新查詢營養..."):
+                    nutrition_result = analysis_pipeline.fetch_nutrition(item.llm_refined_name, item.user_grams)
+                    if nutrition_result and nutrition_result["status"] == "success":
+                        # 直接修改 session_state 中的項目
+                        item.set_nutrition(StageStatus.SUCCESS, nutrition_result["data"], nutrition_result.get("source"))
+                    elif nutrition_result and nutrition_result["status"] == "no_data":
+                        item.set_nutrition(StageStatus.NO_DATA)
+                        st.warning(f"AI 未能提供 '{item.llm_refined_name}' ({item.user_grams}克) 的詳細營養數據。")
+                    else: 
+                        item.set_nutrition(StageStatus.ERROR)
+                        st.error(f"為 '{item.llm_refined_name}' ({item.user_grams}克) 查詢營養時發生錯誤。")
+                st.rerun() 
+
+        with col_remove_button:
+            st.write("") # 佔位
+            if st.button(f"❌ 移除", key=f"remove_button_{item.id}", type="secondary"):
+                items_to_remove_indices.append(index)
+        
+        # 顯示該項目的營養成分
+        if item.nutrients is not None:
+            nut_data = item.nutrition_data
+            st.write(f"**估計營養 ({item.user_grams} 克):**")
+            if item.nutrition_source == "local":
+                st.caption("（營養數據來自本地食物資料庫）")
+            elif item.nutrition_source in ("edamam", "edamam_cache"):
+                st.caption("（營養數據來自 Edamam 食物資料庫）")
+            col_nut_disp_1, col_nut_disp_2 = st.columns(2)
+            with col_nut_disp_1:
+                st.metric("熱量", f"{nut_data.get('calories_kcal', 0):.0f} kcal", delta_color="off")
+                st.metric("蛋白質", f"{nut_data.get('protein_g', 0):.1f} g", delta_color="off")
+                st.metric("膳食纖維", f"{nut_data.get('fiber_g', 0):.1f} g", delta_color="off")
+            with col_nut_disp_2:
+                st.metric("總脂肪", f"{nut_data.get('fat_g', 0):.1f} g", delta_color="off")
+                st.metric("總碳水化合物", f"{nut_data.get('carbohydrates_g', 0):.1f} g", delta_color="off")
+        elif item.status_nutrition_fetch is StageStatus.NO_DATA:
+             st.caption(f"（AI 未能提供此項目 ({item.user_grams}克) 的詳細營養數據）")
+        elif item_needs_recalculation: # 如果需要重新計算但按鈕還沒按
+             st.caption(f"（請點擊「🔄 計算營養」以獲取 {item.user_grams}克的數據）")
+        elif item.status_nutrition_fetch is StageStatus.ERROR:
+             st.caption(f"（查詢此項目 ({item.user_grams}克) 的營養時發生錯誤）")
+
+
+def restore_job_images(job_images):
+    """重新連線時，從磁碟快取取回背景工作分析過的圖片 (session 中的縮圖已隨舊 session 消失)。"""
+    disk_store = image_store.get_disk_store()
+    st.session_state.image_store.clear()
+    restored_keys = []
+    for image_key, image_name in job_images:
+        image_bytes = disk_store.get(image_key)
+        if image_bytes is not None:
+            restored_keys.append(st.session_state.image_store.add(image_name, image_bytes))
+    st.session_state.uploaded_image_keys = restored_keys
+
+
+def apply_finished_analysis_job(job):
+    """把已完成的背景分析工作結果套用到 session state。"""
+    st.session_state.applied_job_id = job.id
+    st.session_state.analysis_job_id = job.id
+    job_state = job.snapshot()
+    if job_state["status"] == job_queue.JOB_FAILED:
+        st.error(f"AI 分析工作失敗：{job_state['error']}")
+        return
+
+    job_images = job.metadata["images"]
+    if st.session_state.uploaded_image_keys != [image_key for image_key, _ in job_images]:
+        restore_job_images(job_images)
+    image_keys = st.session_state.uploaded_image_keys
+
+    temp_food_items = []
+    st.session_state.image_analysis_results = {}
+    for image_key in image_keys:
+        image_result = job.result.get(image_key)
+        if not image_result:
+            continue
+        # 工作結果可能被多個 session 取回 (例如重新連線)，各自修改份量時不可互相影響
+        temp_food_items.extend(item.copy() for item in image_result["items"])
+        st.session_state.image_analysis_results[image_key] = {
+            "status": image_result["status"],
+            "messages": image_result["messages"],
+            "debug": image_result["debug"],
+        }
+
+    st.session_state.food_items_analysis = temp_food_items
+    st.session_state.image_processed_flag = True 
+    pending_item_count = sum(1 for item in temp_food_items if analysis_pipeline.is_item_pending(item))
+    if not st.session_state.food_items_analysis:
+        st.warning("AI 分析完成，但未能從圖片中辨識出可供分析的具體食物項目。") 
+    elif pending_item_count:
+        st.warning(f"AI 分析超過時間上限，先顯示已完成的項目；另有 {pending_item_count} 個項目尚未完成，可稍後補完。")
+    else:
+        st.success(f"AI 分析完成！共從 {len(image_keys)} 張圖片辨識出 {len(st.session_state.food_items_analysis)} 個食物項目。請在下方調整份量並查看總營養。")
+
+
+@st.fragment(run_every=JOB_POLL_SECONDS)
+def show_analysis_job_progress(job_id):
+    """定時重新執行 (只重跑這個區塊) 以顯示背景分析工作的進度；完成時觸發整頁重跑以顯示結果。"""
+    job = job_queue.get_job_queue().get(job_id)
+    if job is None or job.is_finished():
+        st.rerun()
+    job_state = job.snapshot()
+    if job_state["status"] == job_queue.JOB_QUEUED:
+        st.info("⏳ 分析工作排隊中，馬上開始...")
+        return
+    total = job_state["progress_total"] or 1
+    st.progress(job_state["progress_done"] / total,
+                text=f"🤖 AI 正在分析圖片... 已完成 {job_state['progress_done']} / {total} 張 (離開頁面不會中斷分析，回來即可看到結果)")
+
+
+def clear_analysis_job():
+    st.session_state.analysis_job_id = None
+    st.session_state.applied_job_id = None
+    st.query_params.pop("job", None)
+
+
+# --- 背景分析工作：進行中則顯示進度；已完成且尚未套用 (例如重新連線) 則套用結果 ---
+active_job_id = st.session_state.analysis_job_id or st.query_params.get("job")
+analysis_job_running = False
+if active_job_id and active_job_id != st.session_state.applied_job_id:
+    active_job = job_queue.get_job_queue().get(active_job_id)
+    if active_job is None:
+        st.warning("找不到先前的分析工作 (結果可能已過期)，請重新上傳圖片並分析。")
+        clear_analysis_job()
+    elif active_job.is_finished():
+        apply_finished_analysis_job(active_job)
+    else:
+        st.session_state.analysis_job_id = active_job_id
+        analysis_job_running = True
+        show_analysis_job_progress(active_job_id)
+
 
 # --- 主應用程式介面 ---
-uploaded_file = st.file_uploader(
-    "1. 請上傳食物圖片進行分析:", 
+uploaded_files = st.file_uploader(
+    "1. 請上傳食物圖片進行分析 (可一次選擇多張):", 
     type=["jpg", "jpeg", "png"], 
-    help="支援 JPG, JPEG, PNG 格式的圖片檔案。",
-    key="file_uploader_main" # 確保有唯一的 key
+    accept_multiple_files=True,
+    help="支援 JPG, JPEG, PNG 格式的圖片檔案，可一次上傳一整天的餐點照片。上傳後的圖片會顯示在下方，上傳欄位隨即清空。",
+    key=f"file_uploader_main_{st.session_state.file_uploader_generation}" # 每批圖片存好後換一個 key (見上方說明)
 )
 
-if uploaded_file is not None:
-    if st.session_state.current_file_name != uploaded_file.name:
-        st.session_state.uploaded_image_bytes = uploaded_file.getvalue()
-        st.session_state.current_file_name = uploaded_file.name
-        st.session_state.food_items_analysis = [] 
-        st.session_state.image_processed_flag = False 
-        st.rerun() 
+if uploaded_files:
+    # 原圖寫入磁碟，session 中只保留縮圖與 key；之後換掉上傳元件，否則 Streamlit 會在 session 中一直保留整批原圖
+    st.session_state.image_store.clear()
+    uploaded_image_keys = []
+    for f in uploaded_files:
+        image_key = st.session_state.image_store.add(f.name, f.getvalue())
+        if image_key not in uploaded_image_keys: # 內容完全相同的圖片只分析一次
+            uploaded_image_keys.append(image_key)
+    st.session_state.uploaded_image_keys = uploaded_image_keys
+    st.session_state.image_analysis_results = {}
+    st.session_state.food_items_analysis = [] 
+    st.session_state.image_processed_flag = False 
+    clear_analysis_job() # 換了一批圖片：舊的工作 (若仍在執行) 結果不再套用
+    st.session_state.file_uploader_generation += 1
+    st.rerun() 
 
-    image_bytes_to_show = st.session_state.get("uploaded_image_bytes")
+if st.session_state.uploaded_image_keys:
+    session_image_store = st.session_state.image_store
+    image_keys = st.session_state.uploaded_image_keys
     
     col_main, col_sidebar_placeholder = st.columns([0.65, 0.35])
 
     with col_main:
-        if image_bytes_to_show:
-            st.image(image_bytes_to_show, caption="您上傳的圖片", use_container_width=True)
-
-        if st.button("🤖 **開始 AI 智能分析圖片中的所有食物**", key="analyze_all_foods_button", type="primary", use_container_width=True):
+        if not st.session_state.image_processed_flag:
+            preview_columns = st.columns(min(len(image_keys), 4) or 1)
+            for i, image_key in enumerate(image_keys):
+                with preview_columns[i % len(preview_columns)]:
+                    st.image(session_image_store.get_preview(image_key), caption=session_image_store.get_file_name(image_key), use_container_width=True)
+
+        if st.button("🗑️ 清除已上傳的圖片", key="clear_uploaded_images_button", disabled=analysis_job_running):
+            # 重置相關 session state (上傳元件已經是空的)
+            for key_to_reset in default_session_state.keys():
+                if key_to_reset in st.session_state:
+                    st.session_state[key_to_reset] = default_session_state[key_to_reset]
+            st.session_state.image_store.clear() # 釋放縮圖 (磁碟上的原圖由 LRU 自行淘汰)
+            st.query_params.pop("job", None)
+            st.rerun()
+
+        analysis_mode = st.radio(
+            "2. 選擇分析模式:",
+            options=list(analysis_pipeline.ANALYSIS_MODES.keys()),
+            format_func=lambda mode: analysis_pipeline.ANALYSIS_MODES[mode],
+            horizontal=True,
+            key="analysis_mode",
+        )
+
+        if st.button(f"🤖 **開始 AI 智能分析 {len(image_keys)} 張圖片中的所有食物**", key="analyze_all_foods_button", type="primary",
+                     use_container_width=True, disabled=analysis_job_running):
+            st.session_state.image_analysis_results = {}
             st.session_state.food_items_analysis = [] 
             st.session_state.image_processed_flag = False
-            st.markdown("--- DEBUGGING OUTPUTS BELOW ---") # 標記除錯輸出的開始
 
             if not vision_api._google_credentials_set or not llm_module._vertex_ai_initialized:
                 st.error("錯誤：AI 服務未完全準備就緒 (GCP憑證或Vertex AI初始化問題)。請檢查側邊欄警告。")
-            elif image_bytes_to_show:
-                with st.spinner("AI 正在努力工作中... (Vision API 物件偵測...)"):
-                    vision_results = vision_api.analyze_image_objects(image_bytes_to_show)
-                
-                # --- 加入除錯訊息 ---
-                st.write("--- DEBUG: Vision API 原始結果 (vision_results) ---")
-                st.json(vision_results if vision_results is not None else "Vision API 未返回結果或結果為 None (例如憑證或API呼叫問題)")
-                # --- 除錯訊息結束 ---
-                
-                if vision_results: # 確保 vision_results 不是 None 也不是空列表
-                    temp_food_items = []
-                    processed_vision_names = set()
-                    unique_vision_objects = []
-                    for name, score in vision_results:
-                        if score > 0.45 and name.lower() not in processed_vision_names : # 稍微降低信賴度閾值以進行測試
-                            unique_vision_objects.append((name, score))
-                            processed_vision_names.add(name.lower())
-                    
-                    # --- 加入除錯訊息 ---
-                    st.write("--- DEBUG: 初步過濾和去重後的 Vision API 物件 (unique_vision_objects) ---")
-                    st.json(unique_vision_objects if unique_vision_objects else "沒有符合初步過濾條件的 Vision API 物件")
-                    # --- 除錯訊息結束 ---
-
-                    if not unique_vision_objects:
-                         st.info("Vision API 未偵測到足夠可用於後續分析的物件。")
-
-                    for i, (object_name, vision_score) in enumerate(unique_vision_objects):
-                        item_id = str(uuid.uuid4())
-                        
-                        st.write(f"--- DEBUG: 正在用 LLM 精煉 Vision 物件 {i+1}/{len(unique_vision_objects)}: '{object_name}' (Vision 信賴度: {vision_score:.2f}) ---")
-                        
-                        with st.spinner(f"LLM 正在處理物件 '{object_name}'..."):
-                            refined_name_result = llm_module.refine_food_name_with_llm(object_name)
-                        
-                        st.write(f"--- DEBUG: LLM 對 '{object_name}' 的精煉結果 (refined_name_result) ---")
-                        st.json(refined_name_result if refined_name_result else "LLM refine_food_name_with_llm 未返回結果或結果為 None")
-                        
-                        if refined_name_result and refined_name_result["status"] == "success":
-                            food_name = refined_name_result["refined_name"]
-                            original_vision_name = refined_name_result.get("original_name", object_name)
-                            
-                            st.write(f"--- DEBUG: LLM 精煉成功，食物名稱: '{food_name}'。準備獲取典型份量。 ---")
-                            
-                            with st.spinner(f"LLM 正在為 '{food_name}' 建議典型份量..."):
-                                typical_portion_result = llm_module.get_typical_portion_grams_with_llm(food_name)
-                            
-                            st.write(f"--- DEBUG: LLM 對 '{food_name}' 的典型份量建議結果 (typical_portion_result) ---")
-                            st.json(typical_portion_result if typical_portion_result else "LLM get_typical_portion_grams_with_llm 未返回結果或結果為 None")
-
-                            suggested_grams = 100 # 預設值
-                            if typical_portion_result and typical_portion_result["status"] == "success" and typical_portion_result["grams"] is not None:
-                                suggested_grams = typical_portion_result["grams"]
-                            elif typical_portion_result and typical_portion_result["status"] == "unknown_weight":
-                                st.caption(f"提示：AI 未能為 '{food_name}' 建議典型克數，預設為 {suggested_grams}克。")
-                            
-                            st.write(f"--- DEBUG: 食物 '{food_name}'，建議/預設克數: {suggested_grams}克。準備獲取營養數據。 ---")
-                            
-                            with st.spinner(f"LLM 正在查詢 '{food_name}' ({suggested_grams}克) 的營養數據..."):
-                                nutrition_data_result = llm_module.get_nutrition_from_llm(food_name, suggested_grams)
-                            
-                            st.write(f"--- DEBUG: LLM 對 '{food_name}' ({suggested_grams}克) 的營養數據查詢結果 (nutrition_data_result) ---")
-                            st.json(nutrition_data_result if nutrition_data_result else "LLM get_nutrition_from_llm 未返回結果或結果為 None")
-                            
-                            nutrition_info = None
-                            if nutrition_data_result and nutrition_data_result["status"] == "success":
-                                nutrition_info = nutrition_data_result["data"]
-                            elif nutrition_data_result and nutrition_data_result["status"] == "no_data":
-                                 st.caption(f"提示：AI 未能查詢到 '{food_name}' ({suggested_grams}克) 的詳細營養數據。")
-                            
-                            temp_food_items.append({
-                                "id": item_id,
-                                "vision_object_name": original_vision_name,
-                                "llm_refined_name": food_name,
-                                "llm_suggested_grams": suggested_grams,
-                                "user_grams": suggested_grams, 
-                                "llm_nutrition_data": nutrition_info, 
-                                "status_name_refinement": refined_name_result["status"],
-                                "status_portion_suggestion": typical_portion_result.get("status") if typical_portion_result else "error",
-                                "status_nutrition_fetch": nutrition_data_result.get("status") if nutrition_data_result else "error"
-                            })
-                        elif refined_name_result and refined_name_result["status"] == "category":
-                            st.info(f"AI 判斷 '{object_name}' 是一個食物類別 '{refined_name_result['refined_name']}'，而非具體品項，已略過。")
-                        elif refined_name_result and refined_name_result["status"] in ["not_food", "unknown_food"]:
-                             st.info(f"AI 判斷 '{object_name}' 為 '{refined_name_result['status']}' ({refined_name_result.get('refined_name', '')})，已略過。")
-                        # 其他 "error" 狀態會被自然略過
-
-                    st.session_state.food_items_analysis = temp_food_items
-                    st.session_state.image_processed_flag = True 
-                    if not st.session_state.food_items_analysis:
-                        st.warning("AI 分析完成，但未能從圖片中辨識出可供分析的具體食物項目。") 
-                    else:
-                        st.success(f"AI 分析完成！共辨識出 {len(st.session_state.food_items_analysis)} 個食物項目。請在下方調整份量並查看總營養。")
-                    st.markdown("--- END DEBUGGING OUTPUTS ---") # 標記除錯輸出的結束
-                    st.rerun() # 分析完成後，重跑一次以更新 UI 顯示食物列表
-
-                else: # vision_results 是 None 或空
-                    st.info("Vision API 未偵測到任何物件。請嘗試另一張圖片或檢查 API 設定。")
+            elif image_keys:
+                job_images = [(image_key, session_image_store.get_file_name(image_key)) for image_key in image_keys]
+                # 分析在背景工作執行緒中進行：Vision API 使用原圖 (直接從磁碟快取讀取，不依賴這個 session 仍然存在)
+                analysis_job_id = job_queue.get_job_queue().submit(
+                    "image_analysis",
+                    lambda job, job_images=job_images, mode=analysis_mode: analysis_pipeline.analyze_images_concurrently(
+                        job_images,
+                        load_image_bytes=image_store.get_disk_store().get,
+                        mode=mode,
+                        on_progress=job.report_progress,
+                    ),
+                    metadata={"images": job_images, "mode": analysis_mode},
+                )
+                st.session_state.analysis_job_id = analysis_job_id
+                st.session_state.applied_job_id = None
+                st.query_params["job"] = analysis_job_id
+                st.rerun() # 重跑後由上方的進度區塊輪詢工作狀態
             else: 
                 st.warning("請先上傳圖片。")
 
-        # --- 顯示已分析的食物項目列表，並允許使用者修改份量 ---
-        if st.session_state.image_processed_flag and st.session_state.food_items_analysis:
+        # --- 依圖片顯示已分析的食物項目列表，並允許使用者修改份量 ---
+        if st.session_state.image_processed_flag:
             st.markdown("---")
             st.subheader("📊 步驟 2: 檢視食物分析結果與調整份量")
             
-            # 使用 st.session_state.food_items_analysis 來迭代，以確保修改能正確反映
-            # 為了能修改列表中的項目（例如 user_grams, llm_nutrition_data），我們需要用索引來操作
-            
+            # 為了能修改列表中的項目（例如 user_grams、營養數據），我們需要用索引來操作
             items_to_remove_indices = [] 
 
-            for index in range(len(st.session_state.food_items_analysis)):
-                item = st.session_state.food_items_analysis[index] # 獲取當前項目的可變引用
-
-                # 使用 expander 來包裹每個食物項目，使介面更整潔
-                with st.expander(f"食物項目 {index + 1}: **{item['llm_refined_name']}** (原始偵測: *{item['vision_object_name']}*)", expanded=True):
-                    
-                    col_gram_input, col_recalc_button, col_remove_button = st.columns([2,1,1])
-
-                    with col_gram_input:
-                        # 份量調整
-                        new_user_grams = st.number_input(
-                            f"份量 (克)", 
-                            min_value=1, 
-                            value=item["user_grams"], 
-                            step=10, # 調整步伐
-                            key=f"grams_input_{item['id']}" 
-                        )
-                    
-                    item_needs_recalculation = False
-                    if new_user_grams != item["user_grams"]:
-                        item["user_grams"] = new_user_grams # 直接更新 session state 中的值
-                        item["llm_nutrition_data"] = None # 克數變了，舊的營養數據失效
-                        item_needs_recalculation = True # 標記需要重新計算按鈕出現
-                    
-                    # 如果沒有營養數據，也標記為需要計算 (通常是首次，或上一步LLM查詢營養失敗)
-                    if item["llm_nutrition_data"] is None and item["status_nutrition_fetch"] != "no_data":
-                         item_needs_recalculation = True
-
-                    with col_recalc_button:
-                        # 為了讓按鈕在同一行，可以使用 st.empty() 或 CSS，但簡單起見先這樣
-                        st.write("") # 佔位，讓按鈕稍微下來一點
-                        if st.button(f"🔄 計算營養", key=f"recalc_button_{item['id']}", help=f"使用 {item['user_grams']}克 重新計算 '{item['llm_refined_name']}' 的營養"):
-                            with st.spinner(f"正在為 '{item['llm_refined_name']}' ({item['user_grams']}克) 重新查詢營養..."):
-                                nutrition_result = llm_module.get_nutrition_from_llm(item["llm_refined_name"], item["user_grams"])
-                                if nutrition_result and nutrition_result["status"] == "success":
-                                    # 直接修改 session_state 中的項目
-                                    st.session_state.food_items_analysis[index]["llm_nutrition_data"] = nutrition_result["data"]
-                                    st.session_state.food_items_analysis[index]["status_nutrition_fetch"] = "success"
-                                elif nutrition_result and nutrition_result["status"] == "no_data":
-                                    st.session_state.food_items_analysis[index]["llm_nutrition_data"] = {}
-                                    st.session_state.food_items_analysis[index]["status_nutrition_fetch"] = "no_data"
-                                    st.warning(f"AI 未能提供 '{item['llm_refined_name']}' ({item['user_grams']}克) 的詳細營養數據。")
-                                else: 
-                                    st.session_state.food_items_analysis[index]["llm_nutrition_data"] = None
-                                    st.session_state.food_items_analysis[index]["status_nutrition_fetch"] = "error"
-                                    st.error(f"為 '{item['llm_refined_name']}' ({item['user_grams']}克) 查詢營養時發生錯誤。")
-                            st.rerun() 
-
-                    with col_remove_button:
-                        st.write("") # 佔位
-                        if st.button(f"❌ 移除", key=f"remove_button_{item['id']}", type="secondary"):
-                            items_to_remove_indices.append(index)
-                    
-                    # 顯示該項目的營養成分
-                    if item.get("llm_nutrition_data"): # 使用 .get() 避免因 key 不存在而報錯
-                        nut_data = item["llm_nutrition_data"]
-                        st.write(f"**估計營養 ({item['user_grams']} 克):**")
-                        col_nut_disp_1, col_nut_disp_2 = st.columns(2)
-                        with col_nut_disp_1:
-                            st.metric("熱量", f"{nut_data.get('calories_kcal', 0):.0f} kcal", delta_color="off")
-                            st.metric("蛋白質", f"{nut_data.get('protein_g', 0):.1f} g", delta_color="off")
-                            st.metric("膳食纖維", f"{nut_data.get('fiber_g', 0):.1f} g", delta_color="off")
-                        with col_nut_disp_2:
-                            st.metric("總脂肪", f"{nut_data.get('fat_g', 0):.1f} g", delta_color="off")
-                            st.metric("總碳水化合物", f"{nut_data.get('carbohydrates_g', 0):.1f} g", delta_color="off")
-                    elif item["status_nutrition_fetch"] == "no_data":
-                         st.caption(f"（AI 未能提供此項目 ({item['user_grams']}克) 的詳細營養數據）")
-                    elif item_needs_recalculation: # 如果需要重新計算但按鈕還沒按
-                         st.caption(f"（請點擊「🔄 計算營養」以獲取 {item['user_grams']}克的數據）")
-                    elif item["status_nutrition_fetch"] == "error":
-                         st.caption(f"（查詢此項目 ({item['user_grams']}克) 的營養時發生錯誤）")
-
+            pending_items = [item for item in st.session_state.food_items_analysis if analysis_pipeline.is_item_pending(item)]
+            if pending_items and st.button(f"⏳ 完成所有未完成的項目 ({len(pending_items)} 個)", key="complete_all_pending_button"):
+                with st.spinner(f"正在完成 {len(pending_items)} 個項目的分析..."):
+                    completion_results = analysis_pipeline.complete_pending_items(pending_items)
+                dropped_item_ids = {item.id for item, (completed_item, _) in zip(pending_items, completion_results) if completed_item is None}
+                st.session_state.food_items_analysis = [item for item in st.session_state.food_items_analysis if item.id not in dropped_item_ids]
+                st.rerun()
+
+            # 一次掃描就把項目依圖片分組 (不必每張圖片都掃描全部項目)
+            item_indices_by_image = {}
+            for index, item in enumerate(st.session_state.food_items_analysis):
+                item_indices_by_image.setdefault(item.image_key, []).append(index)
+
+            for image_number, image_key in enumerate(image_keys, start=1):
+                image_result = st.session_state.image_analysis_results.get(image_key, {})
+                item_indices = item_indices_by_image.get(image_key, [])
+
+                st.markdown(f"#### 🍽️ 圖片 {image_number}: {session_image_store.get_file_name(image_key)}")
+                col_image, col_items = st.columns([0.3, 0.7])
+                with col_image:
+                    st.image(session_image_store.get_preview(image_key), use_container_width=True)
+                with col_items:
+                    show_messages(image_result.get("messages", []))
+                    if image_result.get("debug"):
+                        with st.expander("🐞 除錯資訊 (DEBUG)", expanded=False):
+                            for debug_title, debug_payload in image_result["debug"]:
+                                st.write(f"--- DEBUG: {debug_title} ---")
+                                st.json(debug_payload)
+                    if not item_indices:
+                        st.caption("（此圖片沒有辨識出可供分析的食物項目）")
+                    for display_number, index in enumerate(item_indices, start=1):
+                        show_food_item(index, display_number, items_to_remove_indices)
+                    show_nutrition_totals([st.session_state.food_items_analysis[index] for index in item_indices], "此餐小計", compact=True)
 
             # 執行刪除 (在主迭代外部進行，避免修改正在迭代的列表)
             if items_to_remove_indices:
@@ -280,46 +491,42 @@ if uploaded_file is not None:
                     st.session_state.food_items_analysis.pop(index_to_remove)
                 st.rerun() 
 
-            # --- 顯示總營養攝取 ---
+            # --- 顯示全部圖片的總營養攝取 ---
             if st.session_state.food_items_analysis: # 只有當列表不為空時才計算和顯示總計
-                total_nutrition_summary = {
-                    "calories_kcal": 0.0, "protein_g": 0.0, "fat_g": 0.0, 
-                    "carbohydrates_g": 0.0, "fiber_g": 0.0
-                }
-                valid_items_for_sum = 0
-                for item in st.session_state.food_items_analysis:
-                    if item.get("llm_nutrition_data"): # 只累加有成功獲取到營養數據的項目
-                        nut_data = item["llm_nutrition_data"]
-                        total_nutrition_summary["calories_kcal"] += float(nut_data.get('calories_kcal', 0))
-                        total_nutrition_summary["protein_g"] += float(nut_data.get('protein_g', 0))
-                        total_nutrition_summary["fat_g"] += float(nut_data.get('fat_g', 0))
-                        total_nutrition_summary["carbohydrates_g"] += float(nut_data.get('carbohydrates_g', 0))
-                        total_nutrition_summary["fiber_g"] += float(nut_data.get('fiber_g', 0))
-                        valid_items_for_sum +=1
-                
-                if valid_items_for_sum > 0:
-                    st.markdown("---")
-                    st.subheader("📈 總計營養攝取 (所有已計算項目加總)")
-                    sum_col1, sum_col2, sum_col3 = st.columns(3)
-                    sum_col1.metric("總熱量", f"{total_nutrition_summary['calories_kcal']:.0f} kcal")
-                    sum_col2.metric("總蛋白質", f"{total_nutrition_summary['protein_g']:.1f} g")
-                    sum_col3.metric("總脂肪", f"{total_nutrition_summary['fat_g']:.1f} g")
-                    
-                    sum_col4, sum_col5, _ = st.columns(3)
-                    sum_col4.metric("總碳水化合物", f"{total_nutrition_summary['carbohydrates_g']:.1f} g")
-                    sum_col5.metric("總膳食纖維", f"{total_nutrition_summary['fiber_g']:.1f} g")
-
-
-elif uploaded_file is None and st.session_state.get("current_file_name") is not None:
-    # 使用者清除了上傳的檔案，重置相關 session state
-    for key_to_reset in default_session_state.keys():
-            if key_to_reset in st.session_state:
-                 st.session_state[key_to_reset] = default_session_state[key_to_reset]
-    st.rerun() 
+                show_nutrition_totals(st.session_state.food_items_analysis, "📈 今日總計營養攝取 (所有圖片已計算項目加總)")
+
+                # --- 寫入飲食日誌 (只記錄已有營養數據、且尚未記錄過的項目) ---
+                items_to_log = [item for item in st.session_state.food_items_analysis
+                                if item.nutrients is not None and item.meal_log_entry_id is None]
+                if items_to_log and st.button(f"📝 將 {len(items_to_log)} 個項目記錄到飲食日誌", key="log_meal_button"):
+                    entry_ids = meal_log.get_meal_log().add_entries(
+                        meal_log_user_id,
+                        [{"food_name": item.llm_refined_name, "grams": item.user_grams, "nutrition": item.nutrition_data}
+                         for item in items_to_log],
+                        source="app",
+                    )
+                    for item, entry_id in zip(items_to_log, entry_ids):
+                        item.meal_log_entry_id = entry_id
+                    st.success(f"已將 {len(entry_ids)} 個項目記錄到「{meal_log_user_id}」的飲食日誌。")
+
+
+else:
+    st.info("👈 請先上傳食物圖片以開始分析 (可一次上傳多張)。")
+
 
-elif uploaded_file is None:
-    st.info("👈 請先上傳一張食物圖片以開始分析。")
+# --- 飲食日誌歷史紀錄 (從 SQLite 彙總表讀取，不需重新計算) ---
+with st.expander(f"📅 飲食日誌歷史紀錄 ({meal_log_user_id})", expanded=False):
+    history_period = st.radio(
+        "統計區間", options=list(meal_log.PERIODS),
+        format_func=lambda period: {"day": "每日", "week": "每週", "month": "每月"}[period],
+        horizontal=True, key="meal_log_history_period",
+    )
+    history_rows = meal_log.get_meal_log().get_aggregates(meal_log_user_id, history_period, limit=60)
+    if history_rows:
+        st.dataframe(history_rows, hide_index=True, use_container_width=True)
+    else:
+        st.caption("尚無飲食紀錄。分析完成後點擊「📝 記錄到飲食日誌」即可開始累積。")
 
 
 st.markdown("---") 
-st.caption("此應用程式使用 Google Cloud Vision API 及 Vertex AI (Gemini LLM) 進行分析。營養數據由 AI 生成，僅供參考，不應用於醫療用途。")
\ No newline at end of file
+st.caption("此應用程式使用 Google Cloud Vision API 及 Vertex AI (Gemini LLM) 進行分析。營養數據由 AI 生成，僅供參考，不應用於醫療用途。")
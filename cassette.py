@@ -0,0 +1,315 @@
+# cassette.py
+# 外部 API 呼叫的錄製 / 重播 (cassette)。
+# - record：照常呼叫 Vision、Vertex AI、Natural Language、Edamam，並把每次呼叫的請求指紋、回應 (或錯誤) 與耗時
+#           附加寫入 cassette 檔 (gzip 壓縮的 JSON lines)。紀錄先暫存在記憶體，每 RECORD_FLUSH_ENTRIES 筆或
+#           每 RECORD_FLUSH_SECONDS 秒 (以及程式結束時) 才整批寫成一個 gzip member，壓縮率較好；程式異常中止時最多遺失最後一批。
+# - replay：不連網、不需要憑證，直接由 cassette 檔回應，並依原本 (或縮放後) 的耗時等待，
+#           讓效能測試與除錯可以在完全離線的情況下重現同樣的結果。等待時間不超過這次呼叫的 timeout / deadline：
+#           錄到的耗時超過時，等到 timeout 為止後重播一次逾時 (ReplayTimeoutError，或該函式逾時時本來的回傳值)。
+# - off (預設)：不做任何事。
+# 以環境變數設定：FOODIE_CASSETTE_MODE=record|replay、FOODIE_CASSETTE_PATH (預設為資料目錄下的 cassettes/default.jsonl.gz)、
+# FOODIE_CASSETTE_LATENCY_SCALE (重播時的耗時倍數，0 代表不等待)；也可以在程式中呼叫 configure()。
+#
+# 同一個請求錄到多次時 (例如同一張圖分析了兩次)，重播會依序回放每一次的回應，最後一筆之後重複最後一筆。
+# 重播時找不到的請求一律回傳 None (這些函式失敗時本來就回傳 None)，並計入 cassette.misses 指標。
+
+import asyncio
+import atexit
+import functools
+import gzip
+import hashlib
+import inspect
+import json
+import os
+import threading
+import time
+
+import data_paths
+import metrics
+
+MODE_OFF = "off"
+MODE_RECORD = "record"
+MODE_REPLAY = "replay"
+MODES = (MODE_OFF, MODE_RECORD, MODE_REPLAY)
+DEFAULT_CASSETTE_NAME = "default.jsonl.gz"
+DEFAULT_IGNORED_ARGUMENTS = ("deadline", "timeout") # 每次呼叫都不同、且不影響回應內容的參數，不納入請求指紋
+RECORD_FLUSH_ENTRIES = 200 # 錄製時累積幾筆紀錄就寫入檔案
+RECORD_FLUSH_SECONDS = 5.0 # 距離上次寫入超過幾秒就寫入檔案
+_RAISE_ON_TIMEOUT = object()
+
+
+class RecordedCallError(Exception):
+    """重播一筆錄製時拋出例外的呼叫。"""
+
+
+class ReplayTimeoutError(RecordedCallError, TimeoutError):
+    """錄製時的耗時超過這次呼叫的 timeout / deadline：重播為一次逾時。"""
+
+
+class Cassette:
+    """一個 cassette 檔：錄製時附加寫入，重播時整個載入記憶體。"""
+
+    def __init__(self, path, mode, latency_scale=1.0):
+        self.path = path
+        self.mode = mode
+        self.latency_scale = latency_scale
+        self._lock = threading.Lock()
+        self._recordings = {} # 請求指紋 -> [錄製紀錄, ...] (依錄製順序)
+        self._replay_positions = {} # 請求指紋 -> 下一次要回放的位置
+        self._pending_lines = [] # 錄製模式下尚未寫入檔案的紀錄
+        self._last_flush_at = time.monotonic()
+        if mode == MODE_REPLAY:
+            self._load()
+        elif mode == MODE_RECORD:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def _load(self):
+        try:
+            with gzip.open(self.path, "rt", encoding="utf-8") as cassette_file:
+                for line in cassette_file:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self._recordings.setdefault(entry["k"], []).append(entry)
+        except FileNotFoundError:
+            print(f"警告 (cassette.py): 找不到 cassette 檔 '{self.path}'，重播時所有呼叫都會落空。")
+        except (OSError, EOFError, json.JSONDecodeError) as e:
+            # 錄製中途中斷時最後一筆可能不完整；已讀到的紀錄仍可使用
+            print(f"警告 (cassette.py): 讀取 cassette 檔 '{self.path}' 時發生錯誤，只使用已讀取的紀錄: {e}")
+
+    def record(self, key, name, elapsed_seconds, result=None, error=None):
+        entry = {"k": key, "n": name, "t": round(elapsed_seconds, 4)}
+        if error is not None:
+            entry["e"] = error
+        else:
+            entry["r"] = result
+        line = json.dumps(entry, ensure_ascii=False, separators=(",", ":"), default=_json_default) + "\n"
+        with self._lock:
+            self._pending_lines.append(line)
+            if (len(self._pending_lines) >= RECORD_FLUSH_ENTRIES or
+                    time.monotonic() - self._last_flush_at >= RECORD_FLUSH_SECONDS):
+                self._flush_locked()
+        metrics.increment(f"cassette.recorded.{name}")
+
+    def flush(self):
+        """把暫存的紀錄寫入檔案 (程式結束或切換 cassette 時自動呼叫)。"""
+        with self._lock:
+            self._flush_locked()
+
+    def _flush_locked(self):
+        # 呼叫前必須已經持有 self._lock；每一批寫成一個 gzip member (讀取時 gzip 會自動串接多個 member)
+        self._last_flush_at = time.monotonic()
+        if not self._pending_lines:
+            return
+        lines, self._pending_lines = self._pending_lines, []
+        try:
+            with gzip.open(self.path, "at", encoding="utf-8") as cassette_file:
+                cassette_file.write("".join(lines))
+        except OSError as e:
+            print(f"錯誤 (cassette.py): 寫入 cassette 檔 '{self.path}' 失敗，遺失 {len(lines)} 筆紀錄: {e}")
+
+    def next_entry(self, key):
+        with self._lock:
+            entries = self._recordings.get(key)
+            if not entries:
+                return None
+            position = self._replay_positions.get(key, 0)
+            self._replay_positions[key] = position + 1
+            return entries[min(position, len(entries) - 1)]
+
+    def size(self):
+        with self._lock:
+            return sum(len(entries) for entries in self._recordings.values())
+
+
+def _json_default(value):
+    # 回應中常見的非 JSON 型別：tuple 由 json 自動轉為 list；bytes 與其他物件轉為字串
+    if isinstance(value, (bytes, bytearray)):
+        return {"sha256": hashlib.sha256(value).hexdigest()}
+    if hasattr(value, "to_dict"):
+        return value.to_dict()
+    return str(value)
+
+
+def _fingerprint_value(value):
+    """把呼叫參數轉成可穩定序列化的形式 (位元組以雜湊表示，例如圖片內容)。"""
+    if isinstance(value, (bytes, bytearray)):
+        return {"sha256": hashlib.sha256(value).hexdigest()}
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    if isinstance(value, (list, tuple)):
+        return [_fingerprint_value(item) for item in value]
+    if isinstance(value, dict):
+        return {str(key): _fingerprint_value(item) for key, item in sorted(value.items(), key=lambda pair: str(pair[0]))}
+    if hasattr(value, "to_dict"): # 例如 Vertex AI 的 Part (多模態的圖片內容)
+        try:
+            return _fingerprint_value(value.to_dict())
+        except Exception:
+            pass
+    return repr(value)
+
+
+def request_key(name, arguments):
+    payload = json.dumps([name, _fingerprint_value(arguments)], ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:32]
+
+
+_cassette = None
+_cassette_lock = threading.Lock()
+
+
+def configure(mode=None, path=None, latency_scale=None):
+    """
+    設定錄製 / 重播模式 (未指定的參數取自環境變數)。
+    Returns:
+        Cassette | None: 目前使用的 cassette (off 模式為 None)。
+    """
+    global _cassette
+    mode = (mode or os.getenv("FOODIE_CASSETTE_MODE") or MODE_OFF).lower()
+    if mode not in MODES:
+        print(f"警告 (cassette.py): 不支援的 cassette 模式 '{mode}'，改為 off。")
+        mode = MODE_OFF
+    with _cassette_lock:
+        if _cassette is not None and _cassette.mode == MODE_RECORD:
+            _cassette.flush() # 切換前先寫入先前錄製但尚未寫入的紀錄
+        if mode == MODE_OFF:
+            _cassette = None
+            return None
+        path = path or os.getenv("FOODIE_CASSETTE_PATH") or data_paths.get_data_path("cassettes", DEFAULT_CASSETTE_NAME)
+        if latency_scale is None:
+            latency_scale = float(os.getenv("FOODIE_CASSETTE_LATENCY_SCALE", "1.0"))
+        _cassette = Cassette(path, mode, latency_scale)
+        print(f"cassette.py: {mode} 模式，cassette 檔 '{path}'。")
+        return _cassette
+
+
+def get_cassette():
+    return _cassette
+
+
+def is_replaying():
+    """重播模式下不需要 (也不應該使用) 任何憑證與網路連線。"""
+    return _cassette is not None and _cassette.mode == MODE_REPLAY
+
+
+def _flush_on_exit():
+    cassette = _cassette
+    if cassette is not None and cassette.mode == MODE_RECORD:
+        cassette.flush()
+
+
+atexit.register(_flush_on_exit)
+
+
+def _call_time_limit(arguments):
+    """這次呼叫允許的秒數：timeout (秒) 與 deadline (deadline.Deadline) 中較短者；都沒有時為 None。"""
+    limits = []
+    timeout = arguments.get("timeout")
+    if isinstance(timeout, (int, float)):
+        limits.append(max(0.0, timeout))
+    deadline = arguments.get("deadline")
+    if deadline is not None and hasattr(deadline, "remaining"):
+        limits.append(deadline.remaining())
+    return min(limits) if limits else None
+
+
+def _replay_delay(cassette, entry, arguments):
+    """回傳 (重播前要等待的秒數, 是否逾時)。"""
+    if entry is None:
+        return 0.0, False
+    recorded_seconds = entry["t"] * cassette.latency_scale
+    time_limit = _call_time_limit(arguments)
+    if time_limit is not None and recorded_seconds > time_limit:
+        return time_limit, True
+    return recorded_seconds, False
+
+
+def _replay_timeout(name, timeout_result):
+    metrics.increment(f"cassette.replay_timeouts.{name}")
+    print(f"警告 (cassette.py): 重播的 {name} 呼叫超過這次呼叫的 timeout / deadline，以逾時處理。")
+    if timeout_result is _RAISE_ON_TIMEOUT:
+        raise ReplayTimeoutError(f"{name} 在 timeout / deadline 內未完成 (重播)")
+    return timeout_result
+
+
+def _replay_result(cassette, entry, name):
+    if entry is None:
+        metrics.increment(f"cassette.misses.{name}")
+        print(f"警告 (cassette.py): cassette 中沒有這次 {name} 呼叫的紀錄，回傳 None。")
+        return None
+    metrics.increment(f"cassette.replayed.{name}")
+    if "e" in entry:
+        raise RecordedCallError(entry["e"])
+    return entry.get("r")
+
+
+def recordable(name, ignore=DEFAULT_IGNORED_ARGUMENTS, timeout_result=_RAISE_ON_TIMEOUT):
+    """
+    裝飾外部 API 呼叫函式 (同步或 async)，使其支援錄製 / 重播。
+    Args:
+        name (str): 呼叫名稱 (用於指紋與指標，例如 "vision.analyze_image_objects")。
+        ignore (tuple): 不納入請求指紋的參數名稱。
+        timeout_result (可選): 重播逾時時的回傳值，應與函式本身逾時時的回傳值相同
+                               (例如逾時會回傳 None 的函式傳入 None)；未指定時拋出 ReplayTimeoutError。
+    """
+    def decorator(fn):
+        signature = inspect.signature(fn)
+
+        def _key(args, kwargs):
+            """回傳 (請求指紋, 所有參數)。"""
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            key = request_key(name, {key: value for key, value in bound.arguments.items() if key not in ignore})
+            return key, bound.arguments
+
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                cassette = _cassette
+                if cassette is None:
+                    return await fn(*args, **kwargs)
+                key, arguments = _key(args, kwargs)
+                if cassette.mode == MODE_REPLAY:
+                    entry = cassette.next_entry(key)
+                    delay, timed_out = _replay_delay(cassette, entry, arguments)
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                    if timed_out:
+                        return _replay_timeout(name, timeout_result)
+                    return _replay_result(cassette, entry, name)
+                started_at = time.perf_counter()
+                try:
+                    result = await fn(*args, **kwargs)
+                except Exception as e:
+                    cassette.record(key, name, time.perf_counter() - started_at, error=f"{type(e).__name__}: {e}")
+                    raise
+                cassette.record(key, name, time.perf_counter() - started_at, result=result)
+                return result
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            cassette = _cassette
+            if cassette is None:
+                return fn(*args, **kwargs)
+            key, arguments = _key(args, kwargs)
+            if cassette.mode == MODE_REPLAY:
+                entry = cassette.next_entry(key)
+                delay, timed_out = _replay_delay(cassette, entry, arguments)
+                if delay > 0:
+                    time.sleep(delay)
+                if timed_out:
+                    return _replay_timeout(name, timeout_result)
+                return _replay_result(cassette, entry, name)
+            started_at = time.perf_counter()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                cassette.record(key, name, time.perf_counter() - started_at, error=f"{type(e).__name__}: {e}")
+                raise
+            cassette.record(key, name, time.perf_counter() - started_at, result=result)
+            return result
+        return wrapper
+    return decorator
+
+
+configure()
@@ -0,0 +1,23 @@
+# data_paths.py
+
+import os
+
+# 所有本機快取/資料檔案的根目錄 (圖片暫存、查表、日誌資料庫等)
+# 可以用環境變數 FOODIE_DATA_DIR 覆寫，例如部署在雲端時指向可寫入的磁碟
+_DEFAULT_DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".foodie_data")
+
+
+def get_data_dir():
+    """回傳資料根目錄的路徑，如果目錄不存在會自動建立。"""
+    data_dir = os.getenv("FOODIE_DATA_DIR", _DEFAULT_DATA_DIR)
+    os.makedirs(data_dir, exist_ok=True)
+    return data_dir
+
+
+def get_data_path(*parts):
+    """
+    組合資料根目錄底下的路徑。
+    例如 get_data_path("images") 會回傳 <資料根目錄>/images。
+    注意：只會確保「根目錄」存在，子目錄或檔案由呼叫端自行建立。
+    """
+    return os.path.join(get_data_dir(), *parts)
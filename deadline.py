@@ -0,0 +1,34 @@
+# deadline.py
+# 整體分析的截止時間 (deadline)：一次「開始 AI 智能分析」的所有工作 (Vision、LLM、營養來源) 共用同一個 Deadline 物件，
+# 以參數明確傳遞給每一層。每個外部呼叫的等待時間都以剩餘時間為上限，截止後尚未開始的工作直接略過，
+# 因此整體回應時間有可預期的上限；未完成的項目標記為 pending，之後再由使用者觸發補完。
+
+import time
+
+
+class Deadline:
+    """從建立時起算 seconds 秒後截止。"""
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self):
+        """剩餘秒數 (已截止時為 0)。"""
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self):
+        return time.monotonic() >= self.expires_at
+
+    def cap(self, seconds):
+        """把某個呼叫自己的等待上限 seconds 再限制在剩餘時間之內。"""
+        return min(seconds, self.remaining())
+
+
+def cap_seconds(deadline, seconds):
+    """deadline 可以是 None (沒有整體截止時間)，此時原樣回傳 seconds。"""
+    return seconds if deadline is None else deadline.cap(seconds)
+
+
+def is_expired(deadline):
+    return deadline is not None and deadline.expired()
@@ -3,6 +3,37 @@
 import streamlit as st
 import requests
 import json
+import asyncio
+import sys
+import threading
+import weakref
+
+import cassette # 外部 API 呼叫的錄製 / 重播
+
+try:
+    import httpx # 非同步 HTTP/2 用戶端 (可在同一個 event loop 中同時查詢多種食物)
+except ImportError:
+    print("警告 (edamam_module.py): Python 套件 'httpx' 尚未安裝，非同步查詢功能停用。"
+          "請在終端機中執行 'pip3 install \"httpx[http2]\"' 指令來安裝。")
+    httpx = None
+
+try:
+    from cachetools import TTLCache
+except ImportError:
+    print("警告 (edamam_module.py): Python 套件 'cachetools' 尚未安裝，食物資料 (份量單位) 快取功能停用。"
+          "請在終端機中執行 'pip3 install cachetools' 指令來安裝。")
+    TTLCache = None
+
+FOOD_DATABASE_PARSER_URL = "https://api.edamam.com/api/food-database/v2/parser"
+NUTRITION_DETAILS_URL = "https://api.edamam.com/api/nutrition-details"
+REQUEST_TIMEOUT_SECONDS = 15
+# 非同步用戶端的連線上限：HTTP/2 下多個請求會共用同一條連線多工傳輸，
+# 這裡限制的是同時開啟的連線數 (以及閒置保留的連線數)，避免瞬間大量查詢時開出過多連線。
+ASYNC_MAX_CONNECTIONS = 10
+ASYNC_MAX_KEEPALIVE_CONNECTIONS = 5
+ASYNC_MAX_CONCURRENT_REQUESTS = 20 # gather_* 函式同時進行中的請求數上限
+FOOD_DATA_CACHE_MAX_FOODS = 2048
+FOOD_DATA_CACHE_TTL_SECONDS = 24 * 60 * 60
 
 _edamam_credentials_loaded = False
 EDAMAM_APP_ID = None
@@ -17,6 +48,9 @@ def load_edamam_credentials(): # 這個函式應該不變
     # ... (函式內容不變) ...
     if _edamam_credentials_loaded:
         return True
+    if cassette.is_replaying(): # 由 cassette 檔重播，不需要憑證
+        _edamam_credentials_loaded = True
+        return True
 
     app_id_from_secrets = st.secrets.get("EDAMAM_APP_ID")
     app_key_from_secrets = st.secrets.get("EDAMAM_APP_KEY")
@@ -32,161 +66,260 @@ def load_edamam_credentials(): # 這個函式應該不變
         _edamam_credentials_loaded = False
         return False
 
-def get_food_data_with_measures(food_name_to_query): # <<< 確認函式名稱是這個！
-    """
-    (原 get_food_nutrition_data 函式，更名以明確其主要獲取的是食物資料和份量單位)
-    使用 Edamam Food Database API (/parser) 根據食物名稱查詢其基本資料、
-    預設營養資訊 (通常是每100g) 以及可用的份量單位 (measures)。
-    """
-    global _edamam_credentials_loaded, EDAMAM_APP_ID, EDAMAM_APP_KEY # 確保引用了正確的全局變數
-
+def _ensure_food_db_ready(food_name_to_query, caller_name):
+    # 同步與非同步版本共用的憑證與參數檢查
     if not _edamam_credentials_loaded: # 檢查憑證
         if not load_edamam_credentials(): # 如果未載入，嘗試載入
-            print("錯誤 (edamam_module.py): get_food_data_with_measures - Edamam 憑證載入失敗。")
-            return None # 載入失敗則返回 None
+            print(f"錯誤 (edamam_module.py): {caller_name} - Edamam 憑證載入失敗。")
+            return False # 載入失敗則返回 False
 
     # 再次檢查 food_name_to_query 和憑證是否有效
     if not food_name_to_query or not EDAMAM_APP_ID or not EDAMAM_APP_KEY:
-        print(f"錯誤 (edamam_module.py): get_food_data_with_measures - 缺少查詢參數 food_name ('{food_name_to_query}') 或 Edamam API 憑證。")
-        return None
+        print(f"錯誤 (edamam_module.py): {caller_name} - 缺少查詢參數 food_name ('{food_name_to_query}') 或 Edamam API 憑證。")
+        return False
+    return True
 
-    base_url = "https://api.edamam.com/api/food-database/v2/parser"
-    params = {
+def _build_parser_params(food_name_to_query):
+    return {
         "ingr": food_name_to_query,
         "app_id": EDAMAM_APP_ID,
         "app_key": EDAMAM_APP_KEY,
         "nutrition-type": "logging"
     }
 
-    try:
-        response = requests.get(base_url, params=params, timeout=15)
-        response.raise_for_status()
-        data = response.json()
-
-        food_item_data = None
-        if data.get("parsed") and len(data["parsed"]) > 0 and data["parsed"][0].get("food"):
-            food_item_data = data["parsed"][0]["food"]
-        elif data.get("hints") and len(data["hints"]) > 0 and data["hints"][0].get("food"):
-            food_item_data = data["hints"][0]["food"]
-
-        if food_item_data:
-            nutrients_per_100g = food_item_data.get("nutrients", {})
-            measures_data = []
-            if "measures" in food_item_data and isinstance(food_item_data["measures"], list):
-                for m_item in food_item_data["measures"]:
-                    if "uri" in m_item and "label" in m_item and "weight" in m_item:
-                        measures_data.append({
-                            "uri": m_item["uri"], 
-                            "label": m_item["label"],
-                            "weight": round(m_item["weight"], 2)
-                        })
-
-            # 確保 "100 grams" 選項存在
-            found_100g = False
-            for m in measures_data:
-                if m['label'].lower() == 'gram' and m['weight'] == 1.0: # Edamam 對 "gram" measure 的 weight 是 1
-                    # 不要直接修改這個，我們額外加一個 "100 grams"
-                    pass
-                if m['label'] == '100 grams':
-                    found_100g = True
-                    break
-            if not found_100g:
-                 measures_data.insert(0, { # 將 "100 grams" 放在列表開頭
-                    "uri": "http://www.edamam.com/ontologies/edamam.owl#Measure_gram", 
-                    "label": "100 grams", 
-                    "weight": 100.0
-                })
-
-
-            processed_data = {
-                "food_id": food_item_data.get("foodId"), 
-                "label": food_item_data.get("label", food_name_to_query),
-                "nutrients_per_100g": { 
-                    "calories": nutrients_per_100g.get("ENERC_KCAL"),
-                    "protein": nutrients_per_100g.get("PROCNT"),
-                    "fat": nutrients_per_100g.get("FAT"),
-                    "carbs": nutrients_per_100g.get("CHOCDF"),
-                    "fiber": nutrients_per_100g.get("FIBTG"),
-                },
-                "image_url": food_item_data.get("image"),
-                "measures": measures_data
+# Food Database 查詢結果 (每 100 克營養 + 份量單位) 的快取：正規化食物名稱 -> 結果。
+# 同步與非同步查詢成功時都會寫入；measure_conversion 用它在本機換算 "2 cups"、"1 slice" 等份量，不必再呼叫 API。
+_food_data_cache = TTLCache(maxsize=FOOD_DATA_CACHE_MAX_FOODS, ttl=FOOD_DATA_CACHE_TTL_SECONDS) if TTLCache is not None else None
+_food_data_cache_lock = threading.Lock()
+
+
+def _food_data_cache_key(food_name):
+    return " ".join(food_name.strip().lower().split())
+
+
+def get_cached_food_data(food_name):
+    """取得快取中的 get_food_data_with_measures 結果 (不發出網路請求)；沒有時返回 None。"""
+    if _food_data_cache is None or not food_name:
+        return None
+    with _food_data_cache_lock:
+        return _food_data_cache.get(_food_data_cache_key(food_name))
+
+
+def _remember_food_data(food_name, food_data):
+    if _food_data_cache is not None and food_data:
+        with _food_data_cache_lock:
+            _food_data_cache[_food_data_cache_key(food_name)] = food_data
+    return food_data
+
+
+def _parse_food_data_response(data, food_name_to_query):
+    """把 Food Database API (/parser) 的回應整理成 get_food_data_with_measures 的回傳格式；找不到食物時返回 None。"""
+    food_item_data = None
+    if data.get("parsed") and len(data["parsed"]) > 0 and data["parsed"][0].get("food"):
+        food_item_data = data["parsed"][0]["food"]
+    elif data.get("hints") and len(data["hints"]) > 0 and data["hints"][0].get("food"):
+        food_item_data = data["hints"][0]["food"]
+
+    if food_item_data:
+        nutrients_per_100g = food_item_data.get("nutrients", {})
+        measures_data = []
+        if "measures" in food_item_data and isinstance(food_item_data["measures"], list):
+            for m_item in food_item_data["measures"]:
+                if "uri" in m_item and "label" in m_item and "weight" in m_item:
+                    measures_data.append({
+                        "uri": m_item["uri"], 
+                        "label": m_item["label"],
+                        "weight": round(m_item["weight"], 2)
+                    })
+
+        # 確保 "100 grams" 選項存在
+        found_100g = False
+        for m in measures_data:
+            if m['label'].lower() == 'gram' and m['weight'] == 1.0: # Edamam 對 "gram" measure 的 weight 是 1
+                # 不要直接修改這個，我們額外加一個 "100 grams"
+                pass
+            if m['label'] == '100 grams':
+                found_100g = True
+                break
+        if not found_100g:
+             measures_data.insert(0, { # 將 "100 grams" 放在列表開頭
+                "uri": "http://www.edamam.com/ontologies/edamam.owl#Measure_gram", 
+                "label": "100 grams", 
+                "weight": 100.0
+            })
+
+
+        processed_data = {
+            "food_id": food_item_data.get("foodId"), 
+            "label": food_item_data.get("label", food_name_to_query),
+            "nutrients_per_100g": { 
+                "calories": nutrients_per_100g.get("ENERC_KCAL"),
+                "protein": nutrients_per_100g.get("PROCNT"),
+                "fat": nutrients_per_100g.get("FAT"),
+                "carbs": nutrients_per_100g.get("CHOCDF"),
+                "fiber": nutrients_per_100g.get("FIBTG"),
+            },
+            "image_url": food_item_data.get("image"),
+            "measures": measures_data
+        }
+
+        if processed_data["nutrients_per_100g"]:
+            processed_data["nutrients_per_100g"] = {
+                k: v for k, v in processed_data["nutrients_per_100g"].items() if v is not None
             }
+        return {k: v for k, v in processed_data.items() if v is not None or k == "nutrients_per_100g"}
+    else:
+        return None
+
+@cassette.recordable("edamam.food_data", ignore=cassette.DEFAULT_IGNORED_ARGUMENTS + ("raise_on_error",))
+def get_food_data_with_measures(food_name_to_query, raise_on_error=False): # <<< 確認函式名稱是這個！
+    """
+    (原 get_food_nutrition_data 函式，更名以明確其主要獲取的是食物資料和份量單位)
+    使用 Edamam Food Database API (/parser) 根據食物名稱查詢其基本資料、
+    預設營養資訊 (通常是每100g) 以及可用的份量單位 (measures)。
+    raise_on_error=True 時，網路 / API 錯誤會拋出例外而不是返回 None，
+    讓呼叫端 (例如 nutrition_providers 的斷路器) 能區分「查無此食物」與「API 故障」。
+    """
+    if not _ensure_food_db_ready(food_name_to_query, "get_food_data_with_measures"):
+        return None
 
-            if processed_data["nutrients_per_100g"]:
-                processed_data["nutrients_per_100g"] = {
-                    k: v for k, v in processed_data["nutrients_per_100g"].items() if v is not None
-                }
-            return {k: v for k, v in processed_data.items() if v is not None or k == "nutrients_per_100g"}
-        else:
-            return None
+    try:
+        response = requests.get(FOOD_DATABASE_PARSER_URL, params=_build_parser_params(food_name_to_query),
+                                timeout=REQUEST_TIMEOUT_SECONDS)
+        response.raise_for_status()
+        return _remember_food_data(food_name_to_query, _parse_food_data_response(response.json(), food_name_to_query))
     except requests.exceptions.HTTPError as http_err:
         print(f"錯誤 (edamam_module.py): Edamam Food DB API HTTP 錯誤: {http_err} - 回應內容: {response.text if 'response' in locals() else 'N/A'}")
+        if raise_on_error:
+            raise
         return None
     except requests.exceptions.RequestException as req_err:
         print(f"錯誤 (edamam_module.py): Edamam Food DB API 請求失敗: {req_err}")
+        if raise_on_error:
+            raise
         return None
     except json.JSONDecodeError:
         print("錯誤 (edamam_module.py): 無法解析來自 Edamam Food DB API 的回應。")
+        if raise_on_error:
+            raise
         return None
     except Exception as e:
         print(f"錯誤 (edamam_module.py): 查詢 Edamam Food DB API 時發生未預期錯誤: {e}")
+        if raise_on_error:
+            raise
         return None
 
-# ... (analyze_nutrition_for_specific_amount 函式保持不變) ...
-def analyze_nutrition_for_specific_amount(food_name_or_id, quantity, unit_label, measure_uri=None):
-    # ... (函式內容不變) ...
-    global _edamam_credentials_loaded, NUTRITION_ANALYSIS_APP_ID, NUTRITION_ANALYSIS_APP_KEY
-
+def _ensure_nutrition_analysis_ready(food_name_or_id, quantity, unit_label, caller_name):
     if not _edamam_credentials_loaded: 
         if not load_edamam_credentials():
-            print("錯誤 (edamam_module.py): analyze_nutrition_for_specific_amount - Edamam 憑證載入失敗。")
-            return None
+            print(f"錯誤 (edamam_module.py): {caller_name} - Edamam 憑證載入失敗。")
+            return False
 
     if not food_name_or_id or quantity is None or quantity <= 0 or not unit_label or \
        not NUTRITION_ANALYSIS_APP_ID or not NUTRITION_ANALYSIS_APP_KEY:
-        print("錯誤 (edamam_module.py): analyze_nutrition_for_specific_amount - 缺少必要的查詢參數或憑證。")
-        return None
-
-    analysis_base_url = f"https://api.edamam.com/api/nutrition-details?app_id={NUTRITION_ANALYSIS_APP_ID}&app_key={NUTRITION_ANALYSIS_APP_KEY}"
+        print(f"錯誤 (edamam_module.py): {caller_name} - 缺少必要的查詢參數或憑證。")
+        return False
+    return True
 
+def _build_nutrition_analysis_request(food_name_or_id, quantity, unit_label):
+    """回傳 (查詢參數, JSON payload)。"""
     ingredient_line = f"{quantity} {unit_label} {food_name_or_id}"
     if unit_label.lower() in ["gram", "grams", "g"]:
         ingredient_line = f"{quantity}g {food_name_or_id}"
     elif unit_label.lower() in ["kilogram", "kilograms", "kg"]:
         ingredient_line = f"{quantity}kg {food_name_or_id}"
 
+    params = {"app_id": NUTRITION_ANALYSIS_APP_ID, "app_key": NUTRITION_ANALYSIS_APP_KEY}
     payload = { "ingr": [ingredient_line] }
+    return params, payload
+
+# --- 精簡的 Nutrition Analysis 結果格式 ---
+# 原始回應中同一批營養素出現兩三次 (totalNutrients、依標籤整理的副本、totalDaily)，
+# 這裡只保留一份：營養代碼 -> [數量, 單位索引]，單位與標籤改用全模組共用的固定表，不在每筆結果中重複。
+NUTRIENT_UNITS = ("kcal", "g", "mg", "µg", "%", "IU", "kJ") # 結果中以索引表示單位
+NUTRIENT_LABELS = { # Edamam 營養代碼 -> 顯示用標籤
+    "ENERC_KCAL": "Energy", "FAT": "Fat", "FASAT": "Saturated", "FATRN": "Trans", "FAMS": "Monounsaturated",
+    "FAPU": "Polyunsaturated", "CHOCDF": "Carbs", "CHOCDF.net": "Carbohydrates (net)", "FIBTG": "Fiber",
+    "SUGAR": "Sugars", "SUGAR.added": "Sugars, added", "PROCNT": "Protein", "CHOLE": "Cholesterol", "NA": "Sodium",
+    "CA": "Calcium", "MG": "Magnesium", "K": "Potassium", "FE": "Iron", "ZN": "Zinc", "P": "Phosphorus",
+    "VITA_RAE": "Vitamin A", "VITC": "Vitamin C", "THIA": "Thiamin (B1)", "RIBF": "Riboflavin (B2)",
+    "NIA": "Niacin (B3)", "VITB6A": "Vitamin B6", "FOLDFE": "Folate equivalent (total)", "FOLFD": "Folate (food)",
+    "FOLAC": "Folic acid", "VITB12": "Vitamin B12", "VITD": "Vitamin D (D2 + D3)", "TOCPHA": "Vitamin E",
+    "VITK1": "Vitamin K", "WATER": "Water",
+}
+_UNIT_INDEX = {unit: index for index, unit in enumerate(NUTRIENT_UNITS)}
+
+
+def compact_nutrients(total_nutrients):
+    """Edamam 的 totalNutrients ({代碼: {label, quantity, unit}}) -> {代碼: [數量, 單位索引]}；不認得的單位略過。"""
+    nutrients = {}
+    for code, nutrient_data in (total_nutrients or {}).items():
+        if not isinstance(nutrient_data, dict) or "quantity" not in nutrient_data:
+            continue
+        unit_index = _UNIT_INDEX.get(nutrient_data.get("unit"))
+        if unit_index is None:
+            print(f"警告 (edamam_module.py): 營養素 '{code}' 的單位 '{nutrient_data.get('unit')}' 不在單位表中，已略過。")
+            continue
+        nutrients[sys.intern(code)] = [round(nutrient_data["quantity"], 2), unit_index]
+    return nutrients
+
+
+def nutrient_quantity(result, code):
+    """從精簡結果取出單一營養素，回傳 (數量, 單位)；沒有該營養素時回傳 (None, None)。"""
+    entry = (result or {}).get("nutrients", {}).get(code)
+    if entry is None:
+        return None, None
+    return entry[0], NUTRIENT_UNITS[entry[1]]
+
+
+def nutrients_by_label(result):
+    """把精簡結果展開為 {標籤: {"quantity", "unit"}} (顯示用，與舊版 total_nutrients_by_label 相同)。"""
+    return {NUTRIENT_LABELS.get(code, code): {"quantity": quantity, "unit": NUTRIENT_UNITS[unit_index]}
+            for code, (quantity, unit_index) in (result or {}).get("nutrients", {}).items()}
+
+
+def _parse_nutrition_details_response(nutrition_details, include_raw=False):
+    """
+    把 Nutrition Analysis API 的回應整理成精簡的固定格式；失敗時返回 None。
+    格式：{"calories", "total_weight_grams", "diet_labels", "health_labels", "cautions",
+           "nutrients": {代碼: [數量, 單位索引]}, "daily_percent": {代碼: 每日建議量百分比}}
+    include_raw=True 時另外附上原始回應 ("raw")，供除錯使用。
+    """
+    if nutrition_details and "calories" in nutrition_details and "totalNutrients" in nutrition_details:
+        result = {
+            "calories": nutrition_details.get("calories"),
+            "total_weight_grams": nutrition_details.get("totalWeight"),
+            # 標籤在不同結果間大量重複，intern 後共用同一個字串物件
+            "diet_labels": [sys.intern(label) for label in nutrition_details.get("dietLabels", [])],
+            "health_labels": [sys.intern(label) for label in nutrition_details.get("healthLabels", [])],
+            "cautions": [sys.intern(label) for label in nutrition_details.get("cautions", [])],
+            "nutrients": compact_nutrients(nutrition_details.get("totalNutrients")),
+            "daily_percent": {sys.intern(code): round(daily["quantity"], 1)
+                              for code, daily in (nutrition_details.get("totalDaily") or {}).items()
+                              if isinstance(daily, dict) and "quantity" in daily},
+        }
+        if include_raw:
+            result["raw"] = nutrition_details
+        return result
+    elif "error" in nutrition_details:
+        print(f"錯誤 (edamam_module.py): Nutrition Analysis API 回應錯誤: {nutrition_details.get('error')}")
+        return None
+    else:
+        print("錯誤 (edamam_module.py): Nutrition Analysis API 回應格式不如預期。")
+        return None
+
+@cassette.recordable("edamam.nutrition_details")
+def analyze_nutrition_for_specific_amount(food_name_or_id, quantity, unit_label, measure_uri=None, include_raw=False):
+    """查詢指定份量的營養 (Nutrition Analysis API)，回傳精簡格式 (見 _parse_nutrition_details_response)；失敗時返回 None。"""
+    if not _ensure_nutrition_analysis_ready(food_name_or_id, quantity, unit_label, "analyze_nutrition_for_specific_amount"):
+        return None
+
+    params, payload = _build_nutrition_analysis_request(food_name_or_id, quantity, unit_label)
 
     try:
-        response = requests.post(analysis_base_url, json=payload, timeout=15)
+        response = requests.post(NUTRITION_DETAILS_URL, params=params, json=payload, timeout=REQUEST_TIMEOUT_SECONDS)
         response.raise_for_status()
-        nutrition_details = response.json()
-
-        if nutrition_details and "calories" in nutrition_details and "totalNutrients" in nutrition_details:
-            nutrients_parsed = {}
-            for key, nutrient_data in nutrition_details.get("totalNutrients", {}).items():
-                if isinstance(nutrient_data, dict) and "label" in nutrient_data and "quantity" in nutrient_data and "unit" in nutrient_data:
-                    nutrients_parsed[nutrient_data["label"]] = {
-                        "quantity": round(nutrient_data["quantity"], 2),
-                        "unit": nutrient_data["unit"]
-                    }
-
-            return {
-                "calories": nutrition_details.get("calories"),
-                "total_weight_grams": nutrition_details.get("totalWeight"), 
-                "diet_labels": nutrition_details.get("dietLabels", []),
-                "health_labels": nutrition_details.get("healthLabels", []),
-                "cautions": nutrition_details.get("cautions", []),
-                "total_nutrients_by_label": nutrients_parsed, 
-                "raw_total_nutrients": nutrition_details.get("totalNutrients", {}), 
-                "raw_total_daily": nutrition_details.get("totalDaily", {}) 
-            }
-        elif "error" in nutrition_details:
-            print(f"錯誤 (edamam_module.py): Nutrition Analysis API 回應錯誤: {nutrition_details.get('error')}")
-            return None
-        else:
-            print("錯誤 (edamam_module.py): Nutrition Analysis API 回應格式不如預期。")
-            return None
+        return _parse_nutrition_details_response(response.json(), include_raw=include_raw)
 
     except requests.exceptions.HTTPError as http_err:
         print(f"錯誤 (edamam_module.py): Edamam Nutrition Analysis API HTTP 錯誤: {http_err} - 回應內容: {response.text if 'response' in locals() else 'N/A'}")
@@ -199,4 +332,145 @@ def analyze_nutrition_for_specific_amount(food_name_or_id, quantity, unit_label,
         return None
     except Exception as e:
         print(f"錯誤 (edamam_module.py): 呼叫 Edamam Nutrition Analysis API 時發生未預期錯誤: {e}")
-        return None
\ No newline at end of file
+        return None
+
+
+# --- 非同步版本 (httpx.AsyncClient，HTTP/2) ---
+# 在同一個 event loop 中以 asyncio.gather 同時查詢多種食物，不需要每個請求一個執行緒。
+# httpx.AsyncClient 綁定建立它的 event loop，因此每個 event loop 共用一個用戶端 (連線池)。
+
+_async_clients = weakref.WeakKeyDictionary() # event loop -> httpx.AsyncClient
+_async_clients_lock = threading.Lock()
+
+
+def _create_async_client():
+    limits = httpx.Limits(max_connections=ASYNC_MAX_CONNECTIONS,
+                          max_keepalive_connections=ASYNC_MAX_KEEPALIVE_CONNECTIONS)
+    try:
+        return httpx.AsyncClient(http2=True, limits=limits, timeout=REQUEST_TIMEOUT_SECONDS)
+    except ImportError:
+        # HTTP/2 需要額外的 'h2' 套件；未安裝時退回 HTTP/1.1 (仍共用連線池)
+        print("警告 (edamam_module.py): 未安裝 'h2' 套件，非同步用戶端改用 HTTP/1.1。"
+              "請執行 'pip3 install \"httpx[http2]\"' 以啟用 HTTP/2。")
+        return httpx.AsyncClient(limits=limits, timeout=REQUEST_TIMEOUT_SECONDS)
+
+
+def get_async_client():
+    """取得目前 event loop 共用的 httpx.AsyncClient (第一次呼叫時建立)；httpx 未安裝時返回 None。"""
+    if httpx is None:
+        return None
+    loop = asyncio.get_running_loop()
+    with _async_clients_lock:
+        client = _async_clients.get(loop)
+        if client is None or client.is_closed:
+            client = _create_async_client()
+            _async_clients[loop] = client
+        return client
+
+
+async def close_async_client():
+    """關閉目前 event loop 的共用用戶端 (在 event loop 結束前呼叫，釋放連線)。"""
+    with _async_clients_lock:
+        client = _async_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+
+@cassette.recordable("edamam.food_data", ignore=cassette.DEFAULT_IGNORED_ARGUMENTS + ("raise_on_error",))
+async def get_food_data_with_measures_async(food_name_to_query):
+    """get_food_data_with_measures 的非同步版本，回傳格式相同。"""
+    if not _ensure_food_db_ready(food_name_to_query, "get_food_data_with_measures_async"):
+        return None
+    client = get_async_client()
+    if client is None:
+        return None
+
+    try:
+        response = await client.get(FOOD_DATABASE_PARSER_URL, params=_build_parser_params(food_name_to_query))
+        response.raise_for_status()
+        return _remember_food_data(food_name_to_query, _parse_food_data_response(response.json(), food_name_to_query))
+    except httpx.HTTPStatusError as http_err:
+        print(f"錯誤 (edamam_module.py): Edamam Food DB API HTTP 錯誤: {http_err} - 回應內容: {http_err.response.text}")
+        return None
+    except httpx.RequestError as req_err:
+        print(f"錯誤 (edamam_module.py): Edamam Food DB API 請求失敗: {req_err}")
+        return None
+    except json.JSONDecodeError:
+        print("錯誤 (edamam_module.py): 無法解析來自 Edamam Food DB API 的回應。")
+        return None
+    except Exception as e:
+        print(f"錯誤 (edamam_module.py): 查詢 Edamam Food DB API 時發生未預期錯誤: {e}")
+        return None
+
+
+@cassette.recordable("edamam.nutrition_details")
+async def analyze_nutrition_for_specific_amount_async(food_name_or_id, quantity, unit_label, measure_uri=None,
+                                                      include_raw=False):
+    """analyze_nutrition_for_specific_amount 的非同步版本，回傳格式相同。"""
+    if not _ensure_nutrition_analysis_ready(food_name_or_id, quantity, unit_label,
+                                            "analyze_nutrition_for_specific_amount_async"):
+        return None
+    client = get_async_client()
+    if client is None:
+        return None
+
+    params, payload = _build_nutrition_analysis_request(food_name_or_id, quantity, unit_label)
+    try:
+        response = await client.post(NUTRITION_DETAILS_URL, params=params, json=payload)
+        response.raise_for_status()
+        return _parse_nutrition_details_response(response.json(), include_raw=include_raw)
+    except httpx.HTTPStatusError as http_err:
+        print(f"錯誤 (edamam_module.py): Edamam Nutrition Analysis API HTTP 錯誤: {http_err} - 回應內容: {http_err.response.text}")
+        return None
+    except httpx.RequestError as req_err:
+        print(f"錯誤 (edamam_module.py): Edamam Nutrition Analysis API 請求失敗: {req_err}")
+        return None
+    except json.JSONDecodeError:
+        print("錯誤 (edamam_module.py): 無法解析來自 Edamam Nutrition Analysis API 的回應。")
+        return None
+    except Exception as e:
+        print(f"錯誤 (edamam_module.py): 呼叫 Edamam Nutrition Analysis API 時發生未預期錯誤: {e}")
+        return None
+
+
+async def _gather_limited(coroutine_factories, max_concurrency):
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def run(factory):
+        async with semaphore:
+            return await factory()
+
+    return await asyncio.gather(*(run(factory) for factory in coroutine_factories))
+
+
+async def gather_food_data_with_measures(food_names, max_concurrency=ASYNC_MAX_CONCURRENT_REQUESTS):
+    """同時查詢多種食物的資料與份量單位，回傳與 food_names 順序相同的結果列表 (失敗的項目為 None)。"""
+    return await _gather_limited(
+        [lambda name=name: get_food_data_with_measures_async(name) for name in food_names], max_concurrency)
+
+
+async def gather_nutrition_for_amounts(requests_list, max_concurrency=ASYNC_MAX_CONCURRENT_REQUESTS):
+    """
+    同時查詢多筆指定份量的營養成分。
+    Args:
+        requests_list (list): 每筆為 (食物名稱, 數量, 單位) 的 tuple，例如 ("apple", 150, "gram")。
+    Returns:
+        list: 與 requests_list 順序相同的結果列表 (失敗的項目為 None)。
+    """
+    return await _gather_limited(
+        [lambda request=request: analyze_nutrition_for_specific_amount_async(*request) for request in requests_list],
+        max_concurrency)
+
+
+def run_async(coroutine):
+    """
+    在同步程式碼 (例如 Streamlit 或 CLI) 中執行上面的非同步函式：
+    建立一個 event loop 執行 coroutine，結束前關閉該 loop 的共用用戶端。
+    """
+    async def run_and_close():
+        try:
+            return await coroutine
+        finally:
+            await close_async_client()
+
+    return asyncio.run(run_and_close())
@@ -0,0 +1,277 @@
+# fake_backends.py
+# 本機假後端：把 Google Vision、Vertex AI (Gemini / 文字向量) 與 Edamam 換成不連網的假實作，
+# 供負載測試 (load_test.py) 在沒有憑證、不產生費用的情況下驅動完整的分析流程。
+# - 只替換「最外層的網路呼叫」：Vision 的兩個 API 函式、Vertex AI 的模型物件、Edamam 的查詢函式；
+#   其餘程式 (對沖呼叫、JSON 驗證、營養來源鏈與斷路器、份量表、本地食物索引、圖片裁切) 都照常執行，
+#   因此量到的 CPU 與記憶體就是 App 本身的成本。
+# - 每個假呼叫以 sleep 模擬網路延遲 (對數常態分布)，延遲可以整體縮放。
+#
+# 用法：fake_backends.install(latency_scale=1.0)；結束後 fake_backends.uninstall() 還原。
+
+import hashlib
+import io
+import json
+import random
+import re
+import threading
+import time
+from types import SimpleNamespace
+
+from vision_module import vision_api
+import llm_module
+import edamam_module
+
+# 各後端的模擬延遲中位數 (秒)，大致對應實際服務的回應時間
+FAKE_LATENCY_SECONDS = {
+    "vision_objects": 0.6,
+    "vision_labels": 0.5,
+    "llm_refine": 0.8,
+    "llm_portion": 0.9,
+    "llm_nutrition": 1.2,
+    "llm_multimodal": 3.0,
+    "embedding": 0.15,
+    "edamam": 0.35,
+}
+LATENCY_SIGMA = 0.35 # 對數常態分布的離散程度 (0.35 時 p99 約為中位數的 2.3 倍)
+FAKE_EMBEDDING_DIMENSIONS = 64
+
+# 假 Vision 會從這些物件中挑選；generic 名稱會觸發裁切標籤偵測與名稱精煉的完整路徑
+_FAKE_OBJECTS = [
+    ("Food", ["Fried rice", "Dish", "Cuisine"]),
+    ("Banana", ["Banana", "Fruit"]),
+    ("Apple", ["Apple", "Fruit"]),
+    ("Bread", ["Bread", "Baked goods"]),
+    ("Fruit", ["Orange", "Citrus"]),
+    ("Plate", ["Tableware"]),
+    ("Packaged goods", ["Snack"]),
+]
+_NOT_FOOD_NAMES = {"plate", "tableware", "table", "person", "packaged goods"}
+_CATEGORY_NAMES = {"fruit", "vegetable", "baked goods", "dessert", "snack"}
+_EDAMAM_MISS_RATE = 0.15 # 部分食物 Edamam 查不到，讓營養來源鏈走到 LLM 備援
+
+_latency_scale = 1.0
+_random = random.Random(0)
+_random_lock = threading.Lock()
+_originals = None
+
+
+def _simulate_latency(backend):
+    with _random_lock:
+        factor = _random.lognormvariate(0.0, LATENCY_SIGMA)
+    seconds = FAKE_LATENCY_SECONDS[backend] * _latency_scale * factor
+    if seconds > 0:
+        time.sleep(seconds)
+
+
+def _stable_fraction(text, salt=""):
+    """由文字決定一個 0~1 的固定值 (同一個食物每次得到相同的假資料)。"""
+    digest = hashlib.sha256(f"{salt}:{text.strip().lower()}".encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") / float(1 << 64)
+
+
+def _fake_nutrients_per_100g(food_name):
+    fraction = _stable_fraction(food_name, "nutrients")
+    return {
+        "calories_kcal": round(40 + fraction * 360, 1),
+        "protein_g": round(fraction * 25, 1),
+        "fat_g": round((1 - fraction) * 15, 1),
+        "carbohydrates_g": round(5 + fraction * 60, 1),
+        "fiber_g": round(fraction * 6, 1),
+    }
+
+
+# --- Google Vision ---
+
+def fake_analyze_image_objects(image_content_bytes, include_bounding_boxes=False, timeout=None):
+    _simulate_latency("vision_objects")
+    # 依圖片內容決定偵測到哪些物件 (同一張圖每次結果相同)
+    digest = hashlib.sha256(image_content_bytes).digest()
+    object_count = 2 + digest[0] % 3
+    objects = []
+    for i in range(object_count):
+        name, _ = _FAKE_OBJECTS[digest[i + 1] % len(_FAKE_OBJECTS)]
+        left = (i % 2) * 0.5
+        top = (i // 2) * 0.5
+        box = [(left, top), (left + 0.45, top), (left + 0.45, top + 0.45), (left, top + 0.45)]
+        score = 0.6 + (digest[i + 8] % 40) / 100.0
+        if include_bounding_boxes:
+            objects.append({"name": name, "score": score, "mid": f"/m/fake{i}", "bounding_box": box})
+        else:
+            objects.append((name, score))
+    return objects
+
+
+def fake_label_object_crops(image_content_bytes, localized_objects, max_labels=5, timeout=None):
+    if not localized_objects:
+        return []
+    # 與真實實作相同，先在本機裁切 (這部分的 CPU 成本屬於 App 本身)
+    try:
+        from PIL import Image
+        with Image.open(io.BytesIO(image_content_bytes)) as pil_image:
+            pil_image = pil_image.convert("RGB")
+            for obj in localized_objects:
+                vision_api._crop_normalized_box(pil_image, obj.get("bounding_box"))
+    except Exception as e:
+        print(f"警告 (fake_backends.py): 假裁切失敗，略過: {e}")
+    _simulate_latency("vision_labels")
+    labels_by_name = dict(_FAKE_OBJECTS)
+    crop_labels = []
+    for obj in localized_objects:
+        labels = labels_by_name.get(obj.get("name"), [])[:max_labels]
+        crop_labels.append([(label, 0.9 - rank * 0.1) for rank, label in enumerate(labels)])
+    return crop_labels
+
+
+# --- Vertex AI ---
+
+class _FakePart:
+    def __init__(self, text):
+        self.text = text
+
+
+class _FakeContent:
+    def __init__(self, text):
+        self.parts = [_FakePart(text)]
+
+
+class _FakeCandidate:
+    def __init__(self, text):
+        self.content = _FakeContent(text)
+        self.finish_reason = llm_module.FinishReason.STOP
+
+
+FAKE_IMAGE_PROMPT_TOKENS = 258 # Gemini 對一張圖片計算的輸入 token 數
+
+
+class _FakeResponse:
+    def __init__(self, text, contents):
+        self.candidates = [_FakeCandidate(text)]
+        # 以約 4 字元一個 token 粗估，讓 llm_usage 的統計在壓力測試中也有數字
+        prompt_tokens = sum(len(content) // 4 if isinstance(content, str) else FAKE_IMAGE_PROMPT_TOKENS
+                            for content in contents)
+        self.usage_metadata = SimpleNamespace(prompt_token_count=prompt_tokens, candidates_token_count=len(text) // 4 + 1)
+
+
+def _quoted_name(prompt_text, pattern):
+    match = re.search(pattern, prompt_text)
+    return match.group(1) if match else "food"
+
+
+def _fake_refine_answer(object_name):
+    key = object_name.strip().lower()
+    if key in _NOT_FOOD_NAMES:
+        return "NOT_FOOD"
+    if key in _CATEGORY_NAMES:
+        return f"CATEGORY:{object_name.strip().title()}"
+    if key in ("food", "dish", "cuisine"):
+        return "UNKNOWN_FOOD"
+    return object_name.strip().lower()
+
+
+class FakeGenerativeModel:
+    """依提示內容辨識任務 (名稱精煉 / 份量 / 營養 / 多模態)，回傳格式正確的假回應。"""
+
+    def generate_content(self, contents, generation_config=None, safety_settings=None, stream=False, timeout=None):
+        prompt_text = next((content for content in contents if isinstance(content, str)), "")
+        if len(contents) > 1 or '{"items"' in prompt_text:
+            _simulate_latency("llm_multimodal")
+            items = []
+            for name, _ in _FAKE_OBJECTS[1:4]:
+                grams = 80 + int(_stable_fraction(name, "grams") * 200)
+                per_100g = _fake_nutrients_per_100g(name)
+                items.append({"name": name.lower(), "grams": grams,
+                              "nutrition": {key: round(value * grams / 100.0, 1) for key, value in per_100g.items()}})
+            return _FakeResponse(json.dumps({"items": items}), contents)
+        if "JSON 格式的建議克數" in prompt_text:
+            _simulate_latency("llm_portion")
+            food_name = _quoted_name(prompt_text, r"食物名稱：「(.+?)」")
+            return _FakeResponse(json.dumps({"grams": 80 + int(_stable_fraction(food_name, "grams") * 200)}), contents)
+        if "JSON 格式的營養成分" in prompt_text:
+            _simulate_latency("llm_nutrition")
+            match = re.search(r"食物：([\d.]+) 克「(.+?)」", prompt_text)
+            grams, food_name = (float(match.group(1)), match.group(2)) if match else (100.0, "food")
+            per_100g = _fake_nutrients_per_100g(food_name)
+            return _FakeResponse(json.dumps({key: round(value * grams / 100.0, 1) for key, value in per_100g.items()}), contents)
+        _simulate_latency("llm_refine")
+        return _FakeResponse(_fake_refine_answer(_quoted_name(prompt_text, r'物件名稱："(.+?)"')), contents)
+
+
+class _FakeEmbedding:
+    def __init__(self, values):
+        self.values = values
+
+
+class FakeEmbeddingModel:
+    """以文字雜湊產生固定的假向量 (相同文字得到相同向量，不同文字幾乎正交)。"""
+
+    def get_embeddings(self, embedding_inputs):
+        _simulate_latency("embedding")
+        embeddings = []
+        for embedding_input in embedding_inputs:
+            text = getattr(embedding_input, "text", str(embedding_input)).strip().lower()
+            seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "big")
+            generator = random.Random(seed)
+            embeddings.append(_FakeEmbedding([generator.gauss(0.0, 1.0) for _ in range(FAKE_EMBEDDING_DIMENSIONS)]))
+        return embeddings
+
+
+# --- Edamam ---
+
+def fake_get_food_data_with_measures(food_name, raise_on_error=False):
+    _simulate_latency("edamam")
+    if _stable_fraction(food_name, "edamam_miss") < _EDAMAM_MISS_RATE:
+        return None
+    per_100g = _fake_nutrients_per_100g(food_name)
+    return {
+        "food_id": f"food_fake_{hashlib.sha256(food_name.encode('utf-8')).hexdigest()[:12]}",
+        "label": food_name.title(),
+        "nutrients_per_100g": {
+            "calories": per_100g["calories_kcal"],
+            "protein": per_100g["protein_g"],
+            "fat": per_100g["fat_g"],
+            "carbs": per_100g["carbohydrates_g"],
+            "fiber": per_100g["fiber_g"],
+        },
+        "measures": [{"uri": "http://www.edamam.com/ontologies/edamam.owl#Measure_gram", "label": "100 grams", "weight": 100.0}],
+    }
+
+
+def install(latency_scale=1.0, seed=0):
+    """換上假後端。latency_scale 縮放所有模擬延遲 (0 代表不等待，只量 App 本身的 CPU 成本)。"""
+    global _originals, _latency_scale, _random
+    _latency_scale = latency_scale
+    _random = random.Random(seed)
+    if _originals is not None:
+        return
+    _originals = {
+        (vision_api, "analyze_image_objects"): vision_api.analyze_image_objects,
+        (vision_api, "label_object_crops"): vision_api.label_object_crops,
+        (vision_api, "_google_credentials_set"): vision_api._google_credentials_set,
+        (llm_module, "_vertex_ai_initialized"): llm_module._vertex_ai_initialized,
+        (llm_module, "_llm_model"): llm_module._llm_model,
+        (llm_module, "_models"): llm_module._models,
+        (llm_module, "_load_model"): llm_module._load_model,
+        (llm_module, "_embedding_model"): llm_module._embedding_model,
+        (edamam_module, "get_food_data_with_measures"): edamam_module.get_food_data_with_measures,
+        (edamam_module, "load_edamam_credentials"): edamam_module.load_edamam_credentials,
+    }
+    vision_api.analyze_image_objects = fake_analyze_image_objects
+    vision_api.label_object_crops = fake_label_object_crops
+    vision_api._google_credentials_set = True
+    llm_module._vertex_ai_initialized = True
+    llm_module._llm_model = FakeGenerativeModel()
+    llm_module._models = {} # 路由表中的每個模型都換成假模型
+    llm_module._load_model = lambda model_name: FakeGenerativeModel()
+    llm_module._embedding_model = FakeEmbeddingModel()
+    edamam_module.get_food_data_with_measures = fake_get_food_data_with_measures
+    edamam_module.load_edamam_credentials = lambda: True
+
+
+def uninstall():
+    """還原真實後端。"""
+    global _originals
+    if _originals is None:
+        return
+    for (module, attribute), original in _originals.items():
+        setattr(module, attribute, original)
+    _originals = None
@@ -0,0 +1,355 @@
+# food_index.py
+# 本地食物表的向量索引：精煉後的食物名稱 (通常是英文) 常常與本地表中的名稱 (例如中文) 寫法不同，
+# 用名稱向量的餘弦相似度找出最接近的本地食物；相似度夠高時直接用本地營養數據，不必再問 LLM。
+#
+# - 預設做法：暴力計算 (NumPy 矩陣乘法)，向量矩陣以 memory-map 方式讀取，不必整個載入記憶體。
+# - 大型食物表：可選用 IVF 分區 (k-means 分群)，查詢時只比對最接近的幾個分區。
+#
+# 重建索引 (食物表更新或向量模型更換後，第一次查詢時會在背景自動重建，建好前查詢直接略過本地比對；
+# 大型表建議事先手動建立)：
+#   python food_index.py                    # 使用 foods.csv
+#   python food_index.py my_foods.csv 64    # 自訂食物表，並建立 64 個 IVF 分區
+
+import csv
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+
+import data_paths
+import metrics
+
+try:
+    import numpy as np
+except ImportError:
+    print("警告 (food_index.py): Python 套件 'numpy' 尚未安裝，本地食物向量比對功能停用。"
+          "請在終端機中執行 'pip3 install numpy' 指令來安裝。")
+    np = None
+
+DEFAULT_FOODS_CSV = os.path.join(os.path.dirname(os.path.abspath(__file__)), "foods.csv")
+SIMILARITY_THRESHOLD = 0.85 # 餘弦相似度門檻，低於此值不採用本地數據
+IVF_MIN_FOODS = 5000        # 食物數超過此值時，自動重建會建立 IVF 分區
+IVF_DEFAULT_NPROBE = 4      # IVF 查詢時比對的分區數
+_KMEANS_ITERATIONS = 20
+
+# 本地 CSV 欄位 -> 程式內統一使用的營養素鍵 (數值為每 100 克)
+_CSV_NUTRIENT_COLUMNS = {
+    "Calories": "calories_kcal",
+    "Protein": "protein_g",
+    "Fat": "fat_g",
+    "Carbs": "carbohydrates_g",
+    "Fiber": "fiber_g", # 選填欄位，缺少時視為 0
+}
+
+
+def load_local_foods(csv_path=DEFAULT_FOODS_CSV):
+    """讀取本地食物 CSV，回傳 [{"name": 名稱, "nutrients_per_100g": {...}}, ...]。"""
+    foods = []
+    try:
+        with open(csv_path, mode="r", encoding="utf-8") as csvfile:
+            for row in csv.DictReader(csvfile):
+                food_name = (row.get("FoodName") or "").strip()
+                if not food_name:
+                    continue
+                nutrients_per_100g = {}
+                for column, nutrient_key in _CSV_NUTRIENT_COLUMNS.items():
+                    try:
+                        nutrients_per_100g[nutrient_key] = float(row.get(column) or 0)
+                    except ValueError:
+                        nutrients_per_100g[nutrient_key] = 0.0
+                foods.append({"name": food_name, "nutrients_per_100g": nutrients_per_100g})
+    except FileNotFoundError:
+        print(f"錯誤 (food_index.py): 找不到本地食物表 {csv_path}")
+    return foods
+
+
+def _file_sha256(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def _normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def _kmeans(vectors, cluster_count, iterations=_KMEANS_ITERATIONS, seed=0):
+    """以球面 k-means (餘弦相似度) 分群，回傳 (中心點矩陣, 每個向量的分群編號)。"""
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), size=cluster_count, replace=False)].copy()
+    assignments = np.zeros(len(vectors), dtype=np.int32)
+    for _ in range(iterations):
+        assignments = np.argmax(vectors @ centroids.T, axis=1).astype(np.int32)
+        for cluster_id in range(cluster_count):
+            members = vectors[assignments == cluster_id]
+            if len(members):
+                centroids[cluster_id] = members.mean(axis=0)
+        centroids = _normalize_rows(centroids)
+    return centroids.astype(np.float32), assignments
+
+
+class FoodIndex:
+    """已建立好的本地食物向量索引 (從磁碟載入，向量矩陣以 memory-map 讀取)。"""
+
+    def __init__(self, index_dir):
+        with open(os.path.join(index_dir, "foods.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        self.source_sha256 = meta["source_sha256"]
+        self.embedding_model = meta["embedding_model"]
+        self.foods = meta["foods"]
+        self.embeddings = np.load(os.path.join(index_dir, "embeddings.npy"), mmap_mode="r")
+        self.centroids = None
+        self.list_offsets = None
+        if meta.get("ivf_lists"):
+            # IVF：向量已依分群排序存放，list_offsets[i]:list_offsets[i+1] 是第 i 個分區的列範圍
+            self.centroids = np.load(os.path.join(index_dir, "ivf_centroids.npy"))
+            self.list_offsets = np.load(os.path.join(index_dir, "ivf_offsets.npy"))
+
+    def search(self, query_vector, nprobe=IVF_DEFAULT_NPROBE):
+        """回傳 (最相似食物的索引, 餘弦相似度)；索引為空時回傳 (None, 0.0)。"""
+        if len(self.foods) == 0:
+            return None, 0.0
+        query = np.asarray(query_vector, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1.0)
+
+        if self.centroids is None:
+            scores = self.embeddings @ query
+            best = int(np.argmax(scores))
+            return best, float(scores[best])
+
+        probe_lists = np.argsort(self.centroids @ query)[::-1][:nprobe]
+        best_index, best_score = None, -1.0
+        for list_id in probe_lists:
+            start, end = int(self.list_offsets[list_id]), int(self.list_offsets[list_id + 1])
+            if start == end:
+                continue
+            scores = self.embeddings[start:end] @ query
+            local_best = int(np.argmax(scores))
+            if float(scores[local_best]) > best_score:
+                best_index, best_score = start + local_best, float(scores[local_best])
+        return best_index, best_score
+
+
+def build_food_index(csv_path=DEFAULT_FOODS_CSV, index_dir=None, ivf_lists=None):
+    """
+    讀取本地食物表、計算所有名稱的向量並寫入索引目錄。
+    Args:
+        ivf_lists (int, 可選): IVF 分區數；None 表示食物數超過 IVF_MIN_FOODS 時自動決定，0 表示不分區。
+    Returns:
+        FoodIndex: 建好的索引；失敗時返回 None。
+    """
+    import llm_module # 計算向量需要 Vertex AI
+
+    if np is None:
+        return None
+    index_dir = index_dir or _index_dir_for(os.path.abspath(csv_path))
+    foods = load_local_foods(csv_path)
+    if not foods:
+        return None
+    vectors = llm_module.get_text_embeddings([food["name"] for food in foods])
+    if vectors is None or len(vectors) != len(foods):
+        print("錯誤 (food_index.py): 無法取得本地食物名稱的向量，索引未建立。")
+        return None
+
+    matrix = _normalize_rows(np.asarray(vectors, dtype=np.float32).reshape(len(foods), -1))
+    if ivf_lists is None:
+        ivf_lists = int(np.sqrt(len(foods))) if len(foods) >= IVF_MIN_FOODS else 0
+    ivf_lists = min(ivf_lists, len(foods))
+
+    os.makedirs(index_dir, exist_ok=True)
+    if ivf_lists > 0:
+        centroids, assignments = _kmeans(matrix, ivf_lists)
+        order = np.argsort(assignments, kind="stable")
+        matrix = matrix[order]
+        foods = [foods[i] for i in order]
+        offsets = np.zeros(ivf_lists + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(assignments, minlength=ivf_lists))
+        np.save(os.path.join(index_dir, "ivf_centroids.npy"), centroids)
+        np.save(os.path.join(index_dir, "ivf_offsets.npy"), offsets)
+
+    np.save(os.path.join(index_dir, "embeddings.npy"), matrix.astype(np.float32))
+    # foods.json 最後寫入：載入時以它為準，避免讀到只寫了一半的索引
+    with open(os.path.join(index_dir, "foods.json"), "w", encoding="utf-8") as f:
+        json.dump({
+            "source_sha256": _file_sha256(csv_path),
+            "embedding_model": llm_module._embedding_model_name,
+            "ivf_lists": ivf_lists,
+            "foods": foods,
+        }, f, ensure_ascii=False)
+    return FoodIndex(index_dir)
+
+
+INDEX_RETRY_BASE_SECONDS = 30    # 索引載入/建立失敗後，第一次重試前等待的秒數 (之後每次加倍)
+INDEX_RETRY_MAX_SECONDS = 3600   # 重試間隔上限
+
+_food_indexes = {}    # 食物表路徑 -> 已可使用的 FoodIndex
+_building_paths = set() # 正在背景載入/建立索引的食物表路徑
+_build_failures = {}  # 食物表路徑 -> (連續失敗次數, 下次可以重試的時間)；以退避重試，避免每次查詢都呼叫向量 API
+_food_index_lock = threading.Lock()
+_query_vector_cache = {} # 正規化查詢名稱 -> 向量
+_query_vector_cache_lock = threading.Lock()
+_QUERY_CACHE_MAX = 2048
+QUERY_EMBEDDING_TIMEOUT_SECONDS = 3.0 # 未指定 timeout 時，計算查詢名稱向量的最長等待秒數
+
+
+def _index_dir_for(csv_path):
+    """每個食物表有自己的索引目錄 (預設的 foods.csv 沿用原本的 food_index 目錄)。"""
+    if csv_path == DEFAULT_FOODS_CSV:
+        return data_paths.get_data_path("food_index")
+    path_hash = hashlib.sha256(csv_path.encode("utf-8")).hexdigest()[:12]
+    return data_paths.get_data_path(f"food_index_{path_hash}")
+
+
+def _load_or_build_index(csv_path):
+    """在背景執行緒中載入磁碟上的索引；不存在、食物表已變更或向量模型不同時重建。"""
+    import llm_module
+
+    index = None
+    try:
+        source_sha256 = _file_sha256(csv_path)
+        index_dir = _index_dir_for(csv_path)
+        try:
+            existing_index = FoodIndex(index_dir)
+            if (existing_index.source_sha256 == source_sha256 and
+                    existing_index.embedding_model == llm_module._embedding_model_name):
+                index = existing_index
+        except (OSError, ValueError, KeyError):
+            pass # 索引不存在或損毀，重建
+        if index is None:
+            index = build_food_index(csv_path, index_dir)
+            if index is not None:
+                metrics.increment("food_index.builds")
+    except Exception as e:
+        print(f"錯誤 (food_index.py): 載入或建立食物表 {csv_path} 的向量索引時發生錯誤: {e}")
+        index = None
+
+    with _food_index_lock:
+        _building_paths.discard(csv_path)
+        if index is not None:
+            _food_indexes[csv_path] = index
+            _build_failures.pop(csv_path, None)
+            return
+        failure_count = _build_failures.get(csv_path, (0, 0.0))[0] + 1
+        retry_delay = min(INDEX_RETRY_MAX_SECONDS, INDEX_RETRY_BASE_SECONDS * 2 ** (failure_count - 1))
+        _build_failures[csv_path] = (failure_count, time.monotonic() + retry_delay)
+    metrics.increment("food_index.build_failures")
+    print(f"警告 (food_index.py): 食物表 {csv_path} 的向量索引無法使用，{retry_delay} 秒後重試。")
+
+
+def get_food_index(csv_path=DEFAULT_FOODS_CSV):
+    """
+    取得 csv_path 的本地食物索引；索引不存在、食物表內容或向量模型變更時在背景執行緒自動重建。
+    不會等待載入或建立：尚未就緒 (或失敗後還在退避期間) 時回傳 None，呼叫端改用其他營養來源。
+    """
+    import llm_module
+
+    if np is None:
+        return None
+    csv_path = os.path.abspath(csv_path)
+    with _food_index_lock:
+        index = _food_indexes.get(csv_path)
+        if index is not None:
+            if index.embedding_model == llm_module._embedding_model_name:
+                return index
+            del _food_indexes[csv_path] # 向量模型已更換，舊向量與查詢向量無法比較
+            with _query_vector_cache_lock:
+                _query_vector_cache.clear()
+        if csv_path in _building_paths:
+            return None
+        failure = _build_failures.get(csv_path)
+        if failure is not None and time.monotonic() < failure[1]:
+            return None
+        _building_paths.add(csv_path)
+    threading.Thread(target=_load_or_build_index, args=(csv_path,), name="food-index-build", daemon=True).start()
+    return None
+
+
+def _query_key(food_name):
+    return food_name.strip().lower()
+
+
+def has_cached_query_vector(food_name):
+    """food_name 的查詢向量是否已在快取中 (比對時不需要呼叫向量 API)。"""
+    with _query_vector_cache_lock:
+        return _query_key(food_name) in _query_vector_cache
+
+
+def _get_query_vector(food_name, timeout=None, cached_only=False):
+    import llm_module
+
+    key = _query_key(food_name)
+    with _query_vector_cache_lock:
+        if key in _query_vector_cache:
+            return _query_vector_cache[key]
+    if cached_only:
+        return None
+    # 呼叫向量 API 時不持有鎖，其他名稱的查詢不必等待
+    vectors = llm_module.get_text_embeddings(
+        [food_name], timeout=QUERY_EMBEDDING_TIMEOUT_SECONDS if timeout is None else timeout)
+    if not vectors:
+        return None
+    with _query_vector_cache_lock:
+        if len(_query_vector_cache) >= _QUERY_CACHE_MAX:
+            _query_vector_cache.clear()
+        _query_vector_cache[key] = vectors[0]
+    return vectors[0]
+
+
+def match_local_food(food_name, threshold=SIMILARITY_THRESHOLD, csv_path=DEFAULT_FOODS_CSV, timeout=None,
+                     cached_only=False):
+    """
+    在本地食物表中找出與 food_name 最相近的食物。
+    timeout 為計算查詢向量的最長等待秒數；cached_only=True 時只使用已快取的查詢向量 (不呼叫向量 API)。
+    Returns:
+        tuple: (食物字典, 相似度)；沒有超過門檻的食物或索引無法使用時回傳 (None, 最高相似度)。
+    """
+    index = get_food_index(csv_path)
+    if index is None or not food_name:
+        return None, 0.0
+    query_vector = _get_query_vector(food_name, timeout=timeout, cached_only=cached_only)
+    if query_vector is None:
+        return None, 0.0
+    best_index, similarity = index.search(query_vector)
+    if best_index is None or similarity < threshold:
+        metrics.increment("food_index.misses")
+        return None, similarity
+    metrics.increment("food_index.hits")
+    return index.foods[best_index], similarity
+
+
+def get_local_nutrition(food_name, grams, threshold=SIMILARITY_THRESHOLD, csv_path=DEFAULT_FOODS_CSV, timeout=None,
+                        cached_only=False):
+    """
+    以本地食物表回答指定克數的營養成分 (timeout、cached_only 見 match_local_food)。
+    Returns:
+        dict: 與 llm_module.get_nutrition_from_llm 相同格式的成功結果，另外包含
+              "source": "local"、"matched_name" 與 "similarity"；找不到夠相似的食物時返回 None。
+    """
+    if not isinstance(grams, (int, float)) or grams <= 0:
+        return None
+    matched_food, similarity = match_local_food(food_name, threshold=threshold, csv_path=csv_path, timeout=timeout,
+                                                cached_only=cached_only)
+    if matched_food is None:
+        return None
+    scale = grams / 100.0
+    data = {key: round(value * scale, 2) for key, value in matched_food["nutrients_per_100g"].items()}
+    return {"status": "success", "data": data, "source": "local",
+            "matched_name": matched_food["name"], "similarity": round(similarity, 4)}
+
+
+if __name__ == "__main__":
+    import llm_module
+
+    source_csv = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_FOODS_CSV
+    requested_lists = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    if not llm_module.initialize_vertex_ai():
+        print("錯誤：Vertex AI 初始化失敗，無法建立食物向量索引。請檢查 .streamlit/secrets.toml。")
+        sys.exit(1)
+    built_index = build_food_index(source_csv, ivf_lists=requested_lists)
+    if built_index is None:
+        sys.exit(1)
+    print(f"食物向量索引已建立：{len(built_index.foods)} 筆食物，"
+          f"IVF 分區數 {0 if built_index.centroids is None else len(built_index.centroids)}。")
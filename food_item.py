@@ -0,0 +1,168 @@
+# food_item.py
+# 分析結果中的單一食物項目。
+# 以前每個項目是約 15 個字串鍵的 dict (狀態是重複的字串、營養是巢狀 dict)，整份複製進 session state，
+# 每次重跑都要逐鍵查找。這裡改為 __slots__ 的 dataclass：
+# - 各階段狀態為 StageStatus 列舉 (所有項目共用同一組單例物件)；
+# - 營養是固定順序 (NUTRIENT_KEYS) 的 array("d") 向量，加總時直接逐欄相加；
+# - to_dict() / from_dict() 與舊的 dict 格式互轉，供 JSON 輸出 (HTTP 服務) 與儲存使用。
+
+import uuid
+from array import array
+from dataclasses import dataclass, replace
+from enum import Enum
+from typing import NamedTuple, Optional
+
+NUTRIENT_KEYS = ("calories_kcal", "protein_g", "fat_g", "carbohydrates_g", "fiber_g") # 營養向量的欄位順序
+
+
+class StageStatus(str, Enum):
+    """分析各階段 (名稱精煉 / 份量建議 / 營養查詢) 的狀態；繼承 str，可直接與舊的狀態字串比較。"""
+    PENDING = "pending" # 截止時間到時尚未執行，之後可補完
+    SUCCESS = "success"
+    UNKNOWN_WEIGHT = "unknown_weight"
+    NO_DATA = "no_data"
+    ERROR = "error"
+
+    @classmethod
+    def parse(cls, value):
+        """把來源回傳的狀態字串轉為列舉；不認得的狀態視為 ERROR。"""
+        if isinstance(value, cls):
+            return value
+        try:
+            return cls(value)
+        except ValueError:
+            return cls.ERROR
+
+
+class PendingRefinement(NamedTuple):
+    """名稱精煉需要的輸入 (精煉完成前才存在)。"""
+    object_name: str
+    vision_score: float
+    label_hints: Optional[list]
+
+
+def nutrients_from_dict(nutrition_data):
+    """營養 dict -> 固定寬度向量；None 或空 dict 回傳 None (沒有營養數據)。"""
+    if not nutrition_data:
+        return None
+    return array("d", (float(nutrition_data.get(key) or 0) for key in NUTRIENT_KEYS))
+
+
+def nutrients_to_dict(nutrients):
+    """固定寬度向量 -> 營養 dict；None 時回傳 None。"""
+    if nutrients is None:
+        return None
+    return dict(zip(NUTRIENT_KEYS, nutrients))
+
+
+@dataclass(slots=True, eq=False)
+class FoodItem:
+    vision_object_name: str
+    llm_refined_name: str
+    llm_suggested_grams: int
+    user_grams: int
+    status_name_refinement: StageStatus = StageStatus.PENDING
+    status_portion_suggestion: StageStatus = StageStatus.PENDING
+    status_nutrition_fetch: StageStatus = StageStatus.PENDING
+    nutrients: Optional[array] = None # NUTRIENT_KEYS 順序的營養向量 (對應 user_grams)
+    nutrition_source: Optional[str] = None # "local" / "edamam_cache" / "edamam" / "llm"
+    image_key: Optional[str] = None
+    image_name: Optional[str] = None
+    pending_refinement: Optional[PendingRefinement] = None
+    meal_log_entry_id: Optional[int] = None
+    id: str = ""
+
+    def __post_init__(self):
+        if not self.id:
+            self.id = uuid.uuid4().hex
+
+    def is_pending(self):
+        """是否還有因截止時間而尚未執行的階段。"""
+        return StageStatus.PENDING in (self.status_name_refinement, self.status_portion_suggestion,
+                                       self.status_nutrition_fetch)
+
+    def pending_stages(self):
+        """尚未執行的階段名稱 ("name_refinement" / "portion_suggestion" / "nutrition_fetch")。"""
+        return [stage for stage, status in (("name_refinement", self.status_name_refinement),
+                                            ("portion_suggestion", self.status_portion_suggestion),
+                                            ("nutrition_fetch", self.status_nutrition_fetch))
+                if status is StageStatus.PENDING]
+
+    @property
+    def nutrition_data(self):
+        """營養 dict (供顯示與寫入飲食日誌)；沒有營養數據時為 None。"""
+        return nutrients_to_dict(self.nutrients)
+
+    def set_nutrition(self, status, nutrition_data=None, source=None):
+        """記錄營養查詢結果 (status 可為來源回傳的狀態字串)。"""
+        self.status_nutrition_fetch = StageStatus.parse(status)
+        self.nutrients = nutrients_from_dict(nutrition_data) if self.status_nutrition_fetch is StageStatus.SUCCESS else None
+        self.nutrition_source = source if self.nutrients is not None else None
+
+    def clear_nutrition(self):
+        """份量改變後舊的營養數據失效 (狀態保留，直到重新查詢)。"""
+        self.nutrients = None
+
+    def copy(self):
+        """獨立的副本 (營養向量也會複製)；工作結果可能被多個 session 取回，各自修改時不可互相影響。"""
+        return replace(self, nutrients=array("d", self.nutrients) if self.nutrients is not None else None)
+
+    def to_dict(self):
+        """轉為舊的 dict 格式 (JSON 可序列化)。"""
+        item_dict = {
+            "id": self.id,
+            "vision_object_name": self.vision_object_name,
+            "llm_refined_name": self.llm_refined_name,
+            "llm_suggested_grams": self.llm_suggested_grams,
+            "user_grams": self.user_grams,
+            "llm_nutrition_data": self.nutrition_data,
+            "status_name_refinement": self.status_name_refinement.value,
+            "status_portion_suggestion": self.status_portion_suggestion.value,
+            "status_nutrition_fetch": self.status_nutrition_fetch.value,
+            "nutrition_source": self.nutrition_source,
+            "image_key": self.image_key,
+            "image_name": self.image_name,
+        }
+        if self.pending_refinement is not None:
+            item_dict["pending_refinement_input"] = self.pending_refinement._asdict()
+        if self.meal_log_entry_id is not None:
+            item_dict["meal_log_entry_id"] = self.meal_log_entry_id
+        return item_dict
+
+    @classmethod
+    def from_dict(cls, item_dict):
+        """由 to_dict() (或舊版的項目 dict) 還原。"""
+        pending_input = item_dict.get("pending_refinement_input")
+        return cls(
+            id=item_dict.get("id") or "",
+            vision_object_name=item_dict.get("vision_object_name", ""),
+            llm_refined_name=item_dict.get("llm_refined_name", ""),
+            llm_suggested_grams=item_dict.get("llm_suggested_grams"),
+            user_grams=item_dict.get("user_grams"),
+            status_name_refinement=StageStatus.parse(item_dict.get("status_name_refinement")),
+            status_portion_suggestion=StageStatus.parse(item_dict.get("status_portion_suggestion")),
+            status_nutrition_fetch=StageStatus.parse(item_dict.get("status_nutrition_fetch")),
+            nutrients=nutrients_from_dict(item_dict.get("llm_nutrition_data")),
+            nutrition_source=item_dict.get("nutrition_source"),
+            image_key=item_dict.get("image_key"),
+            image_name=item_dict.get("image_name"),
+            pending_refinement=PendingRefinement(**pending_input) if pending_input else None,
+            meal_log_entry_id=item_dict.get("meal_log_entry_id"),
+        )
+
+
+def sum_nutrients(food_items):
+    """
+    加總食物項目的營養向量 (只計入已有營養數據的項目)。
+    Returns:
+        tuple: (各營養素總和的字典, 納入加總的項目數)
+    """
+    totals = [0.0] * len(NUTRIENT_KEYS)
+    valid_items_for_sum = 0
+    for item in food_items:
+        if item.nutrients is None:
+            continue
+        for i, value in enumerate(item.nutrients):
+            totals[i] += value
+        valid_items_for_sum += 1
+    return dict(zip(NUTRIENT_KEYS, totals)), valid_items_for_sum
@@ -0,0 +1,209 @@
+# hedging.py
+# 尾端延遲控制：每個任務有最長等待時間 (deadline)；
+# 若呼叫「執行」超過該任務近期 p95 延遲仍未完成，就再送出一個「對沖 (hedged)」請求，先回來的結果勝出。
+
+import contextvars
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import metrics
+
+
+class HedgeTimeoutError(TimeoutError):
+    """在任務的 deadline 之前，原始請求與對沖請求都沒有完成。"""
+
+
+class LatencyTracker:
+    """記錄每個任務最近 N 次呼叫的延遲 (含未完成呼叫的設限樣本)，用來估計 p95 等百分位數。"""
+
+    def __init__(self, window_size=200):
+        self._lock = threading.Lock()
+        self._samples = defaultdict(lambda: deque(maxlen=window_size))
+
+    def record(self, key, seconds):
+        with self._lock:
+            self._samples[key].append(seconds)
+
+    def percentile(self, key, fraction, min_samples=1):
+        """回傳 key 的延遲百分位數 (fraction 介於 0~1)；樣本數不足時回傳 None。"""
+        with self._lock:
+            samples = sorted(self._samples.get(key, ()))
+        if len(samples) < max(1, min_samples):
+            return None
+        index = min(len(samples) - 1, int(round(fraction * (len(samples) - 1))))
+        return samples[index]
+
+    def sample_count(self, key):
+        with self._lock:
+            return len(self._samples.get(key, ()))
+
+
+class _Attempt:
+    """一次實際呼叫 (原始或對沖)：記錄工作執行緒真正開始執行的時間，排隊的時間不算入延遲與對沖門檻。"""
+
+    def __init__(self, is_hedge):
+        self.is_hedge = is_hedge
+        self.started = threading.Event()
+        self.started_at = None
+        self.finished_at = None
+        self.future = None
+
+    def elapsed(self, now=None):
+        """已執行的秒數 (尚未開始時為 None；尚未結束時為到 now 為止的時間)。"""
+        if self.started_at is None:
+            return None
+        return (self.finished_at or now or time.monotonic()) - self.started_at
+
+
+class HedgedCaller:
+    """
+    以對沖請求控制尾端延遲的呼叫器。
+    - 對沖門檻 = 該任務近期延遲的 p95 (樣本不足時使用 default_hedge_delay)，從原始請求「開始執行」起算，
+      執行緒池忙碌時排隊的時間不會觸發對沖 (否則對沖只會讓已經過載的池子負載加倍)。
+    - 超過門檻仍未完成時，再送出一個相同的請求，先成功完成的結果勝出；
+      每個任務的對沖數不超過呼叫數的 max_hedge_rate (加上 1 次的額度)。
+    - fn 會收到該次呼叫的剩餘時間 (timeout 秒)，應傳給底層 RPC，避免卡住的呼叫永遠佔用工作執行緒。
+    - 延遲估計一律以原始請求為準：沒完成的 (對沖勝出或逾時) 記錄到當時為止已執行的時間 (設限樣本)，
+      因此 p95 不會因為只看到較快的勝出者而越估越低。
+    - 超過 deadline 則拋出 HedgeTimeoutError。
+    """
+
+    def __init__(self, name, max_workers=16, hedge_percentile=0.95, default_hedge_delay=4.0,
+                 min_hedge_delay=0.5, min_samples=20, max_hedge_rate=0.05):
+        self.name = name
+        self.hedge_percentile = hedge_percentile
+        self.default_hedge_delay = default_hedge_delay
+        self.min_hedge_delay = min_hedge_delay
+        self.min_samples = min_samples
+        self.max_hedge_rate = max_hedge_rate
+        self.latency = LatencyTracker()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"{name}-hedge")
+        self._stats_lock = threading.Lock()
+        self._stats = defaultdict(lambda: {"calls": 0, "hedged": 0, "hedge_wins": 0, "hedges_capped": 0, "timeouts": 0})
+
+    def hedge_delay(self, task):
+        """此任務目前的對沖門檻 (秒)。"""
+        p95 = self.latency.percentile(task, self.hedge_percentile, min_samples=self.min_samples)
+        if p95 is None:
+            return self.default_hedge_delay
+        return max(self.min_hedge_delay, p95)
+
+    def _record(self, task, field):
+        with self._stats_lock:
+            self._stats[task][field] += 1
+            task_stats = dict(self._stats[task])
+        metrics.increment(f"{self.name}.{field}.{task}")
+        if task_stats["calls"]:
+            metrics.set_value(f"{self.name}.hedge_rate.{task}", round(task_stats["hedged"] / task_stats["calls"], 4))
+
+    def _take_hedge_budget(self, task):
+        # 對沖數上限：max_hedge_rate x 呼叫數 (+1，讓剛啟動、呼叫數還少時也能對沖一次)
+        with self._stats_lock:
+            task_stats = self._stats[task]
+            allowed = task_stats["hedged"] < self.max_hedge_rate * task_stats["calls"] + 1
+        if allowed:
+            self._record(task, "hedged")
+        else:
+            self._record(task, "hedges_capped")
+        return allowed
+
+    def _submit(self, fn, deadline, is_hedge):
+        attempt = _Attempt(is_hedge)
+
+        def run():
+            attempt.started_at = time.monotonic()
+            attempt.started.set()
+            try:
+                timeout = deadline - attempt.started_at
+                if timeout <= 0: # 在池子裡排隊到截止時間都過了，不必再呼叫
+                    raise HedgeTimeoutError(f"{self.name} 請求排隊超過截止時間")
+                return fn(timeout, is_hedge)
+            finally:
+                attempt.finished_at = time.monotonic()
+
+        # 在呼叫端 context 的副本中執行 (例如 llm_usage 的 token 統計範圍)
+        attempt.future = self._executor.submit(contextvars.copy_context().run, run)
+        return attempt
+
+    def _record_primary_latency(self, task, primary, now):
+        elapsed = primary.elapsed(now)
+        if elapsed is not None:
+            self.latency.record(task, elapsed)
+
+    def call(self, fn, task, deadline_seconds, hedge=True):
+        """
+        執行 fn(timeout, is_hedge)，必要時送出對沖請求。
+        Args:
+            fn (callable): 實際的呼叫，參數為此次呼叫的剩餘時間 (秒，應作為 RPC timeout) 與是否為對沖請求；
+                           失敗時應拋出例外。
+            task (str): 任務名稱，用於分別統計延遲與對沖率。
+            deadline_seconds (float): 最長等待時間 (秒)。
+            hedge (bool): 是否允許對沖 (非冪等或昂貴的呼叫可以關閉)。
+        Returns:
+            fn 的回傳值。
+        Raises:
+            HedgeTimeoutError: 超過 deadline 仍未完成。
+            Exception: 所有請求都失敗時，拋出第一個失敗的例外。
+        """
+        self._record(task, "calls")
+        deadline = time.monotonic() + deadline_seconds
+        primary = self._submit(fn, deadline, is_hedge=False)
+        attempts = {primary.future: primary}
+        pending = set(attempts)
+        hedge_allowed = hedge
+        first_error = None
+
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            if hedge_allowed and primary.started_at is None:
+                # 原始請求還在排隊：等它開始 (或截止)，對沖門檻從開始執行起算
+                primary.started.wait(timeout=remaining)
+                continue
+            wait_seconds = remaining
+            if hedge_allowed:
+                wait_seconds = min(remaining, max(0.0, primary.started_at + self.hedge_delay(task) - time.monotonic()))
+            done, pending = wait(pending, timeout=wait_seconds, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                try:
+                    result = future.result()
+                except Exception as e:
+                    if first_error is None:
+                        first_error = e
+                    continue
+                for other in pending:
+                    other.cancel() # 尚未開始的會被取消；已在執行中的會在自己的 timeout 內結束，結果丟棄
+                self._record_primary_latency(task, primary, time.monotonic())
+                if attempts[future] is not primary:
+                    self._record(task, "hedge_wins")
+                return result
+
+            if not pending: # 所有請求都失敗了 (失敗不會觸發對沖，直接回報錯誤)
+                self._record_primary_latency(task, primary, time.monotonic())
+                raise first_error
+            if not done and hedge_allowed and deadline - time.monotonic() > 0:
+                # 原始請求執行超過 p95 門檻仍未完成：在額度內送出對沖請求
+                hedge_allowed = False
+                if self._take_hedge_budget(task):
+                    hedge_attempt = self._submit(fn, deadline, is_hedge=True)
+                    attempts[hedge_attempt.future] = hedge_attempt
+                    pending.add(hedge_attempt.future)
+
+        for future in pending:
+            future.cancel()
+        self._record_primary_latency(task, primary, time.monotonic()) # 設限樣本：至少花了這麼久
+        self._record(task, "timeouts")
+        raise HedgeTimeoutError(f"{self.name} 任務 '{task}' 超過 {deadline_seconds:.1f} 秒仍未完成")
+
+    def stats(self):
+        """回傳各任務的呼叫數、對沖數、對沖率、逾時數與目前的對沖門檻。"""
+        with self._stats_lock:
+            stats_copy = {task: dict(values) for task, values in self._stats.items()}
+        for task, values in stats_copy.items():
+            values["hedge_rate"] = round(values["hedged"] / values["calls"], 4) if values["calls"] else 0.0
+            values["hedge_delay_seconds"] = round(self.hedge_delay(task), 3)
+        return stats_copy
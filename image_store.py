@@ -0,0 +1,234 @@
+# image_store.py
+
+import hashlib
+import io
+import os
+import threading
+import weakref
+from collections import OrderedDict
+
+import data_paths
+
+# 縮圖需要 Pillow；如果沒有安裝，就退回保存原圖 (功能正常，但省不到記憶體)
+try:
+    from PIL import Image
+except ImportError:
+    print("警告 (image_store.py): Python 套件 'pillow' 尚未安裝，將無法產生縮圖。"
+          "請在終端機中執行 'pip3 install pillow' 指令來安裝。")
+    Image = None
+
+PREVIEW_MAX_SIDE = 512       # 縮圖最長邊的像素
+PREVIEW_JPEG_QUALITY = 80    # 縮圖 JPEG 壓縮品質
+# 磁碟上原圖的總容量上限 (MB)，超過時從最久沒被使用的圖片開始刪除
+DISK_STORE_MAX_BYTES = int(os.getenv("FOODIE_IMAGE_STORE_MAX_MB", "512")) * 1024 * 1024
+
+
+class DiskImageStore:
+    """
+    以內容雜湊 (SHA-256) 作為檔名的原圖磁碟儲存區。
+    相同的圖片只會存一份；總容量超過上限時，依最近使用時間 (LRU) 淘汰舊圖。
+    所有 session 共用同一個實例，因此操作都以 lock 保護。
+    """
+
+    def __init__(self, root_dir, max_bytes=DISK_STORE_MAX_BYTES):
+        self.root_dir = root_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict() # key -> 檔案大小，順序即 LRU 順序 (最舊的在前面)
+        self._total_bytes = 0
+        self._evictions = 0
+        os.makedirs(self.root_dir, exist_ok=True)
+        self._load_existing_files()
+
+    def _path_for(self, key):
+        return os.path.join(self.root_dir, f"{key}.img")
+
+    def _load_existing_files(self):
+        # 程式重啟後，把目錄中既有的檔案依修改時間排回 LRU 順序
+        existing = []
+        for file_name in os.listdir(self.root_dir):
+            if not file_name.endswith(".img"):
+                continue
+            file_path = os.path.join(self.root_dir, file_name)
+            try:
+                file_stat = os.stat(file_path)
+            except OSError:
+                continue
+            existing.append((file_stat.st_mtime, file_name[:-len(".img")], file_stat.st_size))
+        for _, key, size in sorted(existing):
+            self._entries[key] = size
+            self._total_bytes += size
+        with self._lock:
+            self._evict_locked()
+
+    def put(self, image_bytes):
+        """儲存原圖並回傳其內容雜湊 (之後用這個 key 取回)。"""
+        key = hashlib.sha256(image_bytes).hexdigest()
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return key
+            # 先寫到暫存檔再改名，避免其他執行緒讀到寫一半的檔案
+            tmp_path = self._path_for(key) + ".tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(image_bytes)
+            os.replace(tmp_path, self._path_for(key))
+            self._entries[key] = len(image_bytes)
+            self._total_bytes += len(image_bytes)
+            self._evict_locked(keep_key=key)
+        return key
+
+    def get(self, key):
+        """依 key 讀回原圖位元組；如果已被淘汰或不存在則回傳 None。"""
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+        try:
+            with open(self._path_for(key), "rb") as f:
+                return f.read()
+        except OSError as e:
+            print(f"警告 (image_store.py): 讀取原圖 {key} 失敗: {e}")
+            with self._lock:
+                size = self._entries.pop(key, None)
+                if size is not None:
+                    self._total_bytes -= size
+            return None
+
+    def contains(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def _evict_locked(self, keep_key=None):
+        # 呼叫前必須已經持有 self._lock
+        while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+            oldest_key = next(iter(self._entries))
+            if oldest_key == keep_key: # 剛存入的圖片不淘汰
+                break
+            size = self._entries.pop(oldest_key)
+            self._total_bytes -= size
+            self._evictions += 1
+            try:
+                os.remove(self._path_for(oldest_key))
+            except OSError:
+                pass
+
+    def stats(self):
+        with self._lock:
+            return {
+                "file_count": len(self._entries),
+                "total_bytes": self._total_bytes,
+                "max_bytes": self.max_bytes,
+                "evictions": self._evictions,
+            }
+
+
+_disk_store = None
+_disk_store_lock = threading.Lock()
+_session_stores = weakref.WeakSet() # 追蹤所有存活中的 SessionImageStore，用於統計記憶體用量
+
+
+def get_disk_store():
+    """取得全程式共用的 DiskImageStore (第一次呼叫時建立)。"""
+    global _disk_store
+    with _disk_store_lock:
+        if _disk_store is None:
+            _disk_store = DiskImageStore(data_paths.get_data_path("images"))
+        return _disk_store
+
+
+def make_preview(image_bytes, max_side=PREVIEW_MAX_SIDE):
+    """
+    產生縮小後的 JPEG 縮圖，用於在 UI 上顯示。
+    如果 Pillow 不可用或圖片無法解析，就直接回傳原圖。
+    """
+    if Image is None:
+        return image_bytes
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as img:
+            img.thumbnail((max_side, max_side))
+            if img.mode not in ("RGB", "L"):
+                img = img.convert("RGB")
+            output = io.BytesIO()
+            img.save(output, format="JPEG", quality=PREVIEW_JPEG_QUALITY, optimize=True)
+            preview_bytes = output.getvalue()
+        # 極小的原圖壓成 JPEG 反而可能變大，這種情況保留原圖即可
+        return preview_bytes if len(preview_bytes) < len(image_bytes) else image_bytes
+    except Exception as e:
+        print(f"警告 (image_store.py): 產生縮圖失敗，改用原圖: {e}")
+        return image_bytes
+
+
+class SessionImageStore:
+    """
+    每個 Streamlit session 各自一份的圖片儲存。
+    記憶體中只保留縮圖與少量中繼資料，原圖一律交給共用的 DiskImageStore。
+    """
+
+    def __init__(self, disk_store=None):
+        self._disk_store = disk_store or get_disk_store()
+        self._images = OrderedDict() # key -> {"file_name", "preview", "original_size"}
+        _session_stores.add(self)
+
+    def add(self, file_name, image_bytes):
+        """加入一張上傳的圖片，回傳其內容雜湊 key。"""
+        key = self._disk_store.put(image_bytes)
+        if key not in self._images:
+            self._images[key] = {
+                "file_name": file_name,
+                "preview": make_preview(image_bytes),
+                "original_size": len(image_bytes),
+            }
+        return key
+
+    def get_preview(self, key):
+        entry = self._images.get(key)
+        return entry["preview"] if entry else None
+
+    def get_file_name(self, key):
+        entry = self._images.get(key)
+        return entry["file_name"] if entry else None
+
+    def get_original(self, key):
+        """從磁碟讀回原圖；如果原圖已被淘汰則回傳 None (呼叫端應請使用者重新上傳)。"""
+        if key not in self._images:
+            return None
+        return self._disk_store.get(key)
+
+    def remove(self, key):
+        self._images.pop(key, None)
+
+    def clear(self):
+        self._images.clear()
+
+    def keys(self):
+        return list(self._images.keys())
+
+    def memory_bytes(self):
+        return sum(len(entry["preview"]) for entry in self._images.values())
+
+
+def get_memory_stats():
+    """
+    回傳圖片儲存的記憶體與磁碟使用統計：
+    - session_count: 目前存活的 session 數
+    - preview_count / preview_bytes: 所有 session 在記憶體中的縮圖數量與總位元組
+    - original_bytes_offloaded: 若原圖都留在記憶體中會佔用的位元組
+    - disk: DiskImageStore 的統計
+    """
+    stores = list(_session_stores)
+    preview_count = 0
+    preview_bytes = 0
+    original_bytes = 0
+    for store in stores:
+        for entry in list(store._images.values()):
+            preview_count += 1
+            preview_bytes += len(entry["preview"])
+            original_bytes += entry["original_size"]
+    return {
+        "session_count": len(stores),
+        "preview_count": preview_count,
+        "preview_bytes": preview_bytes,
+        "original_bytes_offloaded": original_bytes,
+        "disk": get_disk_store().stats(),
+    }
@@ -0,0 +1,183 @@
+# job_queue.py
+# 程式內的背景工作佇列：耗時的分析以「工作 (job)」送出，由固定數量的工作執行緒執行，
+# Streamlit 的 script 執行緒只需送出工作、取得 job id，之後定時查詢進度即可，不會被整個分析過程卡住。
+# 工作結果保存在記憶體中 (保留一段時間)，使用者重新連線 (新的 session) 時可以用 job id 直接取回結果，不必重跑分析。
+
+import itertools
+import os
+import queue
+import threading
+import time
+import uuid
+
+import metrics
+
+JOB_WORKER_COUNT = int(os.getenv("FOODIE_JOB_WORKERS", "2")) # 同時執行的工作數 (每個分析工作內部還會再平行處理多張圖片)
+MAX_FINISHED_JOBS = 200                  # 最多保留幾個已完成工作的結果
+FINISHED_JOB_TTL_SECONDS = 60 * 60       # 已完成工作的結果保留時間
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_SUCCEEDED = "succeeded"
+JOB_FAILED = "failed"
+FINISHED_STATUSES = (JOB_SUCCEEDED, JOB_FAILED)
+
+
+class Job:
+    """一個背景工作的狀態、進度與結果。進度與狀態由工作執行緒更新，UI 以 snapshot() 讀取。"""
+
+    def __init__(self, job_id, kind, fn, metadata=None):
+        self.id = job_id
+        self.kind = kind
+        self.metadata = metadata or {}
+        self._fn = fn
+        self._lock = threading.Lock()
+        self.status = JOB_QUEUED
+        self.progress_done = 0
+        self.progress_total = None
+        self.progress_message = ""
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    def report_progress(self, done, total=None, message=None):
+        """由工作函式呼叫，回報目前進度 (例如已完成幾張圖片)。"""
+        with self._lock:
+            self.progress_done = done
+            if total is not None:
+                self.progress_total = total
+            if message is not None:
+                self.progress_message = message
+
+    def is_finished(self):
+        with self._lock:
+            return self.status in FINISHED_STATUSES
+
+    def snapshot(self):
+        """回傳目前狀態的副本 (不含結果本身)。"""
+        with self._lock:
+            return {
+                "id": self.id,
+                "kind": self.kind,
+                "status": self.status,
+                "progress_done": self.progress_done,
+                "progress_total": self.progress_total,
+                "progress_message": self.progress_message,
+                "error": self.error,
+                "created_at": self.created_at,
+                "started_at": self.started_at,
+                "finished_at": self.finished_at,
+            }
+
+    def _run(self):
+        with self._lock:
+            self.status = JOB_RUNNING
+            self.started_at = time.time()
+        metrics.increment("jobs.queue_wait_seconds", self.started_at - self.created_at)
+        try:
+            result = self._fn(self)
+        except Exception as e:
+            print(f"錯誤 (job_queue.py): 工作 {self.id} ({self.kind}) 執行失敗: {e}")
+            with self._lock:
+                self.status = JOB_FAILED
+                self.error = str(e)
+                self.finished_at = time.time()
+            metrics.increment(f"jobs.failed.{self.kind}")
+        else:
+            with self._lock:
+                self.result = result
+                self.status = JOB_SUCCEEDED
+                self.finished_at = time.time()
+            metrics.increment(f"jobs.succeeded.{self.kind}")
+        finally:
+            self._fn = None # 釋放工作函式 (及其閉包中的大型物件)
+
+
+class JobQueue:
+    """固定數量工作執行緒的 FIFO 工作佇列。"""
+
+    def __init__(self, worker_count=JOB_WORKER_COUNT, max_finished_jobs=MAX_FINISHED_JOBS,
+                 finished_job_ttl_seconds=FINISHED_JOB_TTL_SECONDS):
+        self.max_finished_jobs = max_finished_jobs
+        self.finished_job_ttl_seconds = finished_job_ttl_seconds
+        self._queue = queue.Queue()
+        self._jobs = {} # job id -> Job (依送出順序)
+        self._jobs_lock = threading.Lock()
+        self._workers = []
+        for worker_number in range(max(1, worker_count)):
+            worker = threading.Thread(target=self._worker_loop, name=f"foodie-job-worker-{worker_number}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    @property
+    def worker_count(self):
+        """工作執行緒數。"""
+        return len(self._workers)
+
+    def submit(self, kind, fn, metadata=None):
+        """
+        送出一個工作。
+        Args:
+            kind (str): 工作類型 (用於統計，例如 "image_analysis")。
+            fn (callable): fn(job) -> 結果；可呼叫 job.report_progress(...) 回報進度，失敗時拋出例外。
+            metadata (dict, 可選): 與工作一起保存的資料 (例如圖片列表)，重新連線時用來還原畫面。
+        Returns:
+            str: job id。
+        """
+        job = Job(uuid.uuid4().hex, kind, fn, metadata)
+        with self._jobs_lock:
+            self._prune_locked()
+            self._jobs[job.id] = job
+        self._queue.put(job)
+        metrics.increment(f"jobs.submitted.{kind}")
+        return job.id
+
+    def get(self, job_id):
+        """取得工作；不存在或已過期時回傳 None。"""
+        if not job_id:
+            return None
+        with self._jobs_lock:
+            return self._jobs.get(job_id)
+
+    def _worker_loop(self):
+        while True:
+            job = self._queue.get()
+            try:
+                job._run()
+            finally:
+                self._queue.task_done()
+
+    def _prune_locked(self):
+        # 移除過期的已完成工作，並限制保留數量 (未完成的工作一律保留)
+        now = time.time()
+        finished_jobs = [job for job in self._jobs.values() if job.is_finished()]
+        expired_ids = {job.id for job in finished_jobs if now - job.finished_at > self.finished_job_ttl_seconds}
+        overflow = len(finished_jobs) - len(expired_ids) - self.max_finished_jobs
+        if overflow > 0:
+            remaining_jobs = (job for job in finished_jobs if job.id not in expired_ids)
+            expired_ids.update(job.id for job in itertools.islice(remaining_jobs, overflow))
+        for job_id in expired_ids:
+            del self._jobs[job_id]
+
+    def stats(self):
+        """回傳各狀態的工作數與佇列長度。"""
+        with self._jobs_lock:
+            status_counts = {status: 0 for status in (JOB_QUEUED, JOB_RUNNING, JOB_SUCCEEDED, JOB_FAILED)}
+            for job in self._jobs.values():
+                status_counts[job.snapshot()["status"]] += 1
+        return {**status_counts, "queue_length": self._queue.qsize(), "worker_count": self.worker_count}
+
+
+_job_queue = None
+_job_queue_lock = threading.Lock()
+
+
+def get_job_queue():
+    """取得全程式共用的工作佇列 (所有 session 共用，第一次呼叫時啟動工作執行緒)。"""
+    global _job_queue
+    with _job_queue_lock:
+        if _job_queue is None:
+            _job_queue = JobQueue()
+        return _job_queue
@@ -0,0 +1,75 @@
+# json_store.py
+# 以單一 JSON 檔保存的小型表格 (份量表、標籤精煉紀錄...) 共用的讀寫方式：
+# - 變更後不立刻寫檔，而是啟動一個計時器，計時器到期時把這段期間的所有變更一次寫入 (最多延遲 save_interval_seconds 秒)；
+# - 程式結束時寫入尚未寫入的變更；
+# - 先寫暫存檔再改名，避免寫到一半時程式中斷造成檔案損毀；
+# - 寫檔時不持有表格本身的鎖，查詢不會被磁碟 I/O 擋住。
+
+import atexit
+import json
+import os
+import threading
+
+DEFAULT_SAVE_INTERVAL_SECONDS = 10.0 # 變更後最多隔幾秒寫入磁碟
+
+
+class DebouncedJsonFile:
+    """
+    批次寫入的 JSON 檔。表格變更資料後呼叫 mark_dirty()；寫檔時呼叫 snapshot() 取得要寫入的內容
+    (snapshot 由表格實作，應在表格自己的鎖內複製資料)。
+    """
+
+    def __init__(self, file_path, snapshot, description="資料表", save_interval_seconds=DEFAULT_SAVE_INTERVAL_SECONDS):
+        self.file_path = file_path
+        self.description = description
+        self.save_interval_seconds = save_interval_seconds
+        self._snapshot = snapshot
+        self._lock = threading.Lock()      # 保護 _dirty 與 _save_timer
+        self._save_lock = threading.Lock() # 同一時間只有一個執行緒寫檔
+        self._dirty = False
+        self._save_timer = None
+        atexit.register(self.flush)
+
+    def load(self):
+        """讀取檔案內容；檔案不存在或損毀時回傳 None。"""
+        if not os.path.exists(self.file_path):
+            return None
+        try:
+            with open(self.file_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            print(f"警告 (json_store.py): 讀取{self.description} {self.file_path} 失敗，將從空表開始: {e}")
+            return None
+
+    def mark_dirty(self):
+        """記錄有尚未寫入的變更；沒有進行中的計時器時啟動一個，這段期間的其他變更一併在到期時寫入。"""
+        with self._lock:
+            self._dirty = True
+            if self._save_timer is None:
+                self._save_timer = threading.Timer(self.save_interval_seconds, self._flush_from_timer)
+                self._save_timer.daemon = True
+                self._save_timer.start()
+
+    def _flush_from_timer(self):
+        with self._lock:
+            self._save_timer = None
+        self.flush()
+
+    def flush(self):
+        """立即寫入尚未寫入的變更 (沒有變更時不做任何事)。"""
+        with self._save_lock:
+            with self._lock:
+                if not self._dirty:
+                    return
+                # 先清除標記再取快照：取快照之後的變更會重新標記，下一次再寫入
+                self._dirty = False
+            content = self._snapshot()
+            try:
+                tmp_path = self.file_path + ".tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(content, f, ensure_ascii=False)
+                os.replace(tmp_path, self.file_path)
+            except OSError as e:
+                print(f"警告 (json_store.py): 寫入{self.description} {self.file_path} 失敗: {e}")
+                with self._lock:
+                    self._dirty = True
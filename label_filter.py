@@ -0,0 +1,174 @@
+# label_filter.py
+# 名稱精煉前的本地標籤過濾：Vision 常回傳 "Tableware"、"Plate"、"Person"、"Bottle" 這類非食物標籤，
+# 每一個都要花一次 refine_food_name_with_llm 往返，結果只是 not_food。這裡在 LLM 之前先本地判斷：
+#   1. 人工整理的詞彙表：常與食物一起出現的非食物 (餐具、家具、人物...) 與廣泛的食物類別 (Food、Fruit...)；
+#   2. 從過去的 LLM 精煉結果學習：同一個標籤多次被判為 not_food / category 時，之後直接略過。
+# 食物類別只有在沒有裁切標籤線索時才略過 (有線索時 LLM 可能依線索判斷出具體食物)。
+# 省下的 LLM 呼叫數記錄在 label_filter.llm_calls_saved 指標。
+# 精煉紀錄以 json_store.DebouncedJsonFile 批次寫入磁碟。
+
+import threading
+
+import data_paths
+import json_store
+import metrics
+
+NON_FOOD_LABELS = frozenset({
+    "tableware", "plate", "bowl", "platter", "saucer", "mug", "coffee cup", "cup", "wine glass", "drinking glass",
+    "bottle", "jug", "pitcher", "teapot", "kettle", "spoon", "fork", "knife", "kitchen knife", "chopsticks", "spatula",
+    "cutting board", "frying pan", "wok", "pressure cooker", "slow cooker", "mixing bowl", "measuring cup",
+    "kitchen & dining room table", "table", "dining table", "coffee table", "chair", "tablecloth", "napkin",
+    "paper towel", "box", "packaged goods", "tin can", "jar", "container", "salt and pepper shakers", "candle", "vase",
+    "flower", "houseplant", "person", "man", "woman", "boy", "girl", "human face", "human hand", "hand", "clothing",
+    "mobile phone", "laptop", "computer keyboard", "book", "poster", "picture frame", "toy", "bag", "handbag",
+    "backpack", "refrigerator", "oven", "microwave oven", "toaster", "blender", "sink", "tap", "window", "door",
+    "building", "car", "cat", "dog", "bird", "animal", "shelf", "countertop", "tray", "basket", "lunchbox", "straw",
+    "lid", "serveware", "drinkware", "kitchen utensil", "cutlery", "dishware", "furniture", "text",
+})
+# 廣泛的食物類別 (與 refine_food_name_with_llm 規則 2 的範例一致)：值為回傳的類別名稱
+FOOD_CATEGORY_LABELS = {
+    "food": "Food", "fast food": "Fast food", "baked goods": "Baked goods", "snack": "Snack", "dessert": "Dessert",
+    "fruit": "Fruit", "vegetable": "Vegetable", "seafood": "Seafood", "dairy product": "Dairy product",
+    "meat": "Meat", "drink": "Drink", "dish": "Dish", "cuisine": "Cuisine", "ingredient": "Ingredient",
+    "produce": "Produce", "meal": "Meal",
+}
+
+LEARNED_STATUSES = ("not_food", "category")
+MIN_OBSERVATIONS_TO_LEARN = 3 # 至少看過幾次 LLM 精煉結果才採用學到的判斷
+MIN_AGREEMENT_TO_LEARN = 0.9  # 其中 not_food (或 category) 至少要佔多少比例
+
+
+def _normalize_label(label):
+    return " ".join(str(label).strip().lower().split())
+
+
+class LabelHistory:
+    """以 JSON 檔保存的「標籤 -> 各精煉結果次數」表 (只記錄 LLM 的結果)。"""
+
+    def __init__(self, file_path, min_observations=MIN_OBSERVATIONS_TO_LEARN, min_agreement=MIN_AGREEMENT_TO_LEARN,
+                 save_interval_seconds=json_store.DEFAULT_SAVE_INTERVAL_SECONDS):
+        self.file_path = file_path
+        self.min_observations = min_observations
+        self.min_agreement = min_agreement
+        self._lock = threading.Lock()
+        self._counts = {} # 正規化標籤 -> {精煉狀態: 次數}
+        self._file = json_store.DebouncedJsonFile(file_path, self._snapshot, description="標籤精煉紀錄",
+                                                  save_interval_seconds=save_interval_seconds)
+        self._load()
+
+    def _load(self):
+        raw_counts = self._file.load()
+        if raw_counts is None:
+            return
+        try:
+            self._counts = {label: {status: int(count) for status, count in status_counts.items()}
+                            for label, status_counts in raw_counts.items()}
+        except (AttributeError, TypeError, ValueError) as e:
+            print(f"警告 (label_filter.py): 標籤精煉紀錄 {self.file_path} 格式錯誤，將從空表開始: {e}")
+            self._counts = {}
+
+    def _snapshot(self):
+        with self._lock:
+            return {label: dict(status_counts) for label, status_counts in self._counts.items()}
+
+    def flush(self):
+        """立即把尚未寫入的紀錄寫入磁碟 (平常由 json_store 的計時器批次寫入)。"""
+        self._file.flush()
+
+    def record(self, label, status):
+        """記錄一次 LLM 精煉結果 (status 為 refine_food_name_with_llm 的狀態；error 不記錄)。"""
+        if not label or status not in ("success", "not_food", "category", "unknown_food"):
+            return
+        key = _normalize_label(label)
+        with self._lock:
+            status_counts = self._counts.setdefault(key, {})
+            status_counts[status] = status_counts.get(status, 0) + 1
+        self._file.mark_dirty()
+
+    def learned_status(self, label):
+        """回傳學到的 "not_food" / "category"；觀察次數不足或結果不一致時回傳 None。"""
+        with self._lock:
+            return self._learned_status_locked(_normalize_label(label))
+
+    def _learned_status_locked(self, key):
+        status_counts = self._counts.get(key)
+        if not status_counts:
+            return None
+        total = sum(status_counts.values())
+        if total < self.min_observations:
+            return None
+        for status in LEARNED_STATUSES:
+            if status_counts.get(status, 0) / total >= self.min_agreement:
+                return status
+        return None
+
+    def stats(self):
+        with self._lock:
+            return {
+                "label_count": len(self._counts),
+                "learned_label_count": sum(1 for key in self._counts if self._learned_status_locked(key)),
+            }
+
+
+_label_history = None
+_label_history_lock = threading.Lock()
+
+
+def get_label_history():
+    """取得全程式共用的標籤精煉紀錄 (第一次呼叫時從磁碟載入)。"""
+    global _label_history
+    with _label_history_lock:
+        if _label_history is None:
+            _label_history = LabelHistory(data_paths.get_data_path("label_history.json"))
+        return _label_history
+
+
+def classify(label, label_hints=None, allow_category=True, count_saved=True):
+    """
+    在 LLM 精煉前本地判斷標籤。回傳非 None 時呼叫端「不」呼叫 LLM。
+    Args:
+        label_hints (list, 可選): 裁切標籤線索；有線索時不以類別略過。
+        allow_category (bool): False 時只判斷 not_food (例如裁切前：類別標籤之後可能被裁切標籤具體化)。
+        count_saved (bool): 是否計入 label_filter.llm_calls_saved。只有這個標籤原本會送到 LLM 時才算省下
+                            (例如標籤查表 label_resolution 已有結果時，呼叫端應傳入 False)。
+    Returns:
+        dict: 與 llm_module.refine_food_name_with_llm 相同格式的 not_food / category 結果
+              (多一個 "source": "label_filter_lexicon" 或 "label_filter_history")；
+        None: 無法判斷，應交給 LLM。
+    """
+    key = _normalize_label(label)
+    if key in NON_FOOD_LABELS:
+        result = {"status": "not_food", "refined_name": label, "source": "label_filter_lexicon"}
+    elif key in FOOD_CATEGORY_LABELS and allow_category and not label_hints:
+        result = {"status": "category", "refined_name": FOOD_CATEGORY_LABELS[key], "original_name": label,
+                  "source": "label_filter_lexicon"}
+    else:
+        learned_status = get_label_history().learned_status(key)
+        if learned_status == "not_food":
+            result = {"status": "not_food", "refined_name": label, "source": "label_filter_history"}
+        elif learned_status == "category" and allow_category and not label_hints:
+            result = {"status": "category", "refined_name": label, "original_name": label,
+                      "source": "label_filter_history"}
+        else:
+            return None
+    if count_saved:
+        record_calls_saved(result["source"])
+    return result
+
+
+def record_calls_saved(source, count=1):
+    metrics.increment("label_filter.llm_calls_saved", count)
+    metrics.increment(f"label_filter.hits.{source}", count)
+
+
+def record_llm_outcome(label, refine_result, label_hints=None):
+    """
+    記錄 LLM 精煉結果供之後學習。有裁切標籤線索時的 category 結果不記錄
+    (那是「線索不足」而非標籤本身的性質)。
+    """
+    if not refine_result:
+        return
+    status = refine_result.get("status")
+    if status == "category" and label_hints:
+        return
+    get_label_history().record(label, status)
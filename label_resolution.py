@@ -0,0 +1,155 @@
+# label_resolution.py
+# Vision 物件偵測的標籤來自一個有限的詞彙表 (數百個類別)，同一個標籤每次精煉的結果都一樣。
+# 這個模組提供：
+#   1. 離線工作：對整個標籤詞彙表跑一次 refine_food_name_with_llm，把結果 (含 category / not_food) 存成查表。
+#   2. 線上查詢：resolve_label() 直接查字典，命中時就不需要呼叫 LLM。
+#
+# 離線建表用法 (需要 .streamlit/secrets.toml 中的 GCP 設定)：
+#   python label_resolution.py                 # 使用預設的 vision_labels.txt
+#   python label_resolution.py my_labels.txt   # 使用自訂的標籤清單
+
+import json
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import data_paths
+import metrics
+
+DEFAULT_LABELS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "vision_labels.txt")
+# 只有這些狀態是「確定的」結果，可以寫入查表；error 之類的暫時性失敗不寫入，下次重建時會再試
+CACHEABLE_STATUSES = {"success", "category", "not_food", "unknown_food"}
+
+_label_table = None
+_label_table_lock = threading.Lock()
+
+
+def _normalize_label(label):
+    return " ".join(str(label).strip().lower().split())
+
+
+def get_label_table_path():
+    return data_paths.get_data_path("label_resolution.json")
+
+
+def load_labels(labels_file=DEFAULT_LABELS_FILE):
+    """讀取標籤清單檔案 (一行一個，忽略空行與 # 註解)，回傳去除重複後的列表。"""
+    labels = []
+    seen = set()
+    with open(labels_file, "r", encoding="utf-8") as f:
+        for line in f:
+            label = line.strip()
+            if not label or label.startswith("#") or _normalize_label(label) in seen:
+                continue
+            seen.add(_normalize_label(label))
+            labels.append(label)
+    return labels
+
+
+def _get_label_table():
+    # 第一次查詢時才從磁碟載入；檔案不存在時使用空表 (所有查詢都會 miss，退回 LLM)
+    global _label_table
+    with _label_table_lock:
+        if _label_table is None:
+            _label_table = {}
+            table_path = get_label_table_path()
+            if os.path.exists(table_path):
+                try:
+                    with open(table_path, "r", encoding="utf-8") as f:
+                        _label_table = json.load(f)
+                except (OSError, json.JSONDecodeError) as e:
+                    print(f"警告 (label_resolution.py): 讀取標籤查表 {table_path} 失敗，將全部改用 LLM 精煉: {e}")
+        return _label_table
+
+
+def reload_label_table():
+    """強制下次查詢時重新從磁碟載入查表 (例如離線工作剛更新完檔案)。"""
+    global _label_table
+    with _label_table_lock:
+        _label_table = None
+
+
+def resolve_label(label):
+    """
+    查詢 Vision 標籤的預先精煉結果。
+    Returns:
+        dict: 與 llm_module.refine_food_name_with_llm 相同格式的結果 (多一個 "source": "label_table")；
+        None: 查表中沒有這個標籤，呼叫端應改用 LLM。
+    """
+    entry = _get_label_table().get(_normalize_label(label))
+    if entry is None:
+        metrics.increment("label_table.misses")
+        return None
+    metrics.increment("label_table.hits")
+    result = {"status": entry["status"], "refined_name": entry["refined_name"], "source": "label_table"}
+    if entry["status"] in ("success", "category"):
+        result["original_name"] = label
+    return result
+
+
+def has_label(label):
+    """查表中是否有這個標籤 (不計入 label_table 指標)。"""
+    return _normalize_label(label) in _get_label_table()
+
+
+def build_label_table(labels, max_workers=4, existing_table=None):
+    """
+    對所有標籤執行 LLM 名稱精煉，回傳查表字典 {正規化標籤: {"status", "refined_name"}}。
+    existing_table 中已有的標籤會略過，因此可以對新增的標籤做增量更新。
+    """
+    import llm_module # 只有離線建表時才需要 Vertex AI
+
+    table = dict(existing_table or {})
+    labels_to_refine = [label for label in labels if _normalize_label(label) not in table]
+    if not labels_to_refine:
+        return table
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        refine_results = list(executor.map(llm_module.refine_food_name_with_llm, labels_to_refine))
+
+    for label, refine_result in zip(labels_to_refine, refine_results):
+        if refine_result and refine_result.get("status") in CACHEABLE_STATUSES:
+            table[_normalize_label(label)] = {
+                "status": refine_result["status"],
+                "refined_name": refine_result["refined_name"],
+            }
+        else:
+            print(f"警告 (label_resolution.py): 標籤 '{label}' 精煉失敗，未寫入查表: {refine_result}")
+    return table
+
+
+def save_label_table(table, table_path=None):
+    table_path = table_path or get_label_table_path()
+    tmp_path = table_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(dict(sorted(table.items())), f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, table_path)
+    reload_label_table()
+
+
+def main(argv):
+    import llm_module
+
+    labels_file = argv[1] if len(argv) > 1 else DEFAULT_LABELS_FILE
+    labels = load_labels(labels_file)
+    print(f"讀取到 {len(labels)} 個標籤 (來源: {labels_file})")
+
+    if not llm_module.initialize_vertex_ai():
+        print("錯誤：Vertex AI 初始化失敗，無法建立標籤查表。請檢查 .streamlit/secrets.toml。")
+        return 1
+
+    existing_table = dict(_get_label_table())
+    table = build_label_table(labels, existing_table=existing_table)
+    save_label_table(table)
+
+    status_counts = {}
+    for entry in table.values():
+        status_counts[entry["status"]] = status_counts.get(entry["status"], 0) + 1
+    print(f"標籤查表已寫入 {get_label_table_path()}：共 {len(table)} 筆 "
+          f"(新增 {len(table) - len(existing_table)} 筆)，狀態分佈: {status_counts}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -2,6 +2,8 @@
 
 import streamlit as st # 主要用於可能的錯誤/警告提示
 
+import cassette # 外部 API 呼叫的錄製 / 重播
+
 # 嘗試載入 google.cloud.language 套件
 try:
     from google.cloud import language_v1 # 或者 language_v2，取決於您想用的版本特性，v1 通常穩定
@@ -21,6 +23,7 @@ except ImportError:
 # Natural Language API 客戶端通常也能自動使用它。
 # 我們假設 vision_api.py 中的 setup_google_credentials() 已經被主程式呼叫過了。
 
+@cassette.recordable("language.analyze_text_entities")
 def analyze_text_entities(list_of_text_strings):
     """
     使用 Google Cloud Natural Language API 分析一組文字字串中的實體。
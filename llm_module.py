@@ -4,13 +4,140 @@ import os
 import vertexai
 from vertexai.generative_models import GenerativeModel, Part, FinishReason # type: ignore
 import vertexai.preview.generative_models as generative_models # type: ignore
+from vertexai.language_models import TextEmbeddingInput, TextEmbeddingModel # type: ignore
+import inspect
 import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from google.oauth2 import service_account # <<< 新增或確認此行
+import hedging # 尾端延遲控制 (deadline + 對沖請求)
+from deadline import cap_seconds, is_expired # 整體分析截止時間 (每次呼叫的等待上限不超過剩餘時間)
+import cassette # 外部 API 呼叫的錄製 / 重播
+import llm_usage # 依任務統計 token 用量與費用
+import metrics
+
+# jsonschema 用於驗證 LLM 回傳的 JSON 結構；未安裝時退回較寬鬆的手動檢查
+try:
+    import jsonschema
+except ImportError:
+    print("警告 (llm_module.py): Python 套件 'jsonschema' 尚未安裝，將無法嚴格驗證 LLM 回傳的 JSON。"
+          "請在終端機中執行 'pip3 install jsonschema' 指令來安裝。")
+    jsonschema = None
 
 # 模組級別變數
 _vertex_ai_initialized = False
 _llm_model = None
-_llm_model_name = "gemini-1.0-pro" # 使用基礎模型名稱，通常會指向最新的穩定版
+_llm_model_name = "gemini-1.5-pro-002" # 需要支援 response_schema 結構化輸出 (gemini-1.0 系列不支援)
+_fast_llm_model_name = "gemini-1.5-flash-002" # 較小、較快的模型：用於簡單的分類與單一數字回答
+_multimodal_model_name = "gemini-1.5-flash-002" # 直接看圖分析需要支援圖片輸入的多模態模型
+_models = {} # 模型名稱 -> 已載入的 GenerativeModel (各任務依路由表共用)
+_models_lock = threading.Lock()
+_embedding_model = None
+_embedding_model_name = "text-multilingual-embedding-002" # 多語言向量模型 (本地食物表為中文名稱，精煉名稱為英文)
+_EMBEDDING_BATCH_SIZE = 100 # 單次 get_embeddings 請求的文字數上限 (API 上限為 250)
+EMBEDDING_BATCH_TIMEOUT_SECONDS = 30.0 # 未指定 timeout 時，每個 get_embeddings 批次的最長等待秒數
+# SDK 的 get_embeddings 沒有 timeout 參數：在這個執行緒池中呼叫並限時等待，逾時的呼叫在背景執行完，結果丟棄
+_embedding_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="embedding")
+
+NUTRITION_KEYS = ["calories_kcal", "protein_g", "fat_g", "carbohydrates_g", "fiber_g"]
+
+# --- 每個 LLM 任務的最長等待時間 (秒) ---
+# 超過該任務近期 p95 延遲仍未回應時，會自動送出第二個 (對沖) 請求，先回來的結果勝出
+LLM_TASK_DEADLINES = {
+    "refine": 8.0,      # 食物名稱精煉
+    "portion": 8.0,     # 典型份量建議
+    "nutrition": 15.0,  # 營養成分估算
+    "multimodal": 30.0, # 多模態圖片分析 (輸入較大、輸出較長)
+}
+DEFAULT_LLM_TASK_DEADLINE = 15.0
+
+# --- 每個 LLM 任務的模型與生成參數 (路由表) ---
+# 名稱精煉是簡單的分類、份量建議只回一個數字，改用較快的模型與較短的輸出上限；營養估算需要較強的模型。
+# 可在 .streamlit/secrets.toml 中以 [LLM_TASK_ROUTES.<任務>] 覆寫任一欄位，例如：
+#   [LLM_TASK_ROUTES.nutrition]
+#   model = "gemini-1.5-flash-002"
+#   max_output_tokens = 512
+DEFAULT_LLM_TASK_ROUTE = {
+    "model": _llm_model_name,
+    "temperature": 0.1, # 溫度較低，回答更具確定性和一致性
+    "top_p": 0.8,
+    "top_k": 20,
+    "max_output_tokens": 1024,
+}
+LLM_TASK_ROUTES = {
+    "refine": {"model": _fast_llm_model_name, "temperature": 0.0, "max_output_tokens": 32},   # 食物名稱或 CATEGORY:/NOT_FOOD
+    "portion": {"model": _fast_llm_model_name, "max_output_tokens": 64},                      # {"grams": 數字}
+    "nutrition": {"model": _llm_model_name, "max_output_tokens": 256},                        # 5 個營養素的 JSON
+    "multimodal": {"model": _multimodal_model_name, "temperature": 0.2, "max_output_tokens": 2048}, # 多個食物項目
+}
+_task_route_overrides = None # 由 st.secrets 讀取的覆寫設定 (第一次使用時載入)
+_llm_hedger = hedging.HedgedCaller("llm", default_hedge_delay=4.0)
+
+# --- 結構化輸出的 response schema (Vertex AI 使用的 OpenAPI 子集格式) ---
+# 模型會依 schema 產生 JSON，不再需要手動去除 ``` 標記或處理格式偏差
+NUTRITION_RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {key: {"type": "number", "nullable": True} for key in NUTRITION_KEYS},
+}
+PORTION_RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {"grams": {"type": "number", "nullable": True}},
+    "required": ["grams"],
+}
+MULTIMODAL_RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "items": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "name": {"type": "string"},
+                    "grams": {"type": "number", "nullable": True},
+                    "nutrition": NUTRITION_RESPONSE_SCHEMA,
+                },
+                "required": ["name", "grams", "nutrition"],
+            },
+        },
+    },
+    "required": ["items"],
+}
+# 不支援 response_schema 的舊模型 (只能靠提示詞要求 JSON 格式，再由驗證器把關)
+_MODELS_WITHOUT_RESPONSE_SCHEMA = ("gemini-1.0",)
+
+
+def _to_json_schema(openapi_schema):
+    """將 Vertex AI 的 OpenAPI 子集 schema 轉成標準 JSON Schema (nullable -> type 加上 "null")，供 jsonschema 驗證。"""
+    json_schema = {}
+    for key, value in openapi_schema.items():
+        if key == "nullable":
+            continue
+        if key == "properties":
+            json_schema[key] = {name: _to_json_schema(sub_schema) for name, sub_schema in value.items()}
+        elif key == "items":
+            json_schema[key] = _to_json_schema(value)
+        else:
+            json_schema[key] = value
+    if openapi_schema.get("nullable"):
+        json_schema["type"] = [openapi_schema["type"], "null"]
+    return json_schema
+
+
+def _compile_validator(openapi_schema):
+    if jsonschema is None:
+        return None
+    json_schema = _to_json_schema(openapi_schema)
+    validator_class = jsonschema.validators.validator_for(json_schema)
+    validator_class.check_schema(json_schema)
+    return validator_class(json_schema)
+
+
+# 模組載入時就預先編譯好驗證器，每次驗證不需重新解析 schema
+_nutrition_validator = _compile_validator(NUTRITION_RESPONSE_SCHEMA)
+_portion_validator = _compile_validator(PORTION_RESPONSE_SCHEMA)
+_multimodal_validator = _compile_validator(MULTIMODAL_RESPONSE_SCHEMA)
 
 # 您需要在 secrets.toml 中設定您的 GCP 專案 ID 和 Vertex AI 的區域
 # 例如：
@@ -28,6 +155,9 @@ def initialize_vertex_ai():
 
     if _vertex_ai_initialized:
         return True
+    if cassette.is_replaying(): # 由 cassette 檔重播，不需要憑證與模型
+        _vertex_ai_initialized = True
+        return True
 
     gcp_project_id_from_secrets = st.secrets.get("GCP_PROJECT_ID")
     gcp_vertex_location_from_secrets = st.secrets.get("GCP_VERTEX_LOCATION")
@@ -66,7 +196,7 @@ def initialize_vertex_ai():
             credentials=credentials  # <<< 明確傳遞憑證物件
         )
 
-        _llm_model = GenerativeModel(_llm_model_name) # _llm_model_name 仍然是 "gemini-1.0-pro-002" 或您選擇的
+        _llm_model = _get_model(_llm_model_name) # 其他任務的模型依路由表在第一次使用時載入
         _vertex_ai_initialized = True
         print(f"DEBUG (llm_module.py): Vertex AI 初始化成功 (使用明確憑證)，已載入模型: '{_llm_model_name}'")
         return True
@@ -85,35 +215,211 @@ def initialize_vertex_ai():
         return False
 # ... (檔案中其他的函式 _generate_llm_response, refine_food_name_with_llm 等保持不變) ...
 
-def _generate_llm_response(prompt_text, task_description="LLM 任務"):
+def _load_model(model_name):
+    return GenerativeModel(model_name)
+
+
+def _get_model(model_name):
+    """取得 (必要時載入) 指定名稱的模型；載入失敗時返回 None。"""
+    with _models_lock:
+        model = _models.get(model_name)
+        if model is None:
+            try:
+                model = _models[model_name] = _load_model(model_name)
+            except Exception as e:
+                print(f"錯誤 (llm_module.py): 載入模型 '{model_name}' 失敗: {e}")
+                return None
+        return model
+
+
+def _load_task_route_overrides():
+    try:
+        overrides = st.secrets.get("LLM_TASK_ROUTES") or {}
+        return {task: dict(task_overrides) for task, task_overrides in overrides.items()}
+    except Exception as e: # 沒有 secrets.toml 或格式錯誤時使用預設路由
+        print(f"警告 (llm_module.py): 無法讀取 LLM_TASK_ROUTES 設定，使用預設路由: {e}")
+        return {}
+
+
+def get_task_route(task):
+    """
+    取得任務的模型與生成參數 (預設值 <- LLM_TASK_ROUTES <- secrets 覆寫)。
+    Returns:
+        dict: {"model", "temperature", "top_p", "top_k", "max_output_tokens"}
+    """
+    global _task_route_overrides
+    if _task_route_overrides is None:
+        _task_route_overrides = _load_task_route_overrides()
+    return {**DEFAULT_LLM_TASK_ROUTE, **LLM_TASK_ROUTES.get(task, {}), **_task_route_overrides.get(task, {})}
+
+
+def get_task_routes():
+    """回傳所有任務目前使用的路由 (供 UI/監控顯示)。"""
+    return {task: get_task_route(task) for task in LLM_TASK_ROUTES}
+
+
+@cassette.recordable("vertex.text_embeddings", timeout_result=None) # 逾時時回傳 None
+def get_text_embeddings(texts, task_type="SEMANTIC_SIMILARITY", timeout=None):
+    """
+    取得一組文字的向量 (embedding)，用於名稱的相似度比對。
+    Args:
+        texts (list): 文字字串列表。
+        task_type (str): Vertex AI 的向量任務類型。
+        timeout (float, 可選): 整個呼叫 (所有批次) 的最長等待秒數；未指定時每個批次最多等 EMBEDDING_BATCH_TIMEOUT_SECONDS 秒。
+    Returns:
+        list: 與 texts 對應的向量列表 (每個向量是 float 列表)，或在錯誤、逾時時返回 None。
+    """
+    global _embedding_model
+    if not texts:
+        return []
+    if not _vertex_ai_initialized:
+        if not initialize_vertex_ai():
+            return None
+    try:
+        if _embedding_model is None:
+            _embedding_model = TextEmbeddingModel.from_pretrained(_embedding_model_name)
+        expires_at = None if timeout is None else time.monotonic() + timeout
+        vectors = []
+        for batch_start in range(0, len(texts), _EMBEDDING_BATCH_SIZE):
+            batch = texts[batch_start:batch_start + _EMBEDDING_BATCH_SIZE]
+            batch_timeout = EMBEDDING_BATCH_TIMEOUT_SECONDS if expires_at is None else expires_at - time.monotonic()
+            if batch_timeout <= 0:
+                raise FutureTimeoutError()
+            future = _embedding_executor.submit(_embedding_model.get_embeddings,
+                                                [TextEmbeddingInput(text, task_type) for text in batch])
+            embeddings = future.result(timeout=batch_timeout)
+            vectors.extend(embedding.values for embedding in embeddings)
+        return vectors
+    except FutureTimeoutError:
+        print(f"錯誤 (llm_module.py): 取得文字向量 (模型 '{_embedding_model_name}') 逾時。")
+        return None
+    except Exception as e:
+        print(f"錯誤 (llm_module.py): 取得文字向量 (模型 '{_embedding_model_name}') 時發生錯誤: {e}")
+        return None
+
+
+def _strip_code_fences(llm_response):
+    """去除 LLM 可能回傳的 markdown JSON 標記 (```json ... ```)。"""
+    if llm_response.startswith("```json"):
+        return llm_response.strip("```json").strip("```").strip()
+    elif llm_response.startswith("```"): # 有些模型可能只用 ```
+        return llm_response.strip("```").strip()
+    return llm_response
+
+
+def _parse_json_response(llm_response, validator):
+    """
+    解析並驗證 LLM 回傳的 JSON。
+    Returns:
+        tuple: (解析後的資料, None) 或 (None, 錯誤訊息)
+    """
+    try:
+        parsed = json.loads(_strip_code_fences(llm_response))
+    except json.JSONDecodeError as e:
+        return None, f"Failed to parse LLM's JSON response. Raw response: '{llm_response}'. Error: {e}"
+    if validator is not None:
+        error = jsonschema.exceptions.best_match(validator.iter_errors(parsed))
+        if error is not None:
+            return None, f"LLM's JSON response does not match the expected schema: {error.message}. Raw response: '{llm_response}'."
+    elif not isinstance(parsed, dict): # 沒有 jsonschema 時至少確認是 JSON 物件
+        return None, f"LLM's JSON response is not an object. Raw response: '{llm_response}'."
+    return parsed, None
+
+
+_timeout_support_by_model_type = {}
+_warned_no_rpc_timeout = False
+
+
+def _generate_content_with_timeout(model, contents, timeout, generation_config=None, safety_settings=None):
+    """
+    呼叫 generate_content，並把 timeout (秒) 傳給底層 RPC：卡住的呼叫會在 timeout 後失敗，不會永遠佔用對沖執行緒池。
+    SDK 的 GenerativeModel.generate_content 沒有 timeout 參數時，改用同一個模型物件的 prediction client
+    (_prepare_request / _parse_response) 直接送出請求；兩者都不支援時才退回不帶 timeout 的呼叫。
+    這些是 SDK 的私有成員，因此 requirements.txt 把 google-cloud-aiplatform 固定在已驗證的版本範圍；
+    退回不帶 timeout 的呼叫時會計入 llm.rpc_timeout_unavailable 指標，升級 SDK 後失去 timeout 時可以從指標發現。
+    """
+    model_type = type(model)
+    if model_type not in _timeout_support_by_model_type:
+        try:
+            accepts_timeout = "timeout" in inspect.signature(model.generate_content).parameters
+        except (TypeError, ValueError):
+            accepts_timeout = False
+        has_prediction_client = all(hasattr(model, attribute) for attribute in
+                                    ("_prediction_client", "_prepare_request", "_parse_response"))
+        _timeout_support_by_model_type[model_type] = ("kwarg" if accepts_timeout else
+                                                      "prediction_client" if has_prediction_client else None)
+    timeout_support = _timeout_support_by_model_type[model_type]
+
+    if timeout_support == "kwarg":
+        return model.generate_content(contents, generation_config=generation_config, safety_settings=safety_settings,
+                                      stream=False, timeout=timeout)
+    if timeout_support == "prediction_client":
+        try:
+            request = model._prepare_request(contents=contents, generation_config=generation_config,
+                                             safety_settings=safety_settings)
+        except (AttributeError, TypeError) as e:
+            # 私有成員的簽名已改變 (SDK 升級)：這個模型類型之後都改用不帶 timeout 的呼叫
+            print(f"警告 (llm_module.py): Vertex AI SDK 的 _prepare_request 無法使用 ({e})。")
+            _timeout_support_by_model_type[model_type] = None
+        else:
+            return model._parse_response(model._prediction_client.generate_content(request=request, timeout=timeout))
+    _warn_no_rpc_timeout()
+    return model.generate_content(contents, generation_config=generation_config, safety_settings=safety_settings,
+                                  stream=False)
+
+
+def _warn_no_rpc_timeout():
+    global _warned_no_rpc_timeout
+    metrics.increment("llm.rpc_timeout_unavailable")
+    if not _warned_no_rpc_timeout:
+        _warned_no_rpc_timeout = True
+        print("警告 (llm_module.py): 目前的 Vertex AI SDK 無法設定 generate_content 的 RPC timeout，"
+              "卡住的呼叫會持續佔用對沖執行緒 (請確認 google-cloud-aiplatform 版本符合 requirements.txt)。")
+
+
+def get_llm_latency_stats():
+    """回傳各 LLM 任務的呼叫數、對沖率、逾時數與目前的對沖門檻 (供 UI/監控顯示)。"""
+    return _llm_hedger.stats()
+
+
+@cassette.recordable("vertex.generate_content", timeout_result=None) # 逾時 (HedgeTimeoutError) 時回傳 None
+def _generate_llm_response(prompt_text, task_description="LLM 任務", response_schema=None, task="default", deadline=None):
     """
     通用的 LLM 回應生成函式。
     Args:
-        prompt_text (str): 要發送給 LLM 的完整提示。
+        prompt_text (str | list): 要發送給 LLM 的完整提示；也可以是內容列表 (例如 [圖片 Part, 文字提示])。
         task_description (str): 用於錯誤訊息中描述當前任務。
+        response_schema (dict, 可選): 要求模型依此 schema 輸出 JSON (response_mime_type="application/json")。
+        task (str): 任務名稱 ("refine" / "portion" / "nutrition" / "multimodal")，
+                    決定使用的模型與生成參數 (get_task_route)、deadline，並分別統計延遲與對沖率。
+        deadline (deadline.Deadline, 可選): 整體截止時間；任務的等待上限不會超過其剩餘時間，已截止時直接返回 None。
     Returns:
         str: LLM 生成的文字回應，或在錯誤時返回 None。
     """
-    global _llm_model
+    if is_expired(deadline):
+        print(f"警告 (llm_module.py): 已超過整體分析截止時間，略過 {task_description}。")
+        return None
     if not _vertex_ai_initialized:
         # print(f"警告 (llm_module.py): Vertex AI 未初始化，無法執行 {task_description}。")
         if not initialize_vertex_ai(): # 嘗試再次初始化
             return None
     
-    if not _llm_model:
-        print(f"錯誤 (llm_module.py): LLM 模型未載入，無法執行 {task_description}。")
+    route = get_task_route(task)
+    model_name = route["model"]
+    model = _get_model(model_name)
+    if not model:
+        print(f"錯誤 (llm_module.py): LLM 模型 '{model_name}' 未載入，無法執行 {task_description}。")
         return None
 
     try:
         # print(f"DEBUG (llm_module.py): Sending prompt for {task_description}:\n{prompt_text}") # 除錯用
         
-        # 設定生成參數，讓回答更穩定、簡潔
-        generation_config = generative_models.GenerationConfig(
-            temperature=0.1, # 溫度較低，回答更具確定性和一致性
-            top_p=0.8,
-            top_k=20,
-            max_output_tokens=1024 # 根據預期回答長度調整，營養成分可能需要多一點
-        )
+        # 依任務設定生成參數 (溫度、輸出長度上限等)，讓回答更穩定、簡潔
+        generation_config_kwargs = {key: value for key, value in route.items() if key != "model"}
+        if response_schema and not model_name.startswith(_MODELS_WITHOUT_RESPONSE_SCHEMA):
+            generation_config_kwargs["response_mime_type"] = "application/json"
+            generation_config_kwargs["response_schema"] = response_schema
+        generation_config = generative_models.GenerationConfig(**generation_config_kwargs)
         
         safety_settings = {
             generative_models.HarmCategory.HARM_CATEGORY_HATE_SPEECH: generative_models.HarmBlockThreshold.BLOCK_ONLY_HIGH,
@@ -122,11 +428,20 @@ def _generate_llm_response(prompt_text, task_description="LLM 任務"):
             generative_models.HarmCategory.HARM_CATEGORY_HARASSMENT: generative_models.HarmBlockThreshold.BLOCK_ONLY_HIGH,
         }
 
-        response = _llm_model.generate_content(
-            [prompt_text],
-            generation_config=generation_config,
-            safety_settings=safety_settings,
-            stream=False,
+        contents = prompt_text if isinstance(prompt_text, list) else [prompt_text]
+
+        def _attempt(timeout, is_hedge):
+            attempt_response = _generate_content_with_timeout(model, contents, timeout,
+                                                              generation_config=generation_config,
+                                                              safety_settings=safety_settings)
+            # 每次請求 (含沒被採用的對沖請求) 都會計費，在請求自己的執行緒中記錄其 token 用量
+            llm_usage.record_response(task, model_name, attempt_response, hedged=is_hedge)
+            return attempt_response
+
+        response = _llm_hedger.call(
+            _attempt,
+            task=task,
+            deadline_seconds=cap_seconds(deadline, LLM_TASK_DEADLINES.get(task, DEFAULT_LLM_TASK_DEADLINE)),
         )
         
         # print(f"DEBUG (llm_module.py): LLM raw response for {task_description}: {response}") # 除錯用
@@ -142,6 +457,9 @@ def _generate_llm_response(prompt_text, task_description="LLM 任務"):
             # print(f"警告 (llm_module.py): LLM ({task_description}) 未回傳有效內容。")
             return None
             
+    except hedging.HedgeTimeoutError as e:
+        print(f"錯誤 (llm_module.py): 呼叫 LLM ({task_description}) 逾時: {e}")
+        return None
     except Exception as e:
         error_message = f"錯誤 (llm_module.py): 呼叫 LLM ({task_description}) 時發生錯誤: {e}"
         # print(f"DEBUG (llm_module.py): Exception during LLM call for {task_description}: {e}")
@@ -150,10 +468,18 @@ def _generate_llm_response(prompt_text, task_description="LLM 任務"):
         return None
 
 
-def refine_food_name_with_llm(object_name_from_vision):
+def refine_food_name_with_llm(object_name_from_vision, label_hints=None, deadline=None):
     """
     使用 LLM 分析 Vision API 偵測到的物件名稱，判斷是否為食物並精煉名稱。
+    label_hints (list, 可選): 該物件裁切圖的標籤偵測結果 (字串列表)，作為判斷具體食物名稱的補充線索。
     """
+    hints_text = ""
+    if label_hints:
+        hints_text = (f"""
+    補充資訊：將該物件從圖片中裁切出來後，標籤偵測系統給出的候選標籤為：{", ".join(label_hints)}。
+    如果物件名稱是廣泛類別，但候選標籤中有明確的具體食物，請以該具體食物作為判斷結果 (依規則 1 回覆)。
+    """)
+
     prompt = f"""
     指令：
     分析以下由圖片辨識系統偵測到的物件名稱："{object_name_from_vision}"。
@@ -164,6 +490,7 @@ def refine_food_name_with_llm(object_name_from_vision):
     2. 如果該物件名稱是一個「廣泛的食物類別」(例如："fruit", "vegetable", "meat", "dessert", "baked goods")，而不是一個可以獨立食用的具體品項，請回覆 "CATEGORY:[該類別的英文名稱]"，例如 "CATEGORY:Fruit"。
     3. 如果該物件名稱明確「不是可食用食物」(例如："plate", "table", "person", "utensil", "hand", "text")，請回覆 "NOT_FOOD"。
     4. 如果根據提供的物件名稱，你「無法明確判斷」它是否為具體食物 (例如："brown object", "round shape")，請回覆 "UNKNOWN_FOOD"。
+    {hints_text}
 
     回答要求：
     - 你的回答只能是上述四種情況之一的結果。
@@ -173,7 +500,8 @@ def refine_food_name_with_llm(object_name_from_vision):
     你的判斷結果：
     """
     
-    llm_response = _generate_llm_response(prompt, task_description=f"食物名稱精煉 for '{object_name_from_vision}'")
+    llm_response = _generate_llm_response(prompt, task_description=f"食物名稱精煉 for '{object_name_from_vision}'", task="refine",
+                                          deadline=deadline)
     
     if llm_response:
         if llm_response == "NOT_FOOD":
@@ -188,7 +516,7 @@ def refine_food_name_with_llm(object_name_from_vision):
     return {"status": "error", "refined_name": object_name_from_vision, "error_message": "LLM response was None or empty"}
 
 
-def get_typical_portion_grams_with_llm(refined_food_name):
+def get_typical_portion_grams_with_llm(refined_food_name, deadline=None):
     """
     使用 LLM 為指定的食物名稱建議一個「典型的單人份食用克數」。
     """
@@ -198,31 +526,37 @@ def get_typical_portion_grams_with_llm(refined_food_name):
     請提供一個「常見的」或「標準的」單人份食用份量，單位是「克 (grams)」。
 
     回答要求：
-    1. 你的回答應該**只有一個數字**，代表克數。例如：150
-    2. 如果你無法為這個食物判斷一個常見的克數，或者它通常不以克為單位衡量 (例如 "water")，請回覆 "UNKNOWN_WEIGHT"。
+    1. 你的回答必須是一個 JSON 物件，格式為 {{"grams": 克數}}，克數是一個數字。例如：{{"grams": 150}}
+    2. 如果你無法為這個食物判斷一個常見的克數，或者它通常不以克為單位衡量 (例如 "water")，請回覆 {{"grams": null}}。
     3. 不要包含任何額外的文字、單位 (如 "g" 或 "克") 或解釋。
 
     食物名稱：「{refined_food_name}」
-    建議的克數 (只需數字)：
+    JSON 格式的建議克數：
     """
-    llm_response = _generate_llm_response(prompt, task_description=f"典型份量克數建議 for '{refined_food_name}'")
+    llm_response = _generate_llm_response(prompt, task_description=f"典型份量克數建議 for '{refined_food_name}'",
+                                          response_schema=PORTION_RESPONSE_SCHEMA, task="portion", deadline=deadline)
 
     if llm_response:
-        if llm_response == "UNKNOWN_WEIGHT":
+        portion_data, error_message = _parse_json_response(llm_response, _portion_validator)
+        if error_message:
+            return {"status": "error", "grams": None, "error_message": error_message}
+        if portion_data.get("grams") is None:
             return {"status": "unknown_weight", "grams": None}
         try:
-            grams = int(float(llm_response.strip())) # 嘗試轉換為浮點數再轉整數，以處理可能的 ".0"
-            if grams > 0:
-                 return {"status": "success", "grams": grams}
-            else: # 克數小於等於0不合理
-                return {"status": "error", "grams": None, "error_message": "LLM returned non-positive gram value."}
-        except ValueError:
-            # print(f"警告 (llm_module.py): LLM 為 '{refined_food_name}' 回傳的份量克數 '{llm_response}' 不是有效數字。")
-            return {"status": "error", "grams": None, "error_message": f"LLM response '{llm_response}' is not a valid number for grams."}
+            if isinstance(portion_data["grams"], bool):
+                raise TypeError("boolean gram value")
+            grams = int(float(portion_data["grams"])) # 轉整數，以處理可能的 ".0" 或數字字串 (沒有 jsonschema 時不會先驗證型別)
+        except (TypeError, ValueError, OverflowError) as e:
+            return {"status": "error", "grams": None,
+                    "error_message": f"LLM returned a non-numeric gram value. Raw response: '{llm_response}'. Error: {e}"}
+        if grams > 0:
+             return {"status": "success", "grams": grams}
+        else: # 克數小於等於0不合理
+            return {"status": "error", "grams": None, "error_message": "LLM returned non-positive gram value."}
     return {"status": "error", "grams": None, "error_message": "LLM response was None or empty for portion weight."}
 
 
-def get_nutrition_from_llm(food_name, grams):
+def get_nutrition_from_llm(food_name, grams, deadline=None):
     """
     使用 LLM 為指定克數的特定食物查詢估計的營養成分。
     """
@@ -256,60 +590,88 @@ def get_nutrition_from_llm(food_name, grams):
     食物：{grams} 克「{food_name}」
     JSON 格式的營養成分：
     """
-    llm_response = _generate_llm_response(prompt, task_description=f"營養成分查詢 for {grams}g of '{food_name}'")
+    llm_response = _generate_llm_response(prompt, task_description=f"營養成分查詢 for {grams}g of '{food_name}'",
+                                          response_schema=NUTRITION_RESPONSE_SCHEMA, task="nutrition", deadline=deadline)
 
     if llm_response:
-        try:
-            # 嘗試去除 LLM 可能回傳的 markdown JSON 標記 (```json ... ```)
-            if llm_response.startswith("```json"):
-                llm_response = llm_response.strip("```json").strip("```").strip()
-            elif llm_response.startswith("```"): # 有些模型可能只用 ```
-                llm_response = llm_response.strip("```").strip()
+        nutrition_data, error_message = _parse_json_response(llm_response, _nutrition_validator)
+        if error_message:
+            return {"status": "error", "data": None, "error_message": error_message}
 
-            # print(f"DEBUG (llm_module.py): Cleaned LLM response for nutrition: '{llm_response}'") # 除錯用
-            
-            if not llm_response: # 如果清理後變空字串
-                 return {"status": "error", "data": None, "error_message": "LLM returned an empty response after cleaning for nutrition."}
-
-            nutrition_data = json.loads(llm_response) # 解析 LLM 回傳的 JSON 字串
-
-            # 基本驗證，確保是字典且至少包含一些預期鍵值 (或為空字典表示找不到)
-            if isinstance(nutrition_data, dict):
-                # 可以再做更細緻的鍵值和型態檢查，但這裡我們先假設 LLM 盡力遵循格式
-                # 如果是空字典，也視為一種有效的「找不到資料」的回應
-                if not nutrition_data: # 如果是空字典 {}
-                    return {"status": "no_data", "data": {}, "message": f"LLM 未能提供 {food_name} 的營養數據。"}
-
-                # 標準化我們期望的鍵值 (可選，但建議)
-                expected_keys = ["calories_kcal", "protein_g", "fat_g", "carbohydrates_g", "fiber_g"]
-                processed_nutrition = {}
-                all_keys_present_and_numeric_or_null = True
-                for key in expected_keys:
-                    value = nutrition_data.get(key)
-                    if value is not None and not isinstance(value, (int, float)):
-                        # print(f"警告 (llm_module.py): 營養素 '{key}' 的值 '{value}' 不是數字，將設為 0。")
-                        processed_nutrition[key] = 0 # 或 None，取決於如何處理無效值
-                        # all_keys_present_and_numeric_or_null = False # 如果嚴格要求所有鍵都必須是數字
-                    elif value is None:
-                         processed_nutrition[key] = 0 # 如果 LLM 回傳 null，我們當作 0
-                    else:
-                        processed_nutrition[key] = value
-                
-                # 如果我們只關心這些鍵，可以只回傳它們
-                # return {"status": "success", "data": processed_nutrition}
-                
-                # 或者回傳 LLM 給的完整字典，讓主程式去挑選
-                return {"status": "success", "data": nutrition_data} # 回傳 LLM 給的原始解析後的字典
-            else:
-                return {"status": "error", "data": None, "error_message": "LLM response for nutrition was not a valid JSON object (dictionary)."}
-
-        except json.JSONDecodeError as e:
-            # print(f"錯誤 (llm_module.py): 解析 LLM 回傳的營養 JSON 時失敗: {e}\n原始回應: '{llm_response}'") # 除錯用
-            return {"status": "error", "data": None, "error_message": f"Failed to parse LLM's nutrition JSON response. Raw response: '{llm_response}'. Error: {e}"}
-        except Exception as e: # 其他可能的錯誤
-            # print(f"錯誤 (llm_module.py): 處理 LLM 營養回應時發生未知錯誤: {e}") # 除錯用
-            return {"status": "error", "data": None, "error_message": f"Unknown error processing LLM nutrition response: {e}"}
+        # 如果是空字典 {}，視為一種有效的「找不到資料」的回應
+        if not nutrition_data:
+            return {"status": "no_data", "data": {}, "message": f"LLM 未能提供 {food_name} 的營養數據。"}
+
+        # 標準化我們期望的鍵值：LLM 回傳 null 的營養素當作 0
+        processed_nutrition = {key: nutrition_data.get(key) or 0 for key in NUTRITION_KEYS}
+        return {"status": "success", "data": processed_nutrition}
 
     return {"status": "error", "data": None, "error_message": "LLM response was None or empty for nutrition."}
 
+
+def analyze_image_with_llm(image_bytes, mime_type="image/jpeg", deadline=None):
+    """
+    直接將圖片交給多模態 Gemini 模型，一次取得圖片中所有食物的名稱、估計克數與營養成分。
+    這是「Vision 物件偵測 + 每個物件 3 次文字 LLM 呼叫」流程的替代方案 (1 次呼叫取代 1 + 3N 次)。
+    Args:
+        image_bytes (bytes): 圖片原始位元組。
+        mime_type (str): 圖片的 MIME 類型 ("image/jpeg" 或 "image/png")。
+        deadline (deadline.Deadline, 可選): 整體分析截止時間。
+    Returns:
+        dict: {"status": "success" | "no_food" | "error", "items": [...]}，
+              每個 item 為 {"name": 英文名稱, "grams": 估計克數, "nutrition": {"calories_kcal", "protein_g", ...}}。
+    """
+    if not image_bytes:
+        return {"status": "error", "items": [], "error_message": "Invalid input: empty image."}
+
+    prompt = """
+    指令：
+    請仔細觀察這張圖片，找出圖片中所有「具體的可食用食物品項」(忽略餐具、桌子、人物、包裝等非食物)。
+    對每一個食物品項，請：
+    1. 給出該食物常見、精確的英文名稱 (例如 "fried rice"，而不是 "food" 或 "dish" 這類籠統名稱)。
+    2. 根據圖片中的實際份量，估計其重量，單位是「克 (grams)」。
+    3. 依照估計的克數，估算其營養成分：熱量 (kcal)、蛋白質 (g)、總脂肪 (g)、總碳水化合物 (g)、膳食纖維 (g)。
+
+    回答要求：
+    1. 你的回答必須是一個**合法的 JSON 物件**，格式為 {"items": [...]}。
+    2. items 中每個元素的鍵必須是："name" (字串)、"grams" (數字)、"nutrition" (物件)。
+    3. nutrition 物件的鍵必須是："calories_kcal", "protein_g", "fat_g", "carbohydrates_g", "fiber_g"，值必須是數字，未知時使用 null。
+    4. 如果圖片中沒有任何食物，請回覆 {"items": []}。
+    5. 不要包含任何 JSON 物件以外的文字或解釋。
+
+    範例回答格式：
+    {"items": [{"name": "fried rice", "grams": 250, "nutrition": {"calories_kcal": 410, "protein_g": 9.5, "fat_g": 12.3, "carbohydrates_g": 62.0, "fiber_g": 2.1}}]}
+    """
+    image_part = Part.from_data(data=image_bytes, mime_type=mime_type)
+    llm_response = _generate_llm_response([image_part, prompt], task_description="多模態圖片營養分析",
+                                          response_schema=MULTIMODAL_RESPONSE_SCHEMA, task="multimodal",
+                                          deadline=deadline)
+
+    if not llm_response:
+        return {"status": "error", "items": [], "error_message": "LLM response was None or empty for multimodal analysis."}
+    parsed_response, error_message = _parse_json_response(llm_response, _multimodal_validator)
+    if error_message:
+        return {"status": "error", "items": [], "error_message": error_message}
+
+    raw_items = parsed_response.get("items")
+    if not isinstance(raw_items, list):
+        return {"status": "error", "items": [], "error_message": "LLM response for multimodal analysis did not contain an 'items' list."}
+
+    items = []
+    for raw_item in raw_items:
+        if not isinstance(raw_item, dict) or not raw_item.get("name"):
+            continue
+        grams = raw_item.get("grams")
+        grams = int(grams) if isinstance(grams, (int, float)) and grams > 0 else None
+        raw_nutrition = raw_item.get("nutrition") if isinstance(raw_item.get("nutrition"), dict) else {}
+        nutrition = {}
+        for key in NUTRITION_KEYS:
+            value = raw_nutrition.get(key)
+            nutrition[key] = value if isinstance(value, (int, float)) else 0 # 未知或非數字當作 0
+        items.append({"name": str(raw_item["name"]).strip(), "grams": grams, "nutrition": nutrition if raw_nutrition else {}})
+
+    if not items:
+        return {"status": "no_food", "items": []}
+    return {"status": "success", "items": items}
+
 # 注意：initialize_vertex_ai() 應該在 app_streamlit.py 啟動時被明確呼叫一次。
@@ -0,0 +1,147 @@
+# llm_usage.py
+# LLM token 與費用統計：_generate_llm_response 的每一次實際請求都從回應的 usage_metadata 讀取 prompt / 輸出 token 數，依任務
+# (refine / portion / nutrition / multimodal) 累計，並同時累計到：
+# - 目前的「分析範圍」(track_usage() 建立，例如每張圖片一個)，讓分析結果附上該圖片的 token 用量；
+# - 每日統計 (本地日期，只保留最近 DAILY_USAGE_RETENTION_DAYS 天，以 get_daily_usage() 讀取)；
+# - metrics 指標 (llm_tokens.* / llm_cost_usd.*，依任務累計；不含日期，指標數量不會隨執行天數增加)，
+#   供 UI 與 HTTP 服務的 /metrics 讀取。
+# 分析範圍以 contextvars 傳遞；把工作交給其他執行緒時，要以 contextvars.copy_context().run 執行才會算到同一個範圍。
+# 對沖呼叫 (hedging) 的兩個請求都會計費：每個請求在自己的執行緒中記錄自己的用量 (沒被採用的也算)，
+# 對沖請求另外計入 hedged_calls 與 llm_tokens.hedged_* 指標，方便看出對沖多花了多少。
+
+import contextvars
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import date
+
+import metrics
+
+# 每百萬 token 的美元價格 (輸入, 輸出)，依 Vertex AI 公開定價估算 (128K 以內的提示)；請依實際帳單更新
+MODEL_PRICES_PER_MILLION_TOKENS = {
+    "gemini-1.5-pro": (1.25, 5.00),
+    "gemini-1.5-flash": (0.075, 0.30),
+    "gemini-1.0-pro": (0.50, 1.50),
+}
+DAILY_USAGE_RETENTION_DAYS = 31
+
+
+def _price_for_model(model_name):
+    for model_prefix, prices in MODEL_PRICES_PER_MILLION_TOKENS.items():
+        if model_name and model_name.startswith(model_prefix):
+            return prices
+    return None
+
+
+def estimate_cost_usd(model_name, prompt_tokens, output_tokens):
+    """估算費用 (美元)；未知的模型回傳 0。"""
+    prices = _price_for_model(model_name)
+    if prices is None:
+        return 0.0
+    return (prompt_tokens * prices[0] + output_tokens * prices[1]) / 1_000_000
+
+
+class TokenUsage:
+    """依任務累計的呼叫數、token 數與估算費用 (多執行緒安全)。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_task = {}
+
+    def add(self, task, prompt_tokens, output_tokens, cost_usd, hedged=False):
+        with self._lock:
+            task_usage = self._by_task.setdefault(task, {"calls": 0, "hedged_calls": 0, "prompt_tokens": 0,
+                                                         "output_tokens": 0, "cost_usd": 0.0})
+            task_usage["calls"] += 1
+            task_usage["hedged_calls"] += int(hedged)
+            task_usage["prompt_tokens"] += prompt_tokens
+            task_usage["output_tokens"] += output_tokens
+            task_usage["cost_usd"] += cost_usd
+
+    def snapshot(self):
+        """回傳 {"by_task": {任務: {...}}, "total": {...}} 的副本。"""
+        with self._lock:
+            by_task = {task: dict(task_usage) for task, task_usage in self._by_task.items()}
+        total = {"calls": 0, "hedged_calls": 0, "prompt_tokens": 0, "output_tokens": 0, "cost_usd": 0.0}
+        for task_usage in by_task.values():
+            for key in total:
+                total[key] += task_usage[key]
+        for task_usage in list(by_task.values()) + [total]:
+            task_usage["cost_usd"] = round(task_usage["cost_usd"], 6)
+        return {"by_task": by_task, "total": total}
+
+
+_current_usage = contextvars.ContextVar("foodie_llm_usage", default=None)
+_daily_usage = OrderedDict() # 日期字串 -> TokenUsage (只保留最近 DAILY_USAGE_RETENTION_DAYS 天)
+_daily_usage_lock = threading.Lock()
+
+
+@contextmanager
+def track_usage(usage=None):
+    """
+    建立一個分析範圍：範圍內 (同一個 context) 的 LLM 呼叫都會累計到 yield 的 TokenUsage (未指定時新建一個)。
+    用法：with llm_usage.track_usage() as usage: ...; usage.snapshot()
+    """
+    usage = usage if usage is not None else TokenUsage()
+    token = _current_usage.set(usage)
+    try:
+        yield usage
+    finally:
+        _current_usage.reset(token)
+
+
+def _get_daily_usage(day):
+    with _daily_usage_lock:
+        usage = _daily_usage.get(day)
+        if usage is None:
+            usage = _daily_usage[day] = TokenUsage()
+            while len(_daily_usage) > DAILY_USAGE_RETENTION_DAYS:
+                _daily_usage.popitem(last=False)
+        return usage
+
+
+def record_response(task, model_name, response, hedged=False):
+    """
+    從 Vertex AI 回應的 usage_metadata 記錄 token 用量 (沒有 usage_metadata 時不記錄)。
+    hedged 為 True 表示這是對沖請求 (不論最後是否被採用都會計費)。
+    """
+    usage_metadata = getattr(response, "usage_metadata", None)
+    if usage_metadata is None:
+        return
+    prompt_tokens = int(getattr(usage_metadata, "prompt_token_count", 0) or 0)
+    output_tokens = int(getattr(usage_metadata, "candidates_token_count", 0) or 0)
+    record(task, model_name, prompt_tokens, output_tokens, hedged=hedged)
+
+
+def record(task, model_name, prompt_tokens, output_tokens, hedged=False):
+    cost_usd = estimate_cost_usd(model_name, prompt_tokens, output_tokens)
+    day = date.today().isoformat()
+
+    _get_daily_usage(day).add(task, prompt_tokens, output_tokens, cost_usd, hedged=hedged)
+    current_usage = _current_usage.get()
+    if current_usage is not None:
+        current_usage.add(task, prompt_tokens, output_tokens, cost_usd, hedged=hedged)
+
+    if hedged:
+        metrics.increment(f"llm_tokens.hedged_prompt.{task}", prompt_tokens)
+        metrics.increment(f"llm_tokens.hedged_output.{task}", output_tokens)
+        metrics.increment(f"llm_cost_usd.hedged.{task}", cost_usd)
+
+    metrics.increment(f"llm_tokens.prompt.{task}", prompt_tokens)
+    metrics.increment(f"llm_tokens.output.{task}", output_tokens)
+    metrics.increment(f"llm_cost_usd.{task}", cost_usd)
+
+
+def record_image_usage(usage_snapshot):
+    """記錄一張圖片的總用量 (llm_tokens.per_image.* 除以 llm_tokens.images 即為每張圖片的平均 token 數)。"""
+    metrics.increment("llm_tokens.images")
+    metrics.increment("llm_tokens.per_image.prompt", usage_snapshot["total"]["prompt_tokens"])
+    metrics.increment("llm_tokens.per_image.output", usage_snapshot["total"]["output_tokens"])
+    metrics.increment("llm_cost_usd.per_image", usage_snapshot["total"]["cost_usd"])
+
+
+def get_daily_usage():
+    """回傳 {日期: TokenUsage.snapshot()} (新到舊)。"""
+    with _daily_usage_lock:
+        daily_items = list(_daily_usage.items())
+    return {day: usage.snapshot() for day, usage in reversed(daily_items)}
@@ -0,0 +1,351 @@
+# load_test.py
+# 同時多人使用的負載測試：以 N 個模擬 session 驅動 App 的完整流程
+#   上傳圖片 -> 送出背景分析工作並輪詢 -> 補完未完成項目 -> 調整份量重新計算營養 -> 加總
+# Vision、Vertex AI、Edamam 換成 fake_backends 的本機假後端 (模擬網路延遲，不連網、不產生費用)，
+# 逐步提高同時 session 數，回報吞吐量、p50/p95/p99 延遲、CPU 使用率與記憶體峰值，並推算單一程序的容量上限。
+#
+# 說明：Streamlit 的測試工具 (AppTest) 無法模擬檔案上傳，因此這裡直接呼叫 App 每次重跑時使用的同一組模組
+# (image_store、job_queue、analysis_pipeline、portion_table、nutrition_providers)，順序與 app_streamlit.py 相同；
+# 不包含 Streamlit 本身重跑腳本與傳送畫面的成本，實際容量會再略低一些。
+#
+# 用法：python load_test.py --levels 1,2,4,8,16,32 --sessions 32 --images 2 --slo-p95 20
+#       python load_test.py --latency-scale 0   # 不模擬網路延遲，只量 App 本身的 CPU 成本
+
+import argparse
+import io
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_LEVELS = "1,2,4,8,16,32"
+DEFAULT_SLO_P95_SECONDS = 20.0
+THROUGHPUT_GAIN_THRESHOLD = 1.05 # 提高同時 session 數後，吞吐量至少要增加 5% 才算「還有餘裕」
+JOB_POLL_SECONDS = 0.1           # 輪詢工作狀態的間隔 (App 的畫面每秒輪詢一次，這裡縮短以免延遲被量化)
+IMAGE_POOL_SIZE = 64
+IMAGE_SIZE = (1280, 960)
+RSS_SAMPLE_SECONDS = 0.05        # 每個層級執行期間取樣記憶體用量的間隔
+
+
+def _percentile(sorted_values, percent):
+    """最近秩 (nearest-rank) 百分位數。"""
+    if not sorted_values:
+        return None
+    rank = max(1, int(round(percent / 100.0 * len(sorted_values) + 0.5)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def _peak_rss_mb():
+    """程序啟動以來的記憶體峰值 (各層級會重複同一個最大值，只作為無法讀取目前用量時的備援)。"""
+    # Linux 的 ru_maxrss 單位是 KB，macOS 是 bytes
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def _current_rss_mb():
+    try:
+        with open("/proc/self/statm") as statm:
+            resident_pages = int(statm.read().split()[1])
+        return resident_pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class RssSampler:
+    """在背景執行緒中定期讀取目前的記憶體用量，記錄一段期間內的最大值 (單一層級的峰值)。"""
+
+    def __init__(self, interval_seconds=RSS_SAMPLE_SECONDS):
+        self.interval_seconds = interval_seconds
+        self.peak_mb = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="load-test-rss-sampler", daemon=True)
+
+    def _sample(self):
+        rss_mb = _current_rss_mb()
+        if rss_mb is not None and (self.peak_mb is None or rss_mb > self.peak_mb):
+            self.peak_mb = rss_mb
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._sample()
+            self._stop.wait(self.interval_seconds)
+
+    def __enter__(self):
+        self._sample()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+
+
+def build_image_pool(count=IMAGE_POOL_SIZE, size=IMAGE_SIZE, seed=0):
+    """事先產生一批內容各不相同的 JPEG (產生圖片的成本不計入測量)。"""
+    from PIL import Image, ImageDraw
+
+    generator = random.Random(seed)
+    pool = []
+    for _ in range(count):
+        image = Image.new("RGB", size, tuple(generator.randrange(256) for _ in range(3)))
+        draw = ImageDraw.Draw(image)
+        for _ in range(40):
+            x, y = generator.randrange(size[0]), generator.randrange(size[1])
+            draw.ellipse((x, y, x + generator.randrange(40, 300), y + generator.randrange(40, 300)),
+                         fill=tuple(generator.randrange(256) for _ in range(3)))
+        output = io.BytesIO()
+        image.save(output, format="JPEG", quality=90)
+        pool.append(output.getvalue())
+    return pool
+
+
+class SessionRunner:
+    """依 app_streamlit.py 的順序執行一個使用者 session 的完整流程。"""
+
+    def __init__(self, job_queue_instance, image_pool, images_per_session, mode, think_seconds=0.0):
+        self.job_queue = job_queue_instance
+        self.image_pool = image_pool
+        self.images_per_session = images_per_session
+        self.mode = mode
+        self.think_seconds = think_seconds
+
+    def run(self, session_number):
+        import analysis_pipeline
+        import image_store
+        import job_queue
+        import portion_table
+
+        stage_seconds = {}
+        started_at = time.perf_counter()
+
+        # 1. 上傳：原圖寫入磁碟快取，session 中只保留縮圖
+        stage_started_at = time.perf_counter()
+        session_images = image_store.SessionImageStore()
+        image_keys = []
+        for i in range(self.images_per_session):
+            image_bytes = self.image_pool[(session_number * self.images_per_session + i) % len(self.image_pool)]
+            image_key = session_images.add(f"session{session_number}_{i}.jpg", image_bytes)
+            if image_key not in image_keys:
+                image_keys.append(image_key)
+        stage_seconds["upload"] = time.perf_counter() - stage_started_at
+
+        # 2. 送出背景分析工作並輪詢，完成後複製項目到 session
+        stage_started_at = time.perf_counter()
+        job_images = [(image_key, session_images.get_file_name(image_key)) for image_key in image_keys]
+        job_id = self.job_queue.submit(
+            "image_analysis",
+            lambda job: analysis_pipeline.analyze_images_concurrently(
+                job_images, load_image_bytes=image_store.get_disk_store().get, mode=self.mode,
+                on_progress=job.report_progress),
+            metadata={"images": job_images, "mode": self.mode},
+        )
+        job = self.job_queue.get(job_id)
+        while not job.is_finished():
+            time.sleep(JOB_POLL_SECONDS)
+        if job.snapshot()["status"] != job_queue.JOB_SUCCEEDED:
+            raise RuntimeError(f"分析工作失敗: {job.snapshot()['error']}")
+        food_items = []
+        for image_key in image_keys:
+            food_items.extend(item.copy() for item in job.result[image_key]["items"])
+        stage_seconds["analyze"] = time.perf_counter() - stage_started_at
+
+        # 3. 補完截止時間內未完成的項目 (使用者按下「完成所有未完成的項目」)
+        stage_started_at = time.perf_counter()
+        pending_items = [item for item in food_items if analysis_pipeline.is_item_pending(item)]
+        if pending_items:
+            analysis_pipeline.complete_pending_items(pending_items)
+        stage_seconds["complete_pending"] = time.perf_counter() - stage_started_at
+
+        if self.think_seconds:
+            time.sleep(self.think_seconds)
+
+        # 4. 調整份量並重新計算營養 (每個項目改成建議克數的 1.5 倍)
+        stage_started_at = time.perf_counter()
+        for item in food_items:
+            if analysis_pipeline.is_item_pending(item):
+                continue
+            item.user_grams = int((item.user_grams or analysis_pipeline.DEFAULT_PORTION_GRAMS) * 1.5)
+            portion_table.get_portion_table().record(item.llm_refined_name, item.user_grams, source="user")
+            nutrition_result = analysis_pipeline.fetch_nutrition(item.llm_refined_name, item.user_grams)
+            item.set_nutrition(nutrition_result["status"], nutrition_result.get("data"), nutrition_result.get("source"))
+        stage_seconds["recalculate"] = time.perf_counter() - stage_started_at
+
+        # 5. 加總
+        analysis_pipeline.sum_nutrition(food_items)
+        return time.perf_counter() - started_at - self.think_seconds, stage_seconds, len(food_items)
+
+
+def run_level(runner, concurrency, session_count, first_session_number):
+    """以 concurrency 個同時 session 執行 session_count 個 session，回傳該層級的統計。"""
+    latencies = []
+    stage_totals = {}
+    item_count = 0
+    errors = []
+    results_lock = threading.Lock()
+
+    def _one_session(session_number):
+        nonlocal item_count
+        try:
+            latency, stage_seconds, items = runner.run(session_number)
+        except Exception as e:
+            with results_lock:
+                errors.append(str(e))
+            return
+        with results_lock:
+            latencies.append(latency)
+            item_count += items
+            for stage, seconds in stage_seconds.items():
+                stage_totals.setdefault(stage, []).append(seconds)
+
+    cpu_started_at = time.process_time()
+    wall_started_at = time.perf_counter()
+    with RssSampler() as rss_sampler, \
+            ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="load-test-session") as executor:
+        list(executor.map(_one_session, range(first_session_number, first_session_number + session_count)))
+    wall_seconds = time.perf_counter() - wall_started_at
+    cpu_seconds = time.process_time() - cpu_started_at
+
+    latencies.sort()
+    return {
+        "concurrency": concurrency,
+        "sessions": session_count,
+        "errors": len(errors),
+        "error_samples": errors[:3],
+        "wall_seconds": round(wall_seconds, 3),
+        "throughput_sessions_per_second": round(len(latencies) / wall_seconds, 3) if wall_seconds else 0.0,
+        "latency_p50_seconds": _round_or_none(_percentile(latencies, 50)),
+        "latency_p95_seconds": _round_or_none(_percentile(latencies, 95)),
+        "latency_p99_seconds": _round_or_none(_percentile(latencies, 99)),
+        "stage_mean_seconds": {stage: round(sum(values) / len(values), 3) for stage, values in stage_totals.items()},
+        "items_per_session": round(item_count / len(latencies), 2) if latencies else 0.0,
+        "cpu_percent_of_one_core": round(100.0 * cpu_seconds / wall_seconds, 1) if wall_seconds else 0.0,
+        "cpu_seconds_per_session": round(cpu_seconds / len(latencies), 4) if latencies else None,
+        # 這個層級執行期間的記憶體峰值；無法讀取目前用量 (非 Linux) 時退回程序啟動以來的峰值
+        "peak_rss_mb": round(rss_sampler.peak_mb if rss_sampler.peak_mb is not None else _peak_rss_mb(), 1),
+        "process_peak_rss_mb": round(_peak_rss_mb(), 1),
+        "current_rss_mb": _round_or_none(_current_rss_mb(), 1),
+    }
+
+
+def _round_or_none(value, digits=3):
+    return None if value is None else round(value, digits)
+
+
+def find_capacity(level_results, slo_p95_seconds):
+    """
+    容量上限：沒有錯誤、p95 延遲在 SLO 之內，且吞吐量比前一個合格層級至少增加 THROUGHPUT_GAIN_THRESHOLD 的最高同時 session 數。
+    吞吐量不再增加代表程序已飽和 (CPU、工作執行緒或 GIL)，再多的使用者只會排隊。
+    """
+    capacity = None
+    for level in level_results:
+        p95 = level["latency_p95_seconds"]
+        if level["errors"] or p95 is None or p95 > slo_p95_seconds:
+            continue
+        if capacity is None or level["throughput_sessions_per_second"] >= capacity["throughput_sessions_per_second"] * THROUGHPUT_GAIN_THRESHOLD:
+            capacity = level
+    return capacity
+
+
+def print_report(level_results, capacity, slo_p95_seconds):
+    header = (f"{'同時':>5} {'session':>8} {'錯誤':>4} {'吞吐量/s':>9} {'p50(s)':>8} {'p95(s)':>8} {'p99(s)':>8} "
+              f"{'CPU%':>7} {'CPU s/次':>9} {'RSS峰值MB':>10}")
+    print(header)
+    print("-" * len(header))
+    for level in level_results:
+        print(f"{level['concurrency']:>5} {level['sessions']:>8} {level['errors']:>4} "
+              f"{level['throughput_sessions_per_second']:>9.2f} {_format_seconds(level['latency_p50_seconds'])} "
+              f"{_format_seconds(level['latency_p95_seconds'])} {_format_seconds(level['latency_p99_seconds'])} "
+              f"{level['cpu_percent_of_one_core']:>7.1f} {(level['cpu_seconds_per_session'] or 0):>9.3f} "
+              f"{level['peak_rss_mb']:>10.1f}")
+        if level["error_samples"]:
+            print(f"      錯誤範例: {level['error_samples'][0]}")
+    print()
+    if capacity is None:
+        print(f"結論：即使只有 {level_results[0]['concurrency']} 個同時 session，p95 延遲也超過 {slo_p95_seconds} 秒 (或發生錯誤)，"
+              f"請先改善單一 session 的延遲。")
+        return
+    print(f"結論：單一程序的容量上限約為 {capacity['concurrency']} 個同時 session "
+          f"(吞吐量 {capacity['throughput_sessions_per_second']:.2f} session/秒，p95 {capacity['latency_p95_seconds']:.2f} 秒 ≤ SLO {slo_p95_seconds} 秒，"
+          f"CPU {capacity['cpu_percent_of_one_core']:.0f}% 單核)。")
+    higher_levels = [level for level in level_results if level["concurrency"] > capacity["concurrency"]]
+    if higher_levels:
+        next_level = higher_levels[0]
+        reason = ("p95 超過 SLO" if (next_level["latency_p95_seconds"] or 0) > slo_p95_seconds
+                  else "發生錯誤" if next_level["errors"] else "吞吐量不再增加 (已飽和)")
+        print(f"      超過此數量時 ({next_level['concurrency']} 個同時 session) {reason}。")
+    else:
+        print("      測試的最高層級仍未飽和，可用更高的 --levels 繼續測試。")
+
+
+def _format_seconds(value):
+    return f"{value:>8.2f}" if value is not None else f"{'-':>8}"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Foodie 同時多人使用負載測試 (使用本機假後端)")
+    parser.add_argument("--levels", default=DEFAULT_LEVELS, help="要測試的同時 session 數，以逗號分隔")
+    parser.add_argument("--sessions", type=int, default=0, help="每個層級執行的 session 數 (預設為同時數的 3 倍，至少 8 個)")
+    parser.add_argument("--images", type=int, default=2, help="每個 session 上傳的圖片數")
+    parser.add_argument("--mode", default="vision_llm", choices=["vision_llm", "multimodal"], help="分析模式")
+    parser.add_argument("--latency-scale", type=float, default=1.0, help="假後端延遲的縮放倍數 (0 代表不模擬延遲)")
+    parser.add_argument("--job-workers", type=int, default=None, help="背景分析工作執行緒數 (預設同 App：FOODIE_JOB_WORKERS 或 2)")
+    parser.add_argument("--think-seconds", type=float, default=0.0, help="分析完成後到調整份量之間的使用者停頓秒數 (不計入延遲)")
+    parser.add_argument("--slo-p95", type=float, default=DEFAULT_SLO_P95_SECONDS, help="判斷容量上限用的 p95 延遲上限 (秒)")
+    parser.add_argument("--data-dir", default=None, help="資料目錄 (預設為暫存目錄，避免影響正式的快取與份量表)")
+    parser.add_argument("--json", dest="json_path", default=None, help="另外把結果寫成 JSON 檔")
+    args = parser.parse_args(argv)
+
+    levels = sorted({int(level) for level in args.levels.split(",") if level.strip()})
+    # 必須在使用任何資料檔案之前設定 (圖片快取、份量表、本地食物索引等都在資料目錄下)
+    os.environ["FOODIE_DATA_DIR"] = args.data_dir or tempfile.mkdtemp(prefix="foodie_load_test_")
+
+    import fake_backends
+    import job_queue
+    import metrics
+
+    fake_backends.install(latency_scale=args.latency_scale)
+    load_test_job_queue = job_queue.JobQueue(worker_count=args.job_workers or job_queue.JOB_WORKER_COUNT)
+    print(f"資料目錄：{os.environ['FOODIE_DATA_DIR']}；背景工作執行緒 {load_test_job_queue.worker_count} 個；"
+          f"假後端延遲倍數 {args.latency_scale}；模式 {args.mode}")
+    print("產生測試圖片...")
+    runner = SessionRunner(load_test_job_queue, build_image_pool(), args.images, args.mode, args.think_seconds)
+
+    # 暖身：建立本地食物索引、載入查表等一次性成本不計入測量
+    runner.run(0)
+    metrics.reset()
+
+    level_results = []
+    next_session_number = 1
+    try:
+        for concurrency in levels:
+            session_count = args.sessions or max(8, concurrency * 3)
+            print(f"測試 {concurrency} 個同時 session ({session_count} 個 session)...")
+            level_results.append(run_level(runner, concurrency, session_count, next_session_number))
+            next_session_number += session_count
+    finally:
+        fake_backends.uninstall()
+
+    capacity = find_capacity(level_results, args.slo_p95)
+    print()
+    print_report(level_results, capacity, args.slo_p95)
+
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as output:
+            json.dump({
+                "settings": {key: value for key, value in vars(args).items() if key != "json_path"},
+                "levels": level_results,
+                "capacity_concurrent_sessions": capacity["concurrency"] if capacity else 0,
+                "metrics": metrics.snapshot(),
+            }, output, ensure_ascii=False, indent=2)
+        print(f"結果已寫入 {args.json_path}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
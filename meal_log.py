@@ -0,0 +1,190 @@
+# meal_log.py
+# 持久化的飲食日誌 (SQLite)：App 與 CLI (nutrition_v5.py) 都會寫入。
+# - meal_entries：每一筆食物紀錄，以 (user_id, logged_at) 建立索引，時間範圍查詢不需掃描全表。
+# - meal_rollups：每日 / 每週 / 每月的營養加總，在新增或刪除紀錄時同步增量更新，
+#   因此即使累積了多年的紀錄，歷史統計也只需讀取少量彙總列。
+
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+
+import data_paths
+
+NUTRIENT_COLUMNS = ["calories_kcal", "protein_g", "fat_g", "carbohydrates_g", "fiber_g"]
+PERIODS = ("day", "week", "month")
+DEFAULT_USER_ID = "default"
+_TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S" # 本地時間；字串排序即時間排序，可直接用於索引範圍查詢
+
+_SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS meal_entries (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id TEXT NOT NULL,
+    logged_at TEXT NOT NULL,
+    food_name TEXT NOT NULL,
+    grams REAL,
+    {", ".join(f"{column} REAL" for column in NUTRIENT_COLUMNS)},
+    source TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_meal_entries_user_time ON meal_entries (user_id, logged_at);
+CREATE INDEX IF NOT EXISTS idx_meal_entries_time ON meal_entries (logged_at);
+
+CREATE TABLE IF NOT EXISTS meal_rollups (
+    user_id TEXT NOT NULL,
+    period TEXT NOT NULL,
+    period_start TEXT NOT NULL,
+    entry_count INTEGER NOT NULL DEFAULT 0,
+    {", ".join(f"{column} REAL NOT NULL DEFAULT 0" for column in NUTRIENT_COLUMNS)},
+    PRIMARY KEY (user_id, period, period_start)
+) WITHOUT ROWID;
+"""
+
+_ROLLUP_UPSERT = f"""
+INSERT INTO meal_rollups (user_id, period, period_start, entry_count, {", ".join(NUTRIENT_COLUMNS)})
+VALUES (?, ?, ?, ?, {", ".join("?" for _ in NUTRIENT_COLUMNS)})
+ON CONFLICT (user_id, period, period_start) DO UPDATE SET
+    entry_count = entry_count + excluded.entry_count,
+    {", ".join(f"{column} = {column} + excluded.{column}" for column in NUTRIENT_COLUMNS)}
+"""
+
+
+def period_start(moment, period):
+    """回傳時間點所屬統計區間的起始日 (YYYY-MM-DD)；週以星期一為起點。"""
+    if period == "day":
+        return moment.strftime("%Y-%m-%d")
+    if period == "week":
+        return (moment - timedelta(days=moment.weekday())).strftime("%Y-%m-%d")
+    if period == "month":
+        return moment.strftime("%Y-%m-01")
+    raise ValueError(f"不支援的統計區間: {period}")
+
+
+def _parse_timestamp(value):
+    if isinstance(value, datetime):
+        return value.replace(microsecond=0)
+    return datetime.strptime(value, _TIMESTAMP_FORMAT)
+
+
+class MealLog:
+    """SQLite 飲食日誌。連線在多個執行緒間共用，寫入以 lock 序列化。"""
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL") # 讀寫可同時進行 (App 與 CLI 同時使用)
+            self._conn.executescript(_SCHEMA)
+            self._conn.commit()
+
+    def _apply_rollups_locked(self, user_id, moment, sign, count, nutrition_values):
+        for period in PERIODS:
+            self._conn.execute(
+                _ROLLUP_UPSERT,
+                (user_id, period, period_start(moment, period), sign * count, *(sign * value for value in nutrition_values)),
+            )
+
+    def add_entries(self, user_id, entries, logged_at=None, source="app"):
+        """
+        新增多筆食物紀錄 (同一個交易中同步更新日/週/月彙總)。
+        Args:
+            user_id (str): 使用者識別。
+            entries (list): 每筆為 {"food_name": 名稱, "grams": 克數, "nutrition": {"calories_kcal": ..., ...}}。
+            logged_at (datetime | str, 可選): 紀錄時間 (本地時間)，預設為現在。
+            source (str): 紀錄來源，例如 "app" 或 "cli"。
+        Returns:
+            list: 新增紀錄的 id 列表。
+        """
+        moment = _parse_timestamp(logged_at or datetime.now())
+        timestamp = moment.strftime(_TIMESTAMP_FORMAT)
+        entry_ids = []
+        with self._lock:
+            try:
+                for entry in entries:
+                    nutrition = entry.get("nutrition") or {}
+                    nutrition_values = [float(nutrition.get(column) or 0) for column in NUTRIENT_COLUMNS]
+                    cursor = self._conn.execute(
+                        f"INSERT INTO meal_entries (user_id, logged_at, food_name, grams, {', '.join(NUTRIENT_COLUMNS)}, source) "
+                        f"VALUES (?, ?, ?, ?, {', '.join('?' for _ in NUTRIENT_COLUMNS)}, ?)",
+                        (user_id, timestamp, entry["food_name"], entry.get("grams"), *nutrition_values, source),
+                    )
+                    entry_ids.append(cursor.lastrowid)
+                    self._apply_rollups_locked(user_id, moment, 1, 1, nutrition_values)
+                self._conn.commit()
+            except Exception:
+                self._conn.rollback()
+                raise
+        return entry_ids
+
+    def delete_entry(self, entry_id):
+        """刪除一筆紀錄並從彙總中扣除；紀錄不存在時回傳 False。"""
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM meal_entries WHERE id = ?", (entry_id,)).fetchone()
+            if row is None:
+                return False
+            try:
+                self._conn.execute("DELETE FROM meal_entries WHERE id = ?", (entry_id,))
+                self._apply_rollups_locked(row["user_id"], _parse_timestamp(row["logged_at"]), -1, 1,
+                                           [row[column] or 0 for column in NUTRIENT_COLUMNS])
+                self._conn.execute("DELETE FROM meal_rollups WHERE user_id = ? AND entry_count <= 0", (row["user_id"],))
+                self._conn.commit()
+            except Exception:
+                self._conn.rollback()
+                raise
+        return True
+
+    def get_entries(self, user_id, start=None, end=None, limit=500):
+        """查詢使用者在 [start, end) 時間範圍內的紀錄 (新到舊)。"""
+        start_text = _parse_timestamp(start).strftime(_TIMESTAMP_FORMAT) if start else "0000-00-00 00:00:00"
+        end_text = _parse_timestamp(end).strftime(_TIMESTAMP_FORMAT) if end else "9999-12-31 23:59:59"
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT * FROM meal_entries WHERE user_id = ? AND logged_at >= ? AND logged_at < ? "
+                "ORDER BY logged_at DESC, id DESC LIMIT ?",
+                (user_id, start_text, end_text, limit),
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def get_aggregates(self, user_id, period="day", start=None, end=None, limit=366):
+        """
+        讀取每日 / 每週 / 每月的營養加總 (新到舊)。
+        start / end 為日期 (datetime 或 "YYYY-MM-DD")，以區間起始日篩選。
+        """
+        if period not in PERIODS:
+            raise ValueError(f"不支援的統計區間: {period}")
+        start_text = start.strftime("%Y-%m-%d") if isinstance(start, datetime) else (start or "0000-00-00")
+        end_text = end.strftime("%Y-%m-%d") if isinstance(end, datetime) else (end or "9999-12-31")
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT period_start, entry_count, {', '.join(NUTRIENT_COLUMNS)} FROM meal_rollups "
+                "WHERE user_id = ? AND period = ? AND period_start >= ? AND period_start <= ? AND entry_count > 0 "
+                "ORDER BY period_start DESC LIMIT ?",
+                (user_id, period, start_text, end_text, limit),
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def rebuild_rollups(self):
+        """由 meal_entries 重新計算所有彙總 (維護用，例如手動修改過資料庫之後)。"""
+        with self._lock:
+            try:
+                self._conn.execute("DELETE FROM meal_rollups")
+                for row in self._conn.execute("SELECT * FROM meal_entries").fetchall():
+                    self._apply_rollups_locked(row["user_id"], _parse_timestamp(row["logged_at"]), 1, 1,
+                                               [row[column] or 0 for column in NUTRIENT_COLUMNS])
+                self._conn.commit()
+            except Exception:
+                self._conn.rollback()
+                raise
+
+
+_meal_log = None
+_meal_log_lock = threading.Lock()
+
+
+def get_meal_log():
+    """取得全程式共用的飲食日誌 (資料庫位於資料目錄下的 meal_log.sqlite3)。"""
+    global _meal_log
+    with _meal_log_lock:
+        if _meal_log is None:
+            _meal_log = MealLog(data_paths.get_data_path("meal_log.sqlite3"))
+        return _meal_log
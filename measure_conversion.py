@@ -0,0 +1,144 @@
+# measure_conversion.py
+# 本機份量換算：Edamam Food Database (/parser) 的結果已包含每 100 克營養，以及每個份量單位 (cup、slice...) 的克數。
+# 指定份量 (例如 "2 cups"、"1 slice") 的營養因此可以直接在本機算出：數量 x 單位克數 -> 克數 -> 按比例換算每 100 克營養。
+# 只有食物資料中找不到的單位，才呼叫 Edamam Nutrition Analysis (/nutrition-details) API。
+# 食物資料優先取自 edamam_module 的快取 (營養來源鏈查詢過的食物都已在快取中)，
+# 所以同一種食物調整份量時不需要任何網路請求。
+
+import edamam_module
+import metrics
+
+# 與食物無關的重量單位 -> 克數
+MASS_UNIT_GRAMS = {
+    "g": 1.0, "gram": 1.0, "grams": 1.0,
+    "kg": 1000.0, "kilogram": 1000.0, "kilograms": 1000.0,
+    "mg": 0.001, "milligram": 0.001, "milligrams": 0.001,
+    "oz": 28.3495, "ounce": 28.3495, "ounces": 28.3495,
+    "lb": 453.592, "lbs": 453.592, "pound": 453.592, "pounds": 453.592,
+}
+
+# get_food_data_with_measures 的每 100 克營養鍵 -> (Edamam 營養代碼, 單位)
+PER_100G_NUTRIENTS = {
+    "calories": ("ENERC_KCAL", "kcal"),
+    "protein": ("PROCNT", "g"),
+    "fat": ("FAT", "g"),
+    "carbs": ("CHOCDF", "g"),
+    "fiber": ("FIBTG", "g"),
+}
+
+# 以 "es" 構成複數的字尾 (例如 "pinches"、"boxes"、"glasses")
+PLURAL_ES_SUFFIXES = ("ses", "xes", "zes", "ches", "shes")
+
+SOURCE_LOCAL = "local_measure"
+SOURCE_EDAMAM = "edamam_nutrition_details"
+
+
+def _normalize_unit(unit_label):
+    return " ".join(unit_label.strip().lower().rstrip(".").split())
+
+
+def _unit_variants(unit_label):
+    """單位的比對候選 (含去掉複數字尾的形式)，例如 "cups" -> {"cups", "cup"}、"pinches" -> {"pinches", "pinch"}。"""
+    unit = _normalize_unit(unit_label)
+    variants = {unit}
+    if unit.endswith("ies") and len(unit) > 4:
+        variants.add(unit[:-3] + "y") # "patties" -> "patty"
+    elif unit.endswith(PLURAL_ES_SUFFIXES) and len(unit) > 3:
+        variants.add(unit[:-2]) # 只有 s/x/z/ch/sh 結尾的字以 "es" 構成複數，"slices" 不能變成 "slic"
+    if unit.endswith("s") and not unit.endswith("ss") and len(unit) > 1:
+        variants.add(unit[:-1])
+    return variants
+
+
+def resolve_grams(food_data, quantity, unit_label):
+    """
+    把「數量 + 單位」換算成克數。
+    重量單位 (g、kg、oz、lb...) 直接換算；其他單位在食物資料的 measures 中以標籤比對 (不分大小寫、單複數)。
+    Returns:
+        float: 克數；無法換算時返回 None。
+    """
+    if not unit_label or quantity is None or quantity <= 0:
+        return None
+    variants = _unit_variants(unit_label)
+    for variant in variants:
+        if variant in MASS_UNIT_GRAMS:
+            return quantity * MASS_UNIT_GRAMS[variant]
+    for measure in (food_data or {}).get("measures") or []:
+        label = measure.get("label")
+        weight = measure.get("weight")
+        if not label or not weight:
+            continue
+        if variants & _unit_variants(label):
+            return quantity * weight
+    return None
+
+
+def calculate_nutrition_for_grams(food_data, grams):
+    """
+    依食物資料的每 100 克營養，算出指定克數的營養。
+    回傳精簡格式同 edamam_module.analyze_nutrition_for_specific_amount (另外加上 "source")；沒有熱量資料時返回 None。
+    """
+    nutrients_per_100g = (food_data or {}).get("nutrients_per_100g") or {}
+    if nutrients_per_100g.get("calories") is None:
+        return None
+    scale = grams / 100.0
+    nutrients = {}
+    for key, (code, unit) in PER_100G_NUTRIENTS.items():
+        value = nutrients_per_100g.get(key)
+        if value is not None:
+            nutrients[code] = [round(value * scale, 2), edamam_module.NUTRIENT_UNITS.index(unit)]
+    return {
+        "calories": round(nutrients_per_100g["calories"] * scale),
+        "total_weight_grams": round(grams, 2),
+        "diet_labels": [],
+        "health_labels": [],
+        "cautions": [],
+        "nutrients": nutrients,
+        "daily_percent": {},
+        "source": SOURCE_LOCAL,
+    }
+
+
+def calculate_nutrition_for_amount(food_data, quantity, unit_label):
+    """在本機算出「數量 + 單位」的營養；單位無法換算或沒有營養資料時返回 None。"""
+    grams = resolve_grams(food_data, quantity, unit_label)
+    if grams is None:
+        return None
+    return calculate_nutrition_for_grams(food_data, grams)
+
+
+def _count_conversion(result):
+    metrics.increment("measure_conversion.local" if result else "measure_conversion.remote")
+    return result
+
+
+def get_nutrition_for_amount(food_name, quantity, unit_label, include_raw=False):
+    """
+    查詢指定份量的營養：能在本機換算就不呼叫 Nutrition Analysis API。
+    食物資料依序取自快取 -> Food Database API (結果會寫入快取，之後調整份量都不必再連網)。
+    回傳格式同 edamam_module.analyze_nutrition_for_specific_amount，另外加上 "source"；失敗時返回 None。
+    include_raw 只對 Nutrition Analysis API 的結果有效 (本機換算沒有原始回應)。
+    """
+    food_data = edamam_module.get_cached_food_data(food_name) or edamam_module.get_food_data_with_measures(food_name)
+    local_result = _count_conversion(calculate_nutrition_for_amount(food_data, quantity, unit_label))
+    if local_result:
+        return local_result
+    remote_result = edamam_module.analyze_nutrition_for_specific_amount(food_name, quantity, unit_label,
+                                                                        include_raw=include_raw)
+    if remote_result:
+        remote_result["source"] = SOURCE_EDAMAM
+    return remote_result
+
+
+async def get_nutrition_for_amount_async(food_name, quantity, unit_label, include_raw=False):
+    """get_nutrition_for_amount 的非同步版本 (使用 edamam_module 的 httpx 用戶端)，回傳格式相同。"""
+    food_data = (edamam_module.get_cached_food_data(food_name) or
+                 await edamam_module.get_food_data_with_measures_async(food_name))
+    local_result = _count_conversion(calculate_nutrition_for_amount(food_data, quantity, unit_label))
+    if local_result:
+        return local_result
+    remote_result = await edamam_module.analyze_nutrition_for_specific_amount_async(food_name, quantity, unit_label,
+                                                                                    include_raw=include_raw)
+    if remote_result:
+        remote_result["source"] = SOURCE_EDAMAM
+    return remote_result
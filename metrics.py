@@ -0,0 +1,46 @@
+# metrics.py
+# 簡單的程式內指標 (metrics) 登錄表：計數器與數值，所有執行緒共用。
+# 各模組用 increment()/set_value() 記錄，UI 或 HTTP 服務用 snapshot() 讀取。
+
+import threading
+from collections import defaultdict
+
+_lock = threading.Lock()
+_counters = defaultdict(float)
+_values = {}
+
+
+def increment(name, amount=1):
+    """將計數器 name 加上 amount。"""
+    with _lock:
+        _counters[name] += amount
+
+
+def set_value(name, value):
+    """設定一個「目前值」型的指標 (例如比率、延遲門檻)。"""
+    with _lock:
+        _values[name] = value
+
+
+def get(name, default=0):
+    with _lock:
+        if name in _counters:
+            return _counters[name]
+        return _values.get(name, default)
+
+
+def snapshot(prefix=None):
+    """回傳所有指標的副本 (可用 prefix 只取某一類)，依名稱排序。"""
+    with _lock:
+        merged = dict(_counters)
+        merged.update(_values)
+    if prefix:
+        merged = {name: value for name, value in merged.items() if name.startswith(prefix)}
+    return dict(sorted(merged.items()))
+
+
+def reset():
+    """清除所有指標 (主要給壓力測試或除錯使用)。"""
+    with _lock:
+        _counters.clear()
+        _values.clear()
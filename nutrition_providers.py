@@ -0,0 +1,457 @@
+# nutrition_providers.py
+# 營養查詢的分層來源鏈：本地食物表 -> Edamam 快取 -> Edamam API -> LLM。
+# 依序詢問每個來源，第一個「成功」回答的來源勝出 (越前面越快、越便宜、越可信)。
+# - 每個來源有自己的斷路器 (circuit breaker)：連續失敗達門檻後暫時跳過，冷卻時間過後放行一次試探呼叫。
+# - 每個來源有自己的單次查詢延遲預算：超過預算就視為失敗並改問下一個來源 (逾時的呼叫會在背景執行完，結果丟棄)。
+#   預算從工作執行緒「開始執行」起算；在執行緒池排隊的時間不計入預算，排隊逾時也不計入斷路器。
+# - Edamam 快取只是記憶體查詢，直接在呼叫端執行緒中執行 (不經過執行緒池)；本地食物表在呼叫端執行緒中只做
+#   名稱完全相同與「查詢向量已快取」的比對，需要呼叫向量 API 時才交給執行緒池 (套用延遲預算)。
+#   需要網路的來源各自有獨立的執行緒池，某個來源卡住時不會拖垮其他來源。
+# - 查詢時可傳入整體分析的 Deadline：每個來源的預算不超過剩餘時間，因截止時間而中斷的來源不計入斷路器。
+# App (analysis_pipeline.fetch_nutrition) 與 CLI (nutrition_v5.py) 共用同一條來源鏈。
+
+import contextvars
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+import food_index
+import metrics
+from deadline import cap_seconds, is_expired
+
+try:
+    from cachetools import TTLCache
+except ImportError:
+    print("警告 (nutrition_providers.py): Python 套件 'cachetools' 尚未安裝，Edamam 查詢結果快取功能停用。"
+          "請在終端機中執行 'pip3 install cachetools' 指令來安裝。")
+    TTLCache = None
+
+NUTRITION_KEYS = ["calories_kcal", "protein_g", "fat_g", "carbohydrates_g", "fiber_g"]
+
+# 斷路器預設值
+BREAKER_FAILURE_THRESHOLD = 3   # 連續失敗幾次後斷路
+BREAKER_COOLDOWN_SECONDS = 30.0 # 斷路後多久放行一次試探呼叫
+
+# 各來源的單次查詢延遲預算 (秒)
+LOCAL_BUDGET_SECONDS = 3.0          # 本地比對需要計算查詢名稱的向量 (第一次查詢該名稱時)
+EDAMAM_CACHE_BUDGET_SECONDS = 0.2
+EDAMAM_API_BUDGET_SECONDS = 5.0
+LLM_BUDGET_SECONDS = 20.0           # 略大於 llm_module 的 nutrition 任務 deadline
+
+EDAMAM_CACHE_MAX_FOODS = 4096
+EDAMAM_CACHE_TTL_SECONDS = 24 * 60 * 60
+
+# 每個網路來源的執行緒數：不小於 analysis_pipeline.STAGE_WORKERS (同時查詢營養的階段數上限)，避免平常就在排隊
+PROVIDER_WORKERS = 32
+MAX_QUEUE_WAIT_SECONDS = 10.0 # 在來源的執行緒池排隊的最長時間 (另受整體截止時間限制)
+
+
+DEFER_TO_EXECUTOR = object() # _lookup_inline 的回傳值：需要網路，改在來源的執行緒池中以 _lookup 查詢
+
+
+class ProviderError(Exception):
+    """來源查詢失敗 (網路錯誤、API 錯誤、回應格式錯誤等)；計入斷路器的失敗次數。"""
+
+
+class CircuitBreaker:
+    """
+    連續失敗計數式斷路器。
+    closed (正常) -> 連續失敗達門檻 -> open (直接跳過) -> 冷卻時間過後 -> half_open (放行一次試探)
+    試探成功回到 closed，失敗則重新 open。
+    """
+
+    def __init__(self, name, failure_threshold=BREAKER_FAILURE_THRESHOLD, cooldown_seconds=BREAKER_COOLDOWN_SECONDS):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.cooldown_seconds = cooldown_seconds
+        self._lock = threading.Lock()
+        self._state = "closed"
+        self._consecutive_failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._state == "open" and time.monotonic() - self._opened_at >= self.cooldown_seconds:
+                return "half_open"
+            return self._state
+
+    def allow_request(self):
+        """回傳此時是否可以呼叫該來源；斷路中 (或已有一個試探呼叫進行中) 時回傳 False。"""
+        with self._lock:
+            if self._state == "closed":
+                return True
+            if self._state == "open" and time.monotonic() - self._opened_at < self.cooldown_seconds:
+                return False
+            if self._trial_in_flight:
+                return False
+            self._state = "half_open"
+            self._trial_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._state = "closed"
+            self._consecutive_failures = 0
+            self._trial_in_flight = False
+
+    def release_trial(self):
+        """試探呼叫沒有結果 (例如被整體截止時間中斷)：不改變狀態，只讓下一個呼叫可以再試探。"""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._consecutive_failures += 1
+            self._trial_in_flight = False
+            if self._state == "half_open" or self._consecutive_failures >= self.failure_threshold:
+                if self._state != "open":
+                    metrics.increment(f"nutrition_provider.breaker_opened.{self.name}")
+                self._state = "open"
+                self._opened_at = time.monotonic()
+
+    def stats(self):
+        state = self.state
+        with self._lock:
+            return {"state": state, "consecutive_failures": self._consecutive_failures}
+
+
+def scale_per_100g(nutrients_per_100g, grams):
+    """每 100 克營養 -> 指定克數的營養 (NUTRITION_KEYS，缺少的營養素為 0)。"""
+    scale = grams / 100.0
+    return {key: round(float(nutrients_per_100g.get(key) or 0) * scale, 2) for key in NUTRITION_KEYS}
+
+
+class NutritionProvider:
+    """
+    營養來源的共同介面。子類別實作 _lookup(food_name, grams, deadline=None)：
+    - 回傳 dict ({"status": "success", "data": {...}, ...})：查到了。
+    - 回傳 None：這個來源沒有這種食物 (不算失敗，繼續問下一個來源)。
+    - 拋出 ProviderError (或其他例外)：來源故障，計入斷路器。
+    """
+
+    name = "provider"
+    run_inline = False # True：查詢只讀記憶體，整個 _lookup 直接在呼叫端執行緒執行 (不套用延遲預算)
+
+    def __init__(self, budget_seconds, breaker=None):
+        self.budget_seconds = budget_seconds
+        self.breaker = breaker or CircuitBreaker(self.name)
+        self.executor = None if self.run_inline else ThreadPoolExecutor(max_workers=PROVIDER_WORKERS,
+                                                                          thread_name_prefix=f"nutrition-{self.name}")
+
+    def is_available(self):
+        """來源是否可以使用 (例如憑證是否已設定)；不可用的來源會被直接略過，不計入斷路器。"""
+        return True
+
+    def _lookup(self, food_name, grams, deadline=None):
+        raise NotImplementedError
+
+    def _lookup_inline(self, food_name, grams):
+        """
+        run_inline 為 False 的來源可以覆寫：先在呼叫端執行緒嘗試不需網路的快速查詢 (回傳值同 _lookup)；
+        回傳 DEFER_TO_EXECUTOR 時改在執行緒池中以 _lookup 查詢。
+        """
+        return DEFER_TO_EXECUTOR
+
+
+class LocalStoreProvider(NutritionProvider):
+    """本地食物表 (foods.csv)：名稱完全相同時直接使用，否則以向量相似度比對 (food_index)。"""
+
+    name = "local"
+
+    def __init__(self, budget_seconds=LOCAL_BUDGET_SECONDS, csv_path=food_index.DEFAULT_FOODS_CSV):
+        super().__init__(budget_seconds)
+        self.csv_path = csv_path
+        self._foods_by_name = None
+        self._foods_lock = threading.Lock()
+
+    def _exact_match(self, food_name):
+        with self._foods_lock:
+            if self._foods_by_name is None:
+                self._foods_by_name = {food["name"].strip().lower(): food
+                                       for food in food_index.load_local_foods(self.csv_path)}
+            return self._foods_by_name.get(food_name.strip().lower())
+
+    def _exact_match_result(self, food_name, grams):
+        matched_food = self._exact_match(food_name)
+        if matched_food is None:
+            return None
+        return {"status": "success", "data": scale_per_100g(matched_food["nutrients_per_100g"], grams),
+                "matched_name": matched_food["name"], "similarity": 1.0}
+
+    def _lookup_inline(self, food_name, grams):
+        # 名稱完全相同、向量索引尚未就緒 (food_index 在背景建立，不會等待)、或查詢向量已快取時都不需要網路
+        exact_result = self._exact_match_result(food_name, grams)
+        if exact_result is not None:
+            return exact_result
+        if food_index.get_food_index(self.csv_path) is None:
+            return None
+        if not food_index.has_cached_query_vector(food_name):
+            return DEFER_TO_EXECUTOR # 第一次查詢這個名稱：要呼叫向量 API
+        return food_index.get_local_nutrition(food_name, grams, csv_path=self.csv_path, cached_only=True)
+
+    def _lookup(self, food_name, grams, deadline=None):
+        exact_result = self._exact_match_result(food_name, grams)
+        if exact_result is not None:
+            return exact_result
+        return food_index.get_local_nutrition(food_name, grams, csv_path=self.csv_path,
+                                              timeout=cap_seconds(deadline, self.budget_seconds))
+
+
+class EdamamNutritionCache:
+    """Edamam 查詢結果的 TTL 快取：正規化食物名稱 -> 每 100 克營養 (查無此食物時存 NOT_FOUND)。"""
+
+    NOT_FOUND = "not_found"
+
+    def __init__(self, max_foods=EDAMAM_CACHE_MAX_FOODS, ttl_seconds=EDAMAM_CACHE_TTL_SECONDS):
+        self._lock = threading.Lock()
+        self._cache = TTLCache(maxsize=max_foods, ttl=ttl_seconds) if TTLCache is not None else None
+
+    @staticmethod
+    def _key(food_name):
+        return " ".join(food_name.strip().lower().split())
+
+    def get(self, food_name):
+        if self._cache is None:
+            return None
+        with self._lock:
+            return self._cache.get(self._key(food_name))
+
+    def put(self, food_name, nutrients_per_100g):
+        if self._cache is None:
+            return
+        with self._lock:
+            self._cache[self._key(food_name)] = nutrients_per_100g
+
+    def size(self):
+        if self._cache is None:
+            return 0
+        with self._lock:
+            return len(self._cache)
+
+
+class EdamamCacheProvider(NutritionProvider):
+    """只讀 Edamam 快取，不發出網路請求。"""
+
+    name = "edamam_cache"
+    run_inline = True
+
+    def __init__(self, cache, budget_seconds=EDAMAM_CACHE_BUDGET_SECONDS):
+        super().__init__(budget_seconds)
+        self.cache = cache
+
+    def _lookup(self, food_name, grams, deadline=None):
+        nutrients_per_100g = self.cache.get(food_name)
+        if nutrients_per_100g is None or nutrients_per_100g == EdamamNutritionCache.NOT_FOUND:
+            return None
+        return {"status": "success", "data": scale_per_100g(nutrients_per_100g, grams)}
+
+
+class EdamamApiProvider(NutritionProvider):
+    """Edamam Food Database API：取得每 100 克營養後換算成指定克數，並寫入 Edamam 快取。"""
+
+    name = "edamam"
+
+    def __init__(self, cache, budget_seconds=EDAMAM_API_BUDGET_SECONDS):
+        super().__init__(budget_seconds)
+        self.cache = cache
+
+    def is_available(self):
+        import edamam_module
+        return edamam_module.load_edamam_credentials()
+
+    def _lookup(self, food_name, grams, deadline=None):
+        import edamam_module
+
+        if self.cache.get(food_name) == EdamamNutritionCache.NOT_FOUND:
+            return None # 最近才查過、Edamam 沒有這種食物
+        try:
+            food_data = edamam_module.get_food_data_with_measures(food_name, raise_on_error=True)
+        except Exception as e:
+            raise ProviderError(f"Edamam 查詢失敗: {e}") from e
+        nutrients = (food_data or {}).get("nutrients_per_100g")
+        if not nutrients or nutrients.get("calories") is None:
+            self.cache.put(food_name, EdamamNutritionCache.NOT_FOUND)
+            return None
+        nutrients_per_100g = {
+            "calories_kcal": nutrients.get("calories"),
+            "protein_g": nutrients.get("protein"),
+            "fat_g": nutrients.get("fat"),
+            "carbohydrates_g": nutrients.get("carbs"),
+            "fiber_g": nutrients.get("fiber"),
+        }
+        self.cache.put(food_name, nutrients_per_100g)
+        return {"status": "success", "data": scale_per_100g(nutrients_per_100g, grams),
+                "matched_name": food_data.get("label")}
+
+
+class LLMProvider(NutritionProvider):
+    """LLM 估算 (最慢、最貴，作為最後的備援)。"""
+
+    name = "llm"
+
+    def __init__(self, budget_seconds=LLM_BUDGET_SECONDS):
+        super().__init__(budget_seconds)
+
+    def is_available(self):
+        import llm_module
+        return llm_module.initialize_vertex_ai()
+
+    def _lookup(self, food_name, grams, deadline=None):
+        import llm_module
+
+        llm_result = llm_module.get_nutrition_from_llm(food_name, grams, deadline=deadline)
+        if not llm_result or llm_result["status"] == "error":
+            raise ProviderError((llm_result or {}).get("error_message", "LLM 未返回結果"))
+        if llm_result["status"] == "no_data":
+            return None
+        return llm_result
+
+
+class NutritionProviderChain:
+    """依序詢問多個營養來源，回傳第一個成功的結果。"""
+
+    def __init__(self, providers):
+        self.providers = list(providers)
+
+    def lookup(self, food_name, grams, deadline=None):
+        """
+        查詢指定克數食物的營養。
+        Args:
+            deadline (deadline.Deadline, 可選): 整體截止時間；截止後不再詢問後面的來源。
+        Returns:
+            dict: 與 llm_module.get_nutrition_from_llm 相同格式的結果，另外包含
+                  "source" (回答的來源名稱) 與 "provider_attempts" ([(來源, 結果, 毫秒), ...]，供除錯顯示)。
+                  所有來源都沒有資料時 status 為 "no_data"；因截止時間而沒有問完時為 "timeout"；
+                  全部失敗或被略過時為 "error"。
+        """
+        if not food_name or not isinstance(grams, (int, float)) or grams <= 0:
+            return {"status": "error", "data": None, "error_message": "Invalid input for food_name or grams."}
+
+        attempts = []
+        any_answered = False # 至少有一個來源正常回應 (即使沒有資料)
+        for provider in self.providers:
+            outcome, result, elapsed = self._try_provider(provider, food_name, grams, deadline)
+            attempts.append((provider.name, outcome, round(elapsed * 1000)))
+            metrics.increment(f"nutrition_provider.{outcome}.{provider.name}")
+            if outcome == "hit":
+                result = dict(result)
+                result["source"] = provider.name
+                result["provider_attempts"] = attempts
+                return result
+            if outcome == "miss":
+                any_answered = True
+
+        if any(outcome == "deadline" for _, outcome, _ in attempts):
+            return {"status": "timeout", "data": None, "source": None, "provider_attempts": attempts,
+                    "error_message": f"超過整體截止時間，尚未查到 {food_name} 的營養數據。"}
+        if any_answered:
+            return {"status": "no_data", "data": {}, "source": None, "provider_attempts": attempts,
+                    "message": f"所有營養來源都查不到 {food_name} 的營養數據。"}
+        return {"status": "error", "data": None, "source": None, "provider_attempts": attempts,
+                "error_message": f"所有營養來源都無法使用或查詢失敗: {attempts}"}
+
+    def _try_provider(self, provider, food_name, grams, deadline=None):
+        """回傳 (結果類型, 結果, 耗時秒數)；結果類型為 hit / miss / failure / timeout / queued / deadline / skipped / unavailable。"""
+        start = time.monotonic()
+        if is_expired(deadline):
+            return "deadline", None, 0.0
+        try:
+            if not provider.is_available():
+                return "unavailable", None, time.monotonic() - start
+        except Exception:
+            return "unavailable", None, time.monotonic() - start
+        if not provider.breaker.allow_request():
+            return "skipped", None, time.monotonic() - start
+
+        try:
+            if provider.run_inline:
+                result = provider._lookup(food_name, grams, deadline)
+            else:
+                result = provider._lookup_inline(food_name, grams)
+        except Exception as e:
+            print(f"警告 (nutrition_providers.py): 營養來源 '{provider.name}' 查詢 '{food_name}' 失敗: {e}")
+            provider.breaker.record_failure()
+            return "failure", None, time.monotonic() - start
+        if result is DEFER_TO_EXECUTOR:
+            outcome, result = self._run_in_executor(provider, food_name, grams, deadline)
+            if outcome is not None:
+                return outcome, None, time.monotonic() - start
+
+        provider.breaker.record_success()
+        if result and result.get("status") == "success":
+            return "hit", result, time.monotonic() - start
+        return "miss", None, time.monotonic() - start
+
+    @staticmethod
+    def _run_in_executor(provider, food_name, grams, deadline=None):
+        """
+        在來源的執行緒池中查詢。回傳 (None, 結果)；查詢沒有完成時回傳 (結果類型, None)，
+        結果類型為 queued (排隊逾時，不計入斷路器) / deadline / timeout / failure。
+        """
+        started = threading.Event()
+
+        def run():
+            started.set()
+            return provider._lookup(food_name, grams, deadline)
+
+        # 在呼叫端 context 的副本中執行，LLM 來源的 token 用量才會算進目前的分析 (llm_usage.track_usage())
+        future = provider.executor.submit(contextvars.copy_context().run, run)
+        if not started.wait(timeout=cap_seconds(deadline, MAX_QUEUE_WAIT_SECONDS)):
+            future.cancel()
+            # 還沒開始執行就放棄：與來源本身是否正常無關，放回試探名額但不計入失敗
+            provider.breaker.release_trial()
+            return ("deadline" if is_expired(deadline) else "queued"), None
+
+        budget_seconds = cap_seconds(deadline, provider.budget_seconds) # 從開始執行起算
+        try:
+            return None, future.result(timeout=budget_seconds)
+        except FutureTimeoutError:
+            if budget_seconds < provider.budget_seconds:
+                # 是整體截止時間先到，不代表來源本身有問題；放回試探名額但不計入失敗
+                provider.breaker.release_trial()
+                return "deadline", None
+            provider.breaker.record_failure() # 已在執行中的呼叫無法中斷，其結果會被丟棄
+            return "timeout", None
+        except Exception as e:
+            print(f"警告 (nutrition_providers.py): 營養來源 '{provider.name}' 查詢 '{food_name}' 失敗: {e}")
+            provider.breaker.record_failure()
+            return "failure", None
+
+    def stats(self):
+        """回傳各來源的斷路器狀態、延遲預算與命中 / 失敗次數。"""
+        provider_stats = {}
+        for provider in self.providers:
+            provider_stats[provider.name] = {
+                **provider.breaker.stats(),
+                "budget_seconds": provider.budget_seconds,
+                **{outcome: int(metrics.get(f"nutrition_provider.{outcome}.{provider.name}"))
+                   for outcome in ("hit", "miss", "failure", "timeout", "queued", "deadline", "skipped")},
+            }
+        return provider_stats
+
+
+def build_default_chain():
+    """建立預設來源鏈：本地食物表 -> Edamam 快取 -> Edamam API -> LLM。"""
+    edamam_cache = EdamamNutritionCache()
+    return NutritionProviderChain([
+        LocalStoreProvider(),
+        EdamamCacheProvider(edamam_cache),
+        EdamamApiProvider(edamam_cache),
+        LLMProvider(),
+    ])
+
+
+_default_chain = None
+_default_chain_lock = threading.Lock()
+
+
+def get_default_chain():
+    """取得全程式共用的營養來源鏈 (斷路器狀態與 Edamam 快取在所有 session 間共用)。"""
+    global _default_chain
+    with _default_chain_lock:
+        if _default_chain is None:
+            _default_chain = build_default_chain()
+        return _default_chain
@@ -0,0 +1,113 @@
+# portion_table.py
+# 典型份量查表：常見食物的「單人份克數」幾乎不會變，不需要每次都問 LLM。
+# 表格由兩種來源累積：LLM 建議並被採用的克數、使用者手動調整後的克數；
+# 每種食物保留最近 N 筆樣本，查詢時回傳其中位數 (對偶爾的極端值不敏感)。
+# 樣本數達到 MIN_SAMPLES_FOR_HIT 才採用查表結果 (不會一直沿用 LLM 的第一次猜測)；
+# 之後仍以 LLM_RESAMPLE_RATE 的機率改問 LLM，讓表格持續累積新樣本。
+# 樣本以 json_store.DebouncedJsonFile 批次寫入磁碟。
+
+import random
+import statistics
+import threading
+from collections import deque
+
+import data_paths
+import json_store
+import metrics
+
+MAX_SAMPLES_PER_FOOD = 51 # 每種食物保留的樣本數 (滑動視窗)
+MIN_SAMPLES_FOR_HIT = 3   # 至少要有幾筆樣本才直接採用查表結果
+LLM_RESAMPLE_RATE = 0.05  # 查表命中時仍改問 LLM 的機率 (持續更新樣本)
+
+
+def _normalize_food_name(food_name):
+    return " ".join(str(food_name).strip().lower().split())
+
+
+class PortionTable:
+    """以 JSON 檔保存的「食物名稱 -> 克數樣本」表，查詢時回傳樣本中位數。"""
+
+    def __init__(self, file_path, max_samples_per_food=MAX_SAMPLES_PER_FOOD, min_samples=MIN_SAMPLES_FOR_HIT,
+                 resample_rate=LLM_RESAMPLE_RATE, save_interval_seconds=json_store.DEFAULT_SAVE_INTERVAL_SECONDS):
+        self.file_path = file_path
+        self.max_samples_per_food = max_samples_per_food
+        self.min_samples = min_samples
+        self.resample_rate = resample_rate
+        self._lock = threading.Lock()
+        self._samples = {} # 正規化名稱 -> deque[克數]
+        self._file = json_store.DebouncedJsonFile(file_path, self._snapshot, description="份量表",
+                                                  save_interval_seconds=save_interval_seconds)
+        self._load()
+
+    def _load(self):
+        raw_table = self._file.load()
+        if raw_table is None:
+            return
+        try:
+            for food_name, samples in raw_table.items():
+                self._samples[food_name] = deque(
+                    (float(grams) for grams in samples if isinstance(grams, (int, float)) and grams > 0),
+                    maxlen=self.max_samples_per_food,
+                )
+        except (AttributeError, TypeError) as e:
+            print(f"警告 (portion_table.py): 份量表 {self.file_path} 格式錯誤，將從空表開始: {e}")
+            self._samples = {}
+
+    def _snapshot(self):
+        with self._lock:
+            return {food_name: list(samples) for food_name, samples in self._samples.items()}
+
+    def flush(self):
+        """立即把尚未寫入的樣本寫入磁碟 (平常由 json_store 的計時器批次寫入)。"""
+        self._file.flush()
+
+    def lookup(self, food_name):
+        """
+        回傳該食物的典型克數 (樣本中位數，整數)；查無或樣本不足時回傳 None。
+        樣本足夠時仍以 resample_rate 的機率回傳 None，讓呼叫端改問 LLM 並記錄新的樣本。
+        """
+        with self._lock:
+            samples = self._samples.get(_normalize_food_name(food_name))
+            if not samples or len(samples) < self.min_samples:
+                metrics.increment("portion_table.misses")
+                return None
+            grams = statistics.median(samples)
+        if random.random() < self.resample_rate:
+            metrics.increment("portion_table.resamples")
+            return None
+        metrics.increment("portion_table.hits")
+        return int(round(grams))
+
+    def record(self, food_name, grams, source="llm"):
+        """
+        加入一筆克數樣本。
+        source: "llm" (LLM 建議並被採用) 或 "user" (使用者調整後的克數)，僅用於統計。
+        """
+        if not food_name or not isinstance(grams, (int, float)) or grams <= 0:
+            return
+        key = _normalize_food_name(food_name)
+        with self._lock:
+            samples = self._samples.setdefault(key, deque(maxlen=self.max_samples_per_food))
+            samples.append(float(grams))
+        self._file.mark_dirty()
+        metrics.increment(f"portion_table.samples_from_{source}")
+
+    def stats(self):
+        with self._lock:
+            return {
+                "food_count": len(self._samples),
+                "sample_count": sum(len(samples) for samples in self._samples.values()),
+            }
+
+
+_portion_table = None
+_portion_table_lock = threading.Lock()
+
+
+def get_portion_table():
+    """取得全程式共用的份量表 (第一次呼叫時從磁碟載入)。"""
+    global _portion_table
+    with _portion_table_lock:
+        if _portion_table is None:
+            _portion_table = PortionTable(data_paths.get_data_path("portion_table.json"))
+        return _portion_table
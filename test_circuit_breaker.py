@@ -0,0 +1,78 @@
+# test_circuit_breaker.py
+# nutrition_providers.CircuitBreaker 的狀態轉換測試 (不連網)。
+# 執行: python -m pytest -q test_circuit_breaker.py
+
+import time
+
+from nutrition_providers import CircuitBreaker
+
+COOLDOWN_SECONDS = 0.05
+
+
+def _open_breaker(failure_threshold=3):
+    breaker = CircuitBreaker("test", failure_threshold=failure_threshold, cooldown_seconds=COOLDOWN_SECONDS)
+    for _ in range(failure_threshold):
+        assert breaker.allow_request()
+        breaker.record_failure()
+    return breaker
+
+
+def test_stays_closed_below_threshold():
+    breaker = CircuitBreaker("test", failure_threshold=3, cooldown_seconds=COOLDOWN_SECONDS)
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.state == "closed"
+    assert breaker.allow_request()
+
+
+def test_success_resets_consecutive_failures():
+    breaker = CircuitBreaker("test", failure_threshold=3, cooldown_seconds=COOLDOWN_SECONDS)
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.state == "closed"
+    assert breaker.stats()["consecutive_failures"] == 2
+
+
+def test_opens_after_threshold_and_rejects_requests():
+    breaker = _open_breaker()
+    assert breaker.state == "open"
+    assert not breaker.allow_request()
+
+
+def test_half_open_after_cooldown_allows_single_trial():
+    breaker = _open_breaker()
+    time.sleep(COOLDOWN_SECONDS * 2)
+    assert breaker.state == "half_open"
+    assert breaker.allow_request()
+    assert not breaker.allow_request() # 試探進行中，其他呼叫仍跳過
+
+
+def test_trial_success_closes_breaker():
+    breaker = _open_breaker()
+    time.sleep(COOLDOWN_SECONDS * 2)
+    assert breaker.allow_request()
+    breaker.record_success()
+    assert breaker.state == "closed"
+    assert breaker.allow_request()
+    assert breaker.allow_request()
+
+
+def test_trial_failure_reopens_breaker():
+    breaker = _open_breaker()
+    time.sleep(COOLDOWN_SECONDS * 2)
+    assert breaker.allow_request()
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert not breaker.allow_request()
+
+
+def test_release_trial_lets_next_request_probe():
+    breaker = _open_breaker()
+    time.sleep(COOLDOWN_SECONDS * 2)
+    assert breaker.allow_request()
+    breaker.release_trial()
+    assert breaker.state == "half_open"
+    assert breaker.allow_request()
@@ -0,0 +1,68 @@
+# test_measure_conversion.py
+# measure_conversion 的單位換算測試 (不連網：只使用手動建立的食物資料)。
+# 執行: python -m pytest -q test_measure_conversion.py
+
+import pytest
+
+pytest.importorskip("streamlit") # edamam_module 在載入時需要 streamlit
+
+import measure_conversion
+
+FOOD_DATA = {
+    "measures": [
+        {"label": "Slice", "weight": 25.0},
+        {"label": "Cup", "weight": 240.0},
+        {"label": "Pinch", "weight": 0.4},
+        {"label": "Patty", "weight": 113.0},
+        {"label": "Serving", "weight": None},
+    ],
+    "nutrients_per_100g": {"calories": 250.0, "protein": 9.0, "fat": 3.2, "carbs": 49.0, "fiber": 2.7},
+}
+
+
+@pytest.mark.parametrize("unit_label, expected", [
+    ("cups", {"cups", "cup"}),
+    ("Slices.", {"slices", "slice"}),
+    ("pinches", {"pinches", "pinch", "pinche"}),
+    ("patties", {"patties", "patty", "pattie"}),
+    ("glass", {"glass"}),
+])
+def test_unit_variants(unit_label, expected):
+    assert measure_conversion._unit_variants(unit_label) == expected
+
+
+def test_unit_variants_does_not_strip_es_from_slices():
+    assert "slic" not in measure_conversion._unit_variants("slices")
+
+
+@pytest.mark.parametrize("quantity, unit_label, expected_grams", [
+    (2, "slices", 50.0),
+    (1, "slice", 25.0),
+    (0.5, "Cups", 120.0),
+    (3, "pinches", 1.2),
+    (2, "patties", 226.0),
+    (150, "g", 150.0),
+    (1, "lbs", 453.592),
+    (2, "oz", 56.699),
+])
+def test_resolve_grams(quantity, unit_label, expected_grams):
+    assert measure_conversion.resolve_grams(FOOD_DATA, quantity, unit_label) == pytest.approx(expected_grams)
+
+
+@pytest.mark.parametrize("quantity, unit_label", [
+    (1, "bowl"),     # 食物資料中沒有的單位
+    (1, "serving"),  # 有標籤但沒有克數
+    (0, "cup"),
+    (None, "cup"),
+    (1, ""),
+])
+def test_resolve_grams_unresolvable(quantity, unit_label):
+    assert measure_conversion.resolve_grams(FOOD_DATA, quantity, unit_label) is None
+
+
+def test_calculate_nutrition_for_amount_scales_per_100g():
+    result = measure_conversion.calculate_nutrition_for_amount(FOOD_DATA, 2, "slices")
+    assert result["source"] == measure_conversion.SOURCE_LOCAL
+    assert result["total_weight_grams"] == 50.0
+    assert result["calories"] == 125
+    assert result["nutrients"]["FIBTG"][0] == pytest.approx(1.35)
@@ -0,0 +1,123 @@
+# test_stage_scheduler.py
+# stage_scheduler.StageGraph 的執行順序 / 中止 / 略過，以及搭配 deadline.Deadline 的截止行為測試 (不連網)。
+# 執行: python -m pytest -q test_stage_scheduler.py
+
+import contextvars
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from deadline import Deadline, cap_seconds, is_expired
+from stage_scheduler import STAGE_FAILED, STAGE_SKIPPED, STAGE_STOPPED, StageGraph
+
+
+@pytest.fixture
+def executor():
+    with ThreadPoolExecutor(max_workers=4) as stage_executor:
+        yield stage_executor
+
+
+def _recording_stage(order, stage_name, value=True):
+    def _stage():
+        order.append(stage_name)
+        return value
+    return _stage
+
+
+def test_dependencies_run_before_dependents(executor):
+    order = []
+    graph = (StageGraph()
+             .add("name", _recording_stage(order, "name"))
+             .add("portion", _recording_stage(order, "portion", 150), depends_on=["name"])
+             .add("per_100g", _recording_stage(order, "per_100g", {"calories_kcal": 52}), depends_on=["name"])
+             .add("scale", _recording_stage(order, "scale"), depends_on=["portion", "per_100g"]))
+    outcomes = graph.run(executor)
+    assert order[0] == "name"
+    assert set(order[1:3]) == {"portion", "per_100g"}
+    assert order[3] == "scale"
+    assert outcomes == {"name": True, "portion": 150, "per_100g": {"calories_kcal": 52}, "scale": True}
+
+
+def test_independent_stages_run_concurrently(executor):
+    # 兩個階段都要等到對方開始才能結束：若依序執行，barrier 會逾時
+    barrier = threading.Barrier(2, timeout=2)
+    graph = StageGraph().add("portion", barrier.wait).add("per_100g", barrier.wait)
+    outcomes = graph.run(executor)
+    assert set(outcomes) == {"portion", "per_100g"}
+    assert STAGE_FAILED not in outcomes.values()
+
+
+def test_stopped_stage_skips_transitive_dependents(executor):
+    order = []
+    graph = (StageGraph()
+             .add("name", _recording_stage(order, "name", False))
+             .add("portion", _recording_stage(order, "portion"), depends_on=["name"])
+             .add("scale", _recording_stage(order, "scale"), depends_on=["portion"])
+             .add("unrelated", _recording_stage(order, "unrelated")))
+    outcomes = graph.run(executor)
+    assert sorted(order) == ["name", "unrelated"]
+    assert outcomes == {"name": STAGE_STOPPED, "portion": STAGE_SKIPPED, "scale": STAGE_SKIPPED, "unrelated": True}
+
+
+def test_failed_stage_skips_dependents(executor):
+    def _raise():
+        raise RuntimeError("boom")
+
+    graph = StageGraph().add("name", _raise).add("portion", lambda: True, depends_on=["name"])
+    assert graph.run(executor) == {"name": STAGE_FAILED, "portion": STAGE_SKIPPED}
+
+
+def test_add_rejects_unknown_dependency():
+    with pytest.raises(ValueError):
+        StageGraph().add("portion", lambda: True, depends_on=["name"])
+
+
+def test_stages_run_in_caller_context(executor):
+    request_id = contextvars.ContextVar("request_id", default=None)
+    request_id.set("analysis-1")
+    outcomes = StageGraph().add("read", request_id.get).run(executor)
+    assert outcomes == {"read": "analysis-1"}
+
+
+def test_expired_deadline_stops_remaining_stages(executor):
+    # 與 analysis_pipeline 的階段相同：截止後的階段直接回傳 False，依賴它的階段都略過
+    deadline = Deadline(0.05)
+    order = []
+
+    def _slow_name():
+        order.append("name")
+        time.sleep(0.1)
+        return True
+
+    def _portion():
+        if is_expired(deadline):
+            return False
+        order.append("portion")
+        return 150
+
+    graph = (StageGraph()
+             .add("name", _slow_name)
+             .add("portion", _portion, depends_on=["name"])
+             .add("scale", _recording_stage(order, "scale"), depends_on=["portion"]))
+    outcomes = graph.run(executor)
+    assert order == ["name"]
+    assert outcomes == {"name": True, "portion": STAGE_STOPPED, "scale": STAGE_SKIPPED}
+
+
+def test_deadline_caps_waits_to_remaining_time():
+    deadline = Deadline(0.2)
+    assert cap_seconds(deadline, 10.0) <= 0.2
+    assert cap_seconds(deadline, 0.01) == 0.01
+    assert cap_seconds(None, 10.0) == 10.0
+    assert not is_expired(deadline)
+    assert not is_expired(None)
+
+
+def test_expired_deadline_has_no_remaining_time():
+    deadline = Deadline(0.0)
+    assert deadline.expired()
+    assert is_expired(deadline)
+    assert deadline.remaining() == 0.0
+    assert cap_seconds(deadline, 10.0) == 0.0
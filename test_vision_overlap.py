@@ -0,0 +1,82 @@
+# test_vision_overlap.py
+# vision_api 物件框 IoU 與重疊去重 (suppress_overlapping_objects) 的測試 (不連網)。
+# 執行: python -m pytest -q test_vision_overlap.py
+
+import pytest
+
+pytest.importorskip("streamlit") # vision_api 在載入時需要 streamlit
+
+from vision_module import vision_api
+
+
+def _box(left, top, right, bottom):
+    """(left, top, right, bottom) -> Vision 正規化頂點列表 (順時針四個角)。"""
+    return [(left, top), (right, top), (right, bottom), (left, bottom)]
+
+
+def _object(name, score, bounding_box):
+    return {"name": name, "score": score, "mid": "", "bounding_box": bounding_box}
+
+
+def test_iou_identical_boxes():
+    assert vision_api.bounding_box_iou(_box(0.1, 0.1, 0.5, 0.5), _box(0.1, 0.1, 0.5, 0.5)) == pytest.approx(1.0)
+
+
+def test_iou_partial_overlap():
+    # 交集 0.5 x 1.0 = 0.5，聯集 1.0 + 1.0 - 0.5 = 1.5
+    assert vision_api.bounding_box_iou(_box(0, 0, 1, 1), _box(0.5, 0, 1.5, 1)) == pytest.approx(1 / 3)
+
+
+@pytest.mark.parametrize("box_a, box_b", [
+    (_box(0, 0, 0.4, 0.4), _box(0.5, 0.5, 1, 1)), # 不重疊
+    (_box(0, 0, 0.5, 0.5), _box(0.5, 0, 1, 0.5)), # 只有邊相接
+    (_box(0, 0, 0.5, 0.5), None),                 # 沒有框
+    (_box(0, 0, 0.5, 0.5), _box(0.2, 0.2, 0.2, 0.6)), # 面積為 0 的框
+])
+def test_iou_zero(box_a, box_b):
+    assert vision_api.bounding_box_iou(box_a, box_b) == 0.0
+
+
+def test_keeps_specific_label_over_generic_with_higher_score():
+    objects = [
+        _object("Food", 0.95, _box(0.1, 0.1, 0.6, 0.6)),
+        _object("Baked goods", 0.9, _box(0.12, 0.1, 0.6, 0.62)),
+        _object("Bread", 0.7, _box(0.1, 0.12, 0.62, 0.6)),
+    ]
+    kept, suppressed = vision_api.suppress_overlapping_objects(objects)
+    assert [obj["name"] for obj in kept] == ["Bread"]
+    assert sorted(name for name, kept_name, _ in suppressed) == ["Baked goods", "Food"]
+    assert all(kept_name == "Bread" for _, kept_name, _ in suppressed)
+
+
+def test_keeps_same_name_objects_in_different_regions():
+    objects = [
+        _object("Apple", 0.9, _box(0.0, 0.0, 0.3, 0.3)),
+        _object("Apple", 0.85, _box(0.6, 0.6, 0.9, 0.9)),
+    ]
+    kept, suppressed = vision_api.suppress_overlapping_objects(objects)
+    assert kept == objects
+    assert suppressed == []
+
+
+def test_keeps_objects_without_boxes_and_preserves_order():
+    objects = [
+        _object("Salad", 0.6, _box(0.0, 0.0, 0.5, 0.5)),
+        _object("Egg", 0.8, None),
+        _object("Salad", 0.9, _box(0.02, 0.0, 0.5, 0.52)),
+        _object("Egg", 0.7, None),
+    ]
+    kept, suppressed = vision_api.suppress_overlapping_objects(objects)
+    assert kept == [objects[1], objects[2], objects[3]]
+    assert [(name, kept_name) for name, kept_name, _ in suppressed] == [("Salad", "Salad")]
+
+
+def test_iou_threshold_controls_suppression():
+    objects = [
+        _object("Rice", 0.9, _box(0, 0, 1, 1)),
+        _object("Curry", 0.8, _box(0.5, 0, 1.5, 1)), # IoU = 1/3
+    ]
+    kept, _ = vision_api.suppress_overlapping_objects(objects, iou_threshold=0.3)
+    assert [obj["name"] for obj in kept] == ["Rice"]
+    kept, _ = vision_api.suppress_overlapping_objects(objects, iou_threshold=0.4)
+    assert [obj["name"] for obj in kept] == ["Rice", "Curry"]
@@ -2,9 +2,12 @@
 
 import streamlit as st
 import os
+import io
 import tempfile
 import json
 
+import cassette # 外部 API 呼叫的錄製 / 重播
+
 # 嘗試載入 google.cloud.vision 套件
 # 這有助於在套件未安裝時提供明確的錯誤訊息
 try:
@@ -20,6 +23,22 @@ except ImportError:
               "請在您的終端機中執行 'pip3 install google-cloud-vision' 指令來安裝。")
     vision = None # 將 vision 設為 None，以便後續檢查 import 是否失敗
 
+# 裁切物件需要 Pillow；沒有安裝時只是無法使用裁切標籤功能，不影響物件偵測
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Object Localization 常回傳的「籠統」標籤，這類標籤需要靠裁切後的標籤偵測取得更具體的名稱
+GENERIC_OBJECT_LABELS = {
+    "food", "baked goods", "fast food", "dish", "cuisine", "ingredient", "produce",
+    "meal", "snack", "fruit", "vegetable", "dessert", "seafood", "staple food",
+    "recipe", "natural foods", "finger food", "comfort food", "junk food",
+}
+CROP_PADDING_RATIO = 0.05   # 裁切時向外多留的邊界 (相對於框的寬高)
+OVERLAP_IOU_THRESHOLD = 0.5 # 兩個物件框的 IoU 超過此值時視為同一個區域 (只保留一個)
+BATCH_ANNOTATE_MAX_IMAGES = 16 # batch_annotate_images 單次請求的圖片數上限
+
 _google_credentials_set = False # 模組級別的變數，用來追蹤憑證是否已經設定成功
 
 def setup_google_credentials():
@@ -32,6 +51,9 @@ def setup_google_credentials():
     if _google_credentials_set: # 如果之前已經成功設定過，就直接返回，不再重複設定
         # print("DEBUG (vision_api.py): Google 憑證已設定，跳過重複設定。") # 除錯時可取消註解
         return
+    if cassette.is_replaying(): # 由 cassette 檔重播，不需要憑證
+        _google_credentials_set = True
+        return
 
     try:
         # "GCP_CREDENTIALS_JSON_CONTENT" 是我們約定在 st.secrets
@@ -107,7 +129,13 @@ def setup_google_credentials():
 
 # def setup_google_credentials(): ... (這部分不變)
 
-def analyze_image_objects(image_content_bytes): # <<< 函式名稱可以改為 analyze_image_objects
+def _timeout_kwargs(timeout):
+    # 未指定時沿用用戶端預設的逾時設定 (明確傳入 timeout=None 代表「不設上限」，所以不傳)
+    return {} if timeout is None else {"timeout": max(0.1, timeout)}
+
+
+@cassette.recordable("vision.analyze_image_objects", timeout_result=None) # 逾時的錯誤在函式內處理，回傳 None
+def analyze_image_objects(image_content_bytes, include_bounding_boxes=False, timeout=None): # <<< 函式名稱可以改為 analyze_image_objects
     """
     使用 Google Cloud Vision API 的 Object Localization 功能來辨識圖片中的物件。
     Args:
@@ -120,6 +148,10 @@ def analyze_image_objects(image_content_bytes): # <<< 函式名稱可以改為 a
               或者，我們可以回傳 (物件名稱, 1.0) 以符合之前的 (description, score) 格式。
               Object Localization 的結果主要是 name 和 bounding_poly。
               GCP Object Localization API response (LocalizedObjectAnnotation) 包含 name, mid, score, bounding_poly.
+        include_bounding_boxes (bool): 為 True 時改為回傳字典列表，每個字典包含
+              'name', 'score', 'mid' 以及 'bounding_box' (正規化座標 [(x, y), ...]，值介於 0~1)，
+              供後續裁切物件使用。
+        timeout (float, 可選): API 呼叫的最長等待秒數 (例如整體分析截止時間的剩餘秒數)。
     """
     global _google_credentials_set # 確保能讀取到全域變數
 
@@ -140,7 +172,7 @@ def analyze_image_objects(image_content_bytes): # <<< 函式名稱可以改為 a
         image = vision.Image(content=image_content_bytes)
 
         # 執行物件偵測 (Object Localization)
-        response = client.object_localization(image=image) # <<< 改用 object_localization
+        response = client.object_localization(image=image, **_timeout_kwargs(timeout)) # <<< 改用 object_localization
 
         if response.error.message:
             print(f"錯誤 (vision_api.py): Vision API (物件偵測) 錯誤: {response.error.message}")
@@ -153,7 +185,16 @@ def analyze_image_objects(image_content_bytes): # <<< 函式名稱可以改為 a
                 # 我們主要需要 name 和 score
                 object_name = localized_object.name
                 object_score = localized_object.score # 通常 object localization 會提供 score
-                if object_name: # 確保名稱不是空的
+                if not object_name: # 確保名稱不是空的
+                    continue
+                if include_bounding_boxes:
+                    extracted_objects.append({
+                        "name": object_name,
+                        "score": object_score,
+                        "mid": localized_object.mid,
+                        "bounding_box": [(vertex.x, vertex.y) for vertex in localized_object.bounding_poly.normalized_vertices],
+                    })
+                else:
                     extracted_objects.append((object_name, object_score))
 
         # print(f"DEBUG (vision_api.py): 成功提取的物件: {extracted_objects}")
@@ -163,5 +204,161 @@ def analyze_image_objects(image_content_bytes): # <<< 函式名稱可以改為 a
         print(f"錯誤 (vision_api.py): 呼叫 Vision API (物件偵測) 時發生 Python 錯誤: {e}")
         return None
 
+def _crop_normalized_box(pil_image, bounding_box):
+    """依正規化座標的框裁切圖片 (含少量外擴邊界)，回傳 JPEG 位元組；框無效時回傳 None。"""
+    if not bounding_box:
+        return None
+    xs = [x for x, _ in bounding_box]
+    ys = [y for _, y in bounding_box]
+    left, right, top, bottom = min(xs), max(xs), min(ys), max(ys)
+    pad_x = (right - left) * CROP_PADDING_RATIO
+    pad_y = (bottom - top) * CROP_PADDING_RATIO
+    width, height = pil_image.size
+    box = (
+        int(max(0.0, left - pad_x) * width),
+        int(max(0.0, top - pad_y) * height),
+        int(min(1.0, right + pad_x) * width),
+        int(min(1.0, bottom + pad_y) * height),
+    )
+    if box[2] - box[0] < 2 or box[3] - box[1] < 2: # 框太小，裁不出有意義的圖
+        return None
+    output = io.BytesIO()
+    pil_image.crop(box).save(output, format="JPEG", quality=90)
+    return output.getvalue()
+
+
+@cassette.recordable("vision.label_object_crops", timeout_result=None)
+def label_object_crops(image_content_bytes, localized_objects, max_labels=5, timeout=None):
+    """
+    將每個偵測到的物件依 bounding box 裁切出來，並用「一次」batch_annotate_images 請求
+    對所有裁切圖做標籤偵測 (Label Detection)，以取得比 Object Localization 更具體的名稱
+    (例如 "Food" -> "Fried rice")。
+    Args:
+        image_content_bytes (bytes): 原圖位元組。
+        localized_objects (list): analyze_image_objects(..., include_bounding_boxes=True) 的結果。
+        max_labels (int): 每個裁切圖最多回傳的標籤數。
+        timeout (float, 可選): 每次批次請求的最長等待秒數。
+    Returns:
+        list: 與 localized_objects 一一對應的列表，每個元素是 [(標籤, 分數), ...]
+              (無法裁切或偵測失敗的物件為空列表)；整體失敗時返回 None。
+    """
+    if vision is None or Image is None:
+        print("警告 (vision_api.py): Vision API 或 Pillow 未成功載入，無法進行物件裁切標籤偵測。")
+        return None
+    if not localized_objects:
+        return []
+    if not _google_credentials_set:
+        setup_google_credentials()
+        if not _google_credentials_set:
+            print("警告 (vision_api.py): Google Cloud 憑證未成功設定，無法進行物件裁切標籤偵測。")
+            return None
+
+    try:
+        with Image.open(io.BytesIO(image_content_bytes)) as pil_image:
+            pil_image = pil_image.convert("RGB")
+            crops = [_crop_normalized_box(pil_image, obj.get("bounding_box")) for obj in localized_objects]
+    except Exception as e:
+        print(f"錯誤 (vision_api.py): 裁切物件圖片時發生錯誤: {e}")
+        return None
+
+    crop_labels = [[] for _ in localized_objects]
+    request_indices = [i for i, crop in enumerate(crops) if crop]
+    if not request_indices:
+        return crop_labels
+
+    try:
+        client = vision.ImageAnnotatorClient()
+        feature = vision.Feature(type_=vision.Feature.Type.LABEL_DETECTION, max_results=max_labels)
+        # 一般情況下物件數不超過 16 個，只需要一次請求；超過時才分批
+        for batch_start in range(0, len(request_indices), BATCH_ANNOTATE_MAX_IMAGES):
+            batch_indices = request_indices[batch_start:batch_start + BATCH_ANNOTATE_MAX_IMAGES]
+            annotate_requests = [
+                vision.AnnotateImageRequest(image=vision.Image(content=crops[i]), features=[feature])
+                for i in batch_indices
+            ]
+            batch_response = client.batch_annotate_images(requests=annotate_requests, **_timeout_kwargs(timeout))
+            for i, response in zip(batch_indices, batch_response.responses):
+                if response.error.message:
+                    print(f"警告 (vision_api.py): 物件 '{localized_objects[i].get('name')}' 的裁切標籤偵測錯誤: {response.error.message}")
+                    continue
+                crop_labels[i] = [(label.description, label.score) for label in response.label_annotations if label.description]
+        return crop_labels
+    except Exception as e:
+        print(f"錯誤 (vision_api.py): 呼叫 Vision API (批次標籤偵測) 時發生 Python 錯誤: {e}")
+        return None
+
+
+def pick_specific_label(object_name, crop_labels, min_score=0.6):
+    """
+    從裁切標籤中挑出比 Object Localization 名稱更具體的標籤。
+    只有當原名稱屬於籠統標籤 (GENERIC_OBJECT_LABELS) 時才替換；
+    找不到夠有信心且非籠統的標籤時，保留原名稱。
+    """
+    if not crop_labels or object_name.lower() not in GENERIC_OBJECT_LABELS:
+        return object_name
+    for label, score in sorted(crop_labels, key=lambda pair: pair[1], reverse=True):
+        if score >= min_score and label.lower() not in GENERIC_OBJECT_LABELS:
+            return label
+    return object_name
+
+def _box_bounds(bounding_box):
+    """正規化座標的頂點列表 -> (left, top, right, bottom)；框無效時回傳 None。"""
+    if not bounding_box:
+        return None
+    xs = [x for x, _ in bounding_box]
+    ys = [y for _, y in bounding_box]
+    left, top, right, bottom = min(xs), min(ys), max(xs), max(ys)
+    if right <= left or bottom <= top:
+        return None
+    return left, top, right, bottom
+
+
+def bounding_box_iou(box_a, box_b):
+    """兩個物件框 (正規化座標的頂點列表) 的 IoU (交集面積 / 聯集面積)；任一框無效時回傳 0。"""
+    bounds_a, bounds_b = _box_bounds(box_a), _box_bounds(box_b)
+    if bounds_a is None or bounds_b is None:
+        return 0.0
+    intersection_width = min(bounds_a[2], bounds_b[2]) - max(bounds_a[0], bounds_b[0])
+    intersection_height = min(bounds_a[3], bounds_b[3]) - max(bounds_a[1], bounds_b[1])
+    if intersection_width <= 0 or intersection_height <= 0:
+        return 0.0
+    intersection = intersection_width * intersection_height
+    area_a = (bounds_a[2] - bounds_a[0]) * (bounds_a[3] - bounds_a[1])
+    area_b = (bounds_b[2] - bounds_b[0]) * (bounds_b[3] - bounds_b[1])
+    return intersection / (area_a + area_b - intersection)
+
+
+def suppress_overlapping_objects(localized_objects, iou_threshold=OVERLAP_IOU_THRESHOLD):
+    """
+    重疊框去重 (NMS)：同一個區域常同時偵測出 "Food"、"Baked goods"、"Bread"，每個都會觸發一整串 LLM 呼叫。
+    依 (是否為具體名稱, 信賴度) 由高到低挑選，與已保留的物件框 IoU 超過門檻的物件捨棄，
+    因此每個重疊群組只留下最具體、信賴度最高的標籤。沒有框的物件一律保留。
+    Args:
+        localized_objects (list): analyze_image_objects(..., include_bounding_boxes=True) 的結果。
+    Returns:
+        tuple: (保留的物件列表 (維持原本順序), 捨棄紀錄 [(捨棄的名稱, 保留的名稱, IoU), ...])
+    """
+    ranked_indices = sorted(
+        range(len(localized_objects)),
+        key=lambda i: (localized_objects[i]["name"].lower() not in GENERIC_OBJECT_LABELS, localized_objects[i]["score"]),
+        reverse=True,
+    )
+    kept_indices = []
+    suppressed = []
+    for i in ranked_indices:
+        candidate = localized_objects[i]
+        overlapping = None
+        if candidate.get("bounding_box"):
+            for kept_index in kept_indices:
+                iou = bounding_box_iou(candidate["bounding_box"], localized_objects[kept_index].get("bounding_box"))
+                if iou > iou_threshold:
+                    overlapping = (localized_objects[kept_index]["name"], iou)
+                    break
+        if overlapping:
+            suppressed.append((candidate["name"], overlapping[0], round(overlapping[1], 3)))
+        else:
+            kept_indices.append(i)
+    return [localized_objects[i] for i in sorted(kept_indices)], suppressed
+
 # 舊的 analyze_image_labels 函式可以先保留，或者如果您確定不再使用標籤偵測，可以移除或註解掉。
 # def analyze_image_labels(image_content_bytes): ... (舊的函式)